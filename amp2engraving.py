@@ -1,12 +1,12 @@
-from math import pi, asin, hypot, sin, sqrt, floor
+from math import pi, asin, floor
 import numpy as np
-from PIL import Image
 import warnings
 
 import exporter
+import kernels
 from parameters import default_parameters as p
-from geometry import cyl2cart
-import builder3d
+import geometry as g
+# builder3d (cadquery) is slow to import, so it is only imported by the functions using it
 
 
 def amplitudes_to_cylinder_points(amplitudes: np.ndarray, frame_rate: float) -> None:
@@ -14,7 +14,7 @@ def amplitudes_to_cylinder_points(amplitudes: np.ndarray, frame_rate: float) ->
     Convert a series of sound amplitudes to a list of points on a cylinder.
     
     The points are calculated based on the parameters defined in the `parameters.py` file.
-    The points are then exported to a CSV file.
+    The points are then exported to a binary (npz) or CSV file, depending on `path_format`.
 
 
     Parameters
@@ -28,38 +28,27 @@ def amplitudes_to_cylinder_points(amplitudes: np.ndarray, frame_rate: float) ->
     -------
     None
     """
-    path_points_cyl = []
-    path_points_plane = []
-    for i,amp in enumerate(amplitudes):
-        radius = p.R-p.depth
-        phase = (i) * p.speed_angular/frame_rate
-        elevation = phase*p.pitch/(2*pi) + amp*p.max_amplitude/2 + p.end_margin + p.start_pos + p.offset_from_centerline
-        if p.right_thread: phase = -phase
-
-        x = radius * phase
-        y = elevation
-        z = p.R
-        if elevation > p.L - p.end_margin:
-            warnings.warn(f"Engraving stopped by end of cylinder.")
-            break
-        else:
-            path_points_cyl.append((radius, phase, elevation))
-            path_points_plane.append((x, y, z))
+    radius = p.R-p.depth
+    phase, elevation, nb_points = cylinder_path(amplitudes, np.arange(len(amplitudes)) * p.speed_angular/frame_rate)
+    path_points_cyl = np.stack([np.full(nb_points, radius), phase[:nb_points], elevation[:nb_points]], axis=-1)
+    path_points_plane = g.unroll_cylinder(path_points_cyl, radius)
+    path_points_plane[:, 2] = p.R
 
     used_length = path_points_cyl[-1][-1] - p.start_pos - 2*p.end_margin
-    print(f"Path contains {i+1}/{len(amplitudes)} points ({round((i+1)/len(amplitudes)*100,3)} %) from the audio segment.")
+    print(f"Path contains {nb_points}/{len(amplitudes)} points ({round(nb_points/len(amplitudes)*100,3)} %) from the audio segment.")
     print(f"Engraving takes {round(used_length, 3)} mm, {round(used_length/(p.L - 2*p.end_margin)*100, 3)} % of the available space of the cylinder.")
 
     # Create the engraved cylinder and wire
-    exporter.export_path_to_csv(path_points_cyl, p.output_folder+p.output_filename+'_cyl', split_files=p.split_files, files_per_turn=p.files_per_turn, cyl_coord=True)
-    exporter.export_path_to_csv(path_points_plane, p.output_folder+p.output_filename+'_plan', split_files=p.split_files, files_per_turn=p.files_per_turn, cyl_coord=False)
+    export_path = exporter.export_path_to_npz if p.path_format == 'npz' else exporter.export_path_to_csv
+    export_path(path_points_cyl, p.output_folder+p.output_filename+'_cyl', split_files=p.split_files, files_per_turn=p.files_per_turn, cyl_coord=True)
+    export_path(path_points_plane, p.output_folder+p.output_filename+'_plan', split_files=p.split_files, files_per_turn=p.files_per_turn, cyl_coord=False)
 
 def amplitudes_to_disc_points(amplitudes: np.ndarray, frame_rate: float) -> None:
     """
     Convert a series of sound amplitudes to a list of points on a disc.
     
     The points are calculated based on the parameters defined in the `parameters.py` file.
-    The points are then exported to a CSV file.
+    The points are then exported to a binary (npz) or CSV file, depending on `path_format`.
 
 
     Parameters
@@ -73,28 +62,18 @@ def amplitudes_to_disc_points(amplitudes: np.ndarray, frame_rate: float) -> None
     -------
     None
     """
-    path_points = []
     R_max, R_min = p.R - p.end_margin - p.start_pos, p.end_margin
-    path_points.append((R_max+p.offset_from_centerline+amplitudes[0]*p.max_amplitude/2, 0, p.L-p.depth))
-    for i,amp in enumerate(amplitudes[1:]):
-        _, prev_teta, z = path_points[-1]
-        
-        teta = prev_teta + 2 * asin(p.speed_angular/(2*frame_rate))
-        r = R_max * (1 - teta*p.pitch/(2*pi*(R_max - R_min))) + amp*p.max_amplitude/2 + p.offset_from_centerline
-
-        if r < R_min:
-            warnings.warn(f"Engraving stopped by center of disc.")
-            break
-        else:
-            path_points.append((r, teta, z))
+    r, teta, nb_points = disc_path(amplitudes, frame_rate)
+    path_points = np.stack([r[:nb_points], teta[:nb_points], np.full(nb_points, p.L-p.depth)], axis=-1)
 
     used_radius = R_max - path_points[-1][0]
-    print(f"Path contains {i+1}/{len(amplitudes)} points ({round((i+1)/len(amplitudes)*100,3)} %) from the audio segment.")
+    print(f"Path contains {nb_points}/{len(amplitudes)} points ({round(nb_points/len(amplitudes)*100,3)} %) from the audio segment.")
     print(f"Engraving is {round(used_radius, 3)} mm wide, {round(used_radius/(R_max - R_min)*100, 3)} % of the available space of the disc.")
 
-    # Export the path to a CSV file
+    # Export the path to a binary or CSV file
     out_name = p.output_folder+p.output_filename
-    exporter.export_path_to_csv(path_points, out_name, split_files=p.split_files, files_per_turn=p.files_per_turn, cyl_coord=True)
+    export_path = exporter.export_path_to_npz if p.path_format == 'npz' else exporter.export_path_to_csv
+    export_path(path_points, out_name, split_files=p.split_files, files_per_turn=p.files_per_turn, cyl_coord=True)
     print(f"Exported file to {out_name}.")
 
 def amplitudes_to_cylinder_image(amplitudes: np.ndarray, frame_rate: float) -> None:
@@ -122,43 +101,31 @@ def amplitudes_to_cylinder_image(amplitudes: np.ndarray, frame_rate: float) -> N
     image = p.white * np.ones((img_height, img_width), dtype=np.uint8)
 
     # Color the pixel in the image
-    for i,amp in enumerate(amplitudes):
-        phase = (i) * p.speed_angular/frame_rate
-
-        x = p.R * phase
-        y = phase*p.pitch/(2*pi) + amp*p.max_amplitude/2 + p.end_margin + p.start_pos + p.offset_from_centerline
-        if y > p.L - p.end_margin:
-            warnings.warn(f"Engraving stopped by end of cylinder.")
-            break
-        else:
-            x_pixel, y_pixel = int(x / p.pixel_size) % img_width, int(y / p.pixel_size)
-            if p.interpolate:
-                # Color according to the distance to the center of the engraving
-                for j in range(p.engraving_pixel_width):
-                    dy = j - p.engraving_pixel_width//2
-                    if 0 <= y_pixel+dy < img_height:
-                        y_pixel_center = (y_pixel+dy + 0.5) * p.pixel_size
-                        distance = abs(y - y_pixel_center)
-                        image[y_pixel+dy, x_pixel] = int(min(p.white * distance/(p.width/2), p.white))
-            else:
-                # Color 100% black the pixel where the center of the engraving lies, and fade gradually to white
-                image[y_pixel-2:y_pixel+3, x_pixel] = p.white*2/3
-                image[y_pixel-1:y_pixel+2, x_pixel] = p.white*1/3
-                image[y_pixel, x_pixel]             = p.white*0/3
-
-    print(f"Path contains {i+1}/{len(amplitudes)} points ({round((i+1)/len(amplitudes)*100,3)} %) from the audio segment.")
+    phase = np.arange(len(amplitudes)) * p.speed_angular/frame_rate
+    x = p.R * phase
+    y = phase*p.pitch/(2*pi) + np.asarray(amplitudes, dtype=float)*p.max_amplitude/2 + p.end_margin + p.start_pos + p.offset_from_centerline
+    nb_points = truncate_path(y > p.L - p.end_margin, "Engraving stopped by end of cylinder.")
+    x, y = x[:nb_points], y[:nb_points]
+    x_pixel, y_pixel = (x / p.pixel_size).astype(np.int64) % img_width, (y / p.pixel_size).astype(np.int64)
+    if p.interpolate:
+        # Color according to the distance to the center of the engraving
+        dy = np.arange(p.engraving_pixel_width) - p.engraving_pixel_width//2
+        rows = y_pixel[:, None] + dy[None, :]
+        cols = np.broadcast_to(x_pixel[:, None], rows.shape)
+        valid = (0 <= rows) & (rows < img_height)
+        distance = np.abs(y[:, None] - (rows + 0.5) * p.pixel_size)
+        values = np.minimum(p.white * distance/(p.width/2), p.white).astype(np.int64)
+        image[rows[valid], cols[valid]] = values[valid]
+    else:
+        # Color 100% black the pixel where the center of the engraving lies, and fade gradually to white
+        for half_band, color in ((2, p.white*2/3), (1, p.white*1/3), (0, p.white*0/3)):
+            for dy in range(-half_band, half_band+1):
+                image[y_pixel+dy, x_pixel] = color
+
+    print(f"Path contains {nb_points}/{len(amplitudes)} points ({round(nb_points/len(amplitudes)*100,3)} %) from the audio segment.")
 
     # Save the image
-    Image.fromarray(image).save(p.output_folder+p.output_filename+".tiff", 
-                                format="TIFF",
-                                quality=100, 
-                                compression=None, 
-                                dpi=(25.4/p.pixel_size, 25.4/p.pixel_size),
-                                artist="Vincent Philippoz",
-                                description=f"Plan de gravure pour un cylindre de {p.L} mm de long et {p.R*2} mm de diametre.",
-                                copyright="Hublot SA",
-                                software="Python 3",
-                                )
+    exporter.export_image_to_tiff(image, p.output_folder+p.output_filename+".tiff")
 
 def amplitudes_to_disc_image(amplitudes: np.ndarray, frame_rate: float) -> None:
     """
@@ -191,48 +158,38 @@ def amplitudes_to_disc_image(amplitudes: np.ndarray, frame_rate: float) -> None:
     image[center-width_cross_half:center+width_cross_half, center-length_cross_half:center+length_cross_half] = 0
 
     # Color the pixel in the image
-    path_points = []
+    if not p.interpolate:
+        raise NotImplementedError
     R_max, _ = p.R - p.end_margin - p.start_pos, p.end_margin
-    path_points.append((R_max+p.offset_from_centerline+amplitudes[0]*p.max_amplitude/2, 0))
-    for _,amp in enumerate(amplitudes):
-        _, prev_teta = path_points[-1]
-        
-        teta = prev_teta + 2 * asin(p.speed_angular/(2*frame_rate))
-        r = R_max * (1 - teta*p.pitch/(2*pi*R_max)) + amp*p.max_amplitude/2 + p.offset_from_centerline
-
-        path_points.append((r, teta))
-
-        x, y, _ = cyl2cart(r, teta, 0)
-        x_pixel_exact, y_pixel_exact = x / p.pixel_size + center, y / p.pixel_size + center
-        x_pixel_approx, y_pixel_approx = int(x_pixel_exact), int(y_pixel_exact)
-        if p.interpolate:
-            # Color according to the distance to the center of the engraving
-            for j in range(p.engraving_pixel_width):
-                for k in range(p.engraving_pixel_width):
-                    dx, dy = j - p.engraving_pixel_width//2, k - p.engraving_pixel_width//2
-                    if 0 <= int(x_pixel_exact)+dx < img_side and 0 <= int(y_pixel_exact)+dy < img_side:
-                        x_currpixel_center = (x_pixel_approx+dx + 0.5 - center) * p.pixel_size
-                        y_currpixel_center = (y_pixel_approx+dy + 0.5 - center) * p.pixel_size
-                        distance = hypot(x-x_currpixel_center, y - y_currpixel_center)
-                        image[y_pixel_approx+dy, x_pixel_approx+dx] = int(min(p.white * distance/(p.width/2), image[int(y_pixel_exact)+dy, int(x_pixel_exact)+dx]))
-        else:
-            raise NotImplementedError
+    if p.disc_speed == 'linear':
+        # Constant linear velocity: each angle step depends on the radius of the previous point
+        teta = kernels.clv_spiral(len(amplitudes), R_max, p.pitch/(2*pi), p.speed/frame_rate)
+    else:
+        teta = np.cumsum(np.full(len(amplitudes), 2 * asin(p.speed_angular/(2*frame_rate))))
+    r = R_max * (1 - teta*p.pitch/(2*pi*R_max)) + np.asarray(amplitudes, dtype=float)*p.max_amplitude/2 + p.offset_from_centerline
+    x, y, _ = g.cyl2cart(r, teta, 0)
+
+    # Color according to the distance to the center of the engraving, by chunks to bound the memory usage
+    d = np.arange(p.engraving_pixel_width) - p.engraving_pixel_width//2
+    dx, dy = (a.ravel() for a in np.meshgrid(d, d, indexing='ij'))
+    for start in range(0, len(x), 65536):
+        x_chunk, y_chunk = x[start:start+65536, None], y[start:start+65536, None]
+        x_pixel_approx = (x_chunk / p.pixel_size + center).astype(np.int64)
+        y_pixel_approx = (y_chunk / p.pixel_size + center).astype(np.int64)
+        cols, rows = x_pixel_approx + dx, y_pixel_approx + dy
+        valid = (0 <= cols) & (cols < img_side) & (0 <= rows) & (rows < img_side)
+        x_currpixel_center = (cols + 0.5 - center) * p.pixel_size
+        y_currpixel_center = (rows + 0.5 - center) * p.pixel_size
+        distance = np.hypot(x_chunk - x_currpixel_center, y_chunk - y_currpixel_center)
+        values = np.minimum(p.white * distance/(p.width/2), p.white).astype(np.uint8)
+        np.minimum.at(image, (rows[valid], cols[valid]), values[valid])
 
     # Save the image
-    Image.fromarray(image).save(p.output_folder+p.output_filename+".tiff", 
-                                format="TIFF",
-                                quality=100, 
-                                compression=None, 
-                                dpi=(25.4/p.pixel_size, 25.4/p.pixel_size),
-                                artist="Vincent Philippoz",
-                                description=f"Plan de gravure pour un cylindre de {p.L} mm de long et {p.R*2} mm de diametre.",
-                                copyright="Hublot SA",
-                                software="Python 3",
-                                )
+    exporter.export_image_to_tiff(image, p.output_folder+p.output_filename+".tiff")
 
 def amplitudes_to_gcode(amplitudes: np.ndarray, frame_rate: float) -> None:
     """
-    Convert a series of sound amplitudes to G-code for engraving on a cylinder.
+    Convert a series of sound amplitudes to G-code for engraving on a cylinder or a disc.
     
     The G-code is generated based on the parameters defined in the `parameters.py` file.
     The G-code is then exported to a file.
@@ -248,64 +205,292 @@ def amplitudes_to_gcode(amplitudes: np.ndarray, frame_rate: float) -> None:
     -------
     None
     """
-    # Initialisation g-code blocks 
-    text = ""
-    gcode_one_pass = ""
+    gcode_pass = amplitudes_to_disc_gcode_pass if p.SURFACE_TYPE == 'disc' else amplitudes_to_gcode_pass
+    gcode_one_pass, x0, a0, length_one_pass, used_length = gcode_pass(amplitudes, frame_rate)
+    text, passes_depth = gcode_pass_to_text(gcode_one_pass, x0, a0)
 
+    # Export G-code to a file, with the restart index
+    filenames = exporter.export_text_to_gcode(text, gcode_chunk_headers(text, gcode_one_pass, x0, a0))
+    import restart
+    restart.export_gcode_index(restart.build_gcode_index(text, gcode_one_pass, x0, a0, len(filenames)), restart.index_filename())
+    print_gcode_summary(passes_depth, length_one_pass, used_length, gcode_pass_time(amplitudes, frame_rate))
+
+def amplitudes_to_gcode_pass(amplitudes: np.ndarray, frame_rate: float) -> tuple[str, float, float, float, float]:
+    """
+    Convert a series of sound amplitudes to the G-code blocks of one engraving pass on a cylinder.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    G-code blocks of one pass, X and A of the first block, length of one pass [mm] and used length of the cylinder [mm].
+    """
     # Create g-code blocks for one pass of engraving
-    length_one_pass = 0
-    points = []
-    x0, a0 = 0, 0
-    for i,amp in enumerate(amplitudes):
-        # Compute point
-        phase = (i) * p.speed/p.R / frame_rate
-        elevation = phase*p.pitch/(2*pi) + amp*p.max_amplitude/2 + p.end_margin + p.start_pos + p.offset_from_centerline
-        if p.right_thread: phase = -phase
-        points.append([phase, elevation]) 
-
-        # Compute length of segment
-        dphase = p.speed_angular/frame_rate
-        dl = sqrt((sin(dphase) * (p.R-p.depth))**2 + (dphase*p.pitch/(2*pi) + amp*p.max_amplitude/2)**2)
-        if elevation > p.L - p.end_margin:
-            warnings.warn(f"Engraving stopped by end of cylinder.")
-            break
-        else:
-            # Create g-code line
-            angle = np.rad2deg(phase) % 360
-            if p.right_thread and angle > 0: angle -= 360
-            line = f"\nX{round(elevation, 3)}A{round(angle, 3)}"
-            gcode_one_pass += line
-            length_one_pass += dl
-            if i == 0:
-                x0 = round(elevation, 3)
-                a0 = round(angle, 3)
-
-    check_intersection(np.array(points), frame_rate)
-
-    # Repeat for each pass
+    phase, elevation, angle, nb_points = gcode_path(amplitudes, frame_rate)
+    x_blocks, a_blocks = np.round(elevation[:nb_points], 3), np.round(angle[:nb_points], 3)
+    gcode_one_pass = "".join(f"\nX{x}A{a}" for x, a in zip(x_blocks.tolist(), a_blocks.tolist()))
+    x0, a0 = (x_blocks[0], a_blocks[0]) if nb_points else (0, 0)
+    length_one_pass = np.sum(g.segment_lengths_cyl(p.R-p.depth, phase[:nb_points], elevation[:nb_points]))
+
+    # The point stopping the engraving is kept for the checks
+    points = np.stack([phase, elevation], axis=-1)[:nb_points+1]
+    check_intersection(points, frame_rate)
+
+    used_length = points[-1][1] - p.start_pos - 2*p.end_margin
+    return gcode_one_pass, x0, a0, length_one_pass, used_length
+
+def gcode_path(amplitudes: np.ndarray, frame_rate: float) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """
+    Compute the path followed by the G-code blocks on a cylinder.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    Phase [rad], X (elevation) [mm], A (angle) [°] of each sample, and number of points before the end of the cylinder.
+    """
+    phase, elevation, nb_points = cylinder_path(amplitudes, np.arange(len(amplitudes)) * p.speed/p.R / frame_rate)
+    angle = np.rad2deg(phase) % 360
+    if p.right_thread:
+        angle = np.where(angle > 0, angle - 360, angle)
+    return phase, elevation, angle, nb_points
+
+def amplitudes_to_disc_gcode_pass(amplitudes: np.ndarray, frame_rate: float) -> tuple[str, float, float, float, float]:
+    """
+    Convert a series of sound amplitudes to the G-code blocks of one engraving pass on a disc.
+
+    The blocks are X (radius) [mm] and C (angle) [°] for `disc_gcode_axes` = 'polar': the controller interpolates
+    the radius and the angle linearly, so each block follows the spiral. They are X and Y [mm] for 'xy',
+    with the center of the disc at the origin.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    G-code blocks of one pass, first and second axis of the first block, length of one pass [mm] and used radius of the disc [mm].
+    """
+    r, teta, nb_points = disc_gcode_path(amplitudes, frame_rate)
+    if p.disc_gcode_axes == 'polar':
+        first_blocks, second_blocks = np.round(r, 3), np.round(np.rad2deg(teta) % 360, 3)
+    else:
+        first_blocks, second_blocks = np.round(r*np.cos(teta), 3), np.round(r*np.sin(teta), 3)
+    second_axis = p.gcode_axes[1]
+    gcode_one_pass = "".join(f"\nX{x}{second_axis}{a}" for x, a in zip(first_blocks.tolist(), second_blocks.tolist()))
+    x0, a0 = (first_blocks[0], second_blocks[0]) if len(r) else (0, 0)
+    length_one_pass = np.sum(np.hypot(np.diff(r*np.cos(teta)), np.diff(r*np.sin(teta))))
+
+    used_length = p.R - p.end_margin - p.start_pos - r[-1]
+    print(f"Path contains {nb_points}/{len(amplitudes)} points ({round(nb_points/len(amplitudes)*100,3)} %) from the audio segment.")
+    if len(r) < nb_points:
+        print(f"{nb_points - len(r)} points merged near the center, to stay below {p.gcode_block_rate} blocks/s at {p.feed_rate} mm/min.")
+    return gcode_one_pass, x0, a0, length_one_pass, used_length
+
+def disc_gcode_path(amplitudes: np.ndarray, frame_rate: float) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Compute the path followed by the G-code blocks on a disc.
+
+    Near the center, consecutive samples get so close that the controller cannot process one block per sample
+    at the feed rate. The samples are then merged, so that the blocks are on average at least as long as the
+    distance travelled at the feed rate between two blocks (`gcode_block_rate`).
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    Radius [mm] and angle [rad] of each block, and number of points before the center of the disc.
+    """
+    r, teta, nb_points = disc_path(amplitudes, frame_rate)
+    r, teta = r[:nb_points], teta[:nb_points]
+    distance = np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(r*np.cos(teta)), np.diff(r*np.sin(teta))))])
+
+    # Keep the first sample of each interval of min_length along the path, and the last sample
+    min_length = p.feed_rate/60 / p.gcode_block_rate
+    keep = np.concatenate([[True], np.diff(np.floor(distance / min_length)) > 0])
+    keep[-1] = True
+    return r[keep], teta[keep], nb_points
+
+def gcode_pass_time(amplitudes: np.ndarray, frame_rate: float) -> float:
+    """
+    Estimate the machining time of one pass, with the acceleration of the machine.
+
+    The speed at each junction of two blocks is limited by the feed rate, by the junction deviation
+    (the sharper the change of direction, the slower), and by the acceleration needed to reach
+    the speed of the next junctions.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    Machining time of one pass [s].
+    """
+    if p.SURFACE_TYPE == 'disc':
+        r, teta, _ = disc_gcode_path(amplitudes, frame_rate)
+        dx, dz = np.diff(r*np.cos(teta)), np.diff(r*np.sin(teta))
+    else:
+        phase, elevation, _, nb_points = gcode_path(amplitudes, frame_rate)
+        dx, dz = np.diff((p.R-p.depth) * phase[:nb_points]), np.diff(elevation[:nb_points])
+    lengths = np.hypot(dx, dz)
+    feed, acceleration = p.feed_rate/60, p.max_acceleration
+
+    # Junction deviation: sin_half is 1 for a straight junction and 0 for a U-turn
+    cos_turn = (dx[:-1]*dx[1:] + dz[:-1]*dz[1:]) / np.maximum(lengths[:-1]*lengths[1:], 1e-300)
+    sin_half = np.sqrt(np.clip((1 + cos_turn)/2, 0, 1))
+    with np.errstate(divide='ignore'):
+        junction_speed = np.sqrt(acceleration * p.junction_deviation * sin_half / (1 - sin_half))
+    max_speeds = np.concatenate([[0.0], np.minimum(junction_speed, feed), [0.0]])
+    speeds = kernels.feed_profile(lengths, max_speeds, acceleration)
+
+    # Trapezoidal speed profile of each block, between the speeds of its junctions
+    v0, v1 = speeds[:-1], speeds[1:]
+    v_peak = np.minimum(feed, np.sqrt(acceleration*lengths + (v0**2 + v1**2)/2))
+    cruise = lengths - (2*v_peak**2 - v0**2 - v1**2) / (2*acceleration)
+    times = (2*v_peak - v0 - v1) / acceleration + np.divide(cruise, v_peak, out=np.zeros_like(cruise), where=v_peak > 0)
+    return float(np.sum(times))
+
+def passes_depths() -> list[float]:
+    """
+    Compute the depth removed by each pass of the engraving.
+
+    Passes start at `start_depth` and remove at most `depth_of_cut` until `depth` is reached.
+
+    Returns
+    -------
+    List of the depth removed by each pass [mm].
+    """
     cutted_depth = p.start_depth
     passes_depth = []
-    total_length = 0.0
     while cutted_depth < p.depth:
         pass_depth = min(p.depth - cutted_depth, p.depth_of_cut)
         if pass_depth <= 0.01*p.depth_of_cut:
             break
         passes_depth.append(pass_depth)
+        cutted_depth += pass_depth
+    return passes_depth
+
+def gcode_pass_to_text(gcode_one_pass: str, x0: float, a0: float) -> tuple[str, list[float]]:
+    """
+    Repeat the G-code blocks of one pass for each pass of the engraving.
+
+    A depth change sequence is inserted between two passes.
+
+    Parameters
+    ----------
+    gcode_one_pass : str
+        G-code blocks of one pass.
+    x0 : float
+        X of the first block.
+    a0 : float
+        A of the first block.
+
+    Returns
+    -------
+    G-code of all passes and list of the depth removed by each pass [mm].
+    """
+    sequences, passes_depth = depth_change_sequences(x0, a0)
+    text = "".join(sequence + gcode_one_pass for sequence in sequences)
+    return text, passes_depth
+
+def depth_change_sequences(x0: float, a0: float) -> tuple[list[str], list[float]]:
+    """
+    G-code inserted before each pass: nothing before the first one, a depth change sequence before the others.
 
-        # Add one pass to gcode
+    Parameters
+    ----------
+    x0 : float
+        X of the first block.
+    a0 : float
+        A of the first block.
+
+    Returns
+    -------
+    G-code inserted before each pass and list of the depth removed by each pass [mm].
+    """
+    sequences = []
+    passes_depth = passes_depths()
+    cutted_depth = p.start_depth
+    for i, pass_depth in enumerate(passes_depth):
         cutted_depth += pass_depth
-        if len(passes_depth) > 1: 
-            text += p.depth_change_sequence(cutted_depth, x0, a0)
-        text += gcode_one_pass
-        total_length += length_one_pass
+        sequences.append(p.depth_change_sequence(cutted_depth, x0, a0) if i > 0 else "")
+    return sequences, passes_depth
 
-    # Export G-code to a file
-    exporter.export_text_to_gcode(text, x0, a0)
-    used_length = points[-1][1] - p.start_pos - 2*p.end_margin
+def gcode_chunk_headers(text: str, gcode_one_pass: str, x0: float, a0: float) -> list[str]:
+    """
+    INITIAL_GCODE of each G-code file: approach of the first block of the file, at the depth of its pass.
+
+    Parameters
+    ----------
+    text : str
+        G-code of all passes, from `gcode_pass_to_text`.
+    gcode_one_pass : str
+        G-code blocks of one pass.
+    x0 : float
+        X of the first block.
+    a0 : float
+        A of the first block.
+
+    Returns
+    -------
+    Header of each file, as split by `exporter.gcode_chunk_bounds`.
+    """
+    sequences, passes_depth = depth_change_sequences(x0, a0)
+    depths = p.start_depth + np.cumsum(passes_depth)
+    pass_starts = np.cumsum([0] + [len(s) + len(gcode_one_pass) for s in sequences])
+    headers = []
+    for file_num, (start, _) in enumerate(exporter.gcode_chunk_bounds(text)):
+        i = min(np.searchsorted(pass_starts, start, side='right') - 1, len(sequences) - 1)
+        if start < pass_starts[i] + len(sequences[i]):
+            # The file starts in a depth change sequence, the next block is the first one of the pass
+            x, a = str(x0), str(a0)
+        else:
+            # Each chunk but the first starts with the newline before a block
+            end = text.find('\n', start+1)
+            block = text[start+1:end if end != -1 else len(text)]
+            x, a = block[1:].split(p.gcode_axes[1])
+        headers.append(p.INITIAL_GCODE(x, a, str(file_num+1), depth=float(depths[i])))
+    return headers
+
+def print_gcode_summary(passes_depth: list[float], length_one_pass: float, used_length: float, time_one_pass: float = None) -> None:
+    """
+    Print the number of passes, the engraving length and the machining time of a G-code.
+
+    The machining time is given at the feed rate, and with the acceleration limits if `time_one_pass` is given [s].
+    """
+    total_length = length_one_pass * len(passes_depth)
     print(f"Number of passes: {len(passes_depth)} ({[round(d*1e3, 0) for d in passes_depth]} [um])")
     print(f"Total engraving length: {total_length:.3f} mm")
-    print(f"Engraving takes {round(used_length, 3)} mm, {round(used_length/(p.L - 2*p.end_margin)*100, 3)} % of the available space of the cylinder.")
+    if p.SURFACE_TYPE == 'disc':
+        print(f"Engraving is {round(used_length, 3)} mm wide, {round(used_length/(p.R - p.start_pos - 2*p.end_margin)*100, 3)} % of the available space of the disc.")
+    else:
+        print(f"Engraving takes {round(used_length, 3)} mm, {round(used_length/(p.L - 2*p.end_margin)*100, 3)} % of the available space of the cylinder.")
     print(f"Machining time: ~{total_length / p.feed_rate // 60:.0f}h{total_length / p.feed_rate % 60:.0f}min")
+    if time_one_pass is not None:
+        total_time = time_one_pass * len(passes_depth) / 60
+        print(f"Machining time with acceleration limits: ~{total_time // 60:.0f}h{total_time % 60:.0f}min")
 
 def amplitudes_to_wire(amplitudes: np.ndarray, frame_rate: float) -> None:
     """
@@ -325,30 +510,24 @@ def amplitudes_to_wire(amplitudes: np.ndarray, frame_rate: float) -> None:
     -------
     None
     """
-    path_points_cyl = []
-    path_points_plane = []
-    for i,amp in enumerate(amplitudes):
-        radius = p.R-p.depth
-        phase = (i) * p.speed_angular/frame_rate
-        elevation = phase*p.pitch/(2*pi) + amp*p.max_amplitude/2 + p.end_margin + p.start_pos + p.offset_from_centerline
-        if p.right_thread: phase = -phase
-
-        x = radius * phase
-        y = elevation
-        z = p.R
-        if elevation > p.L - p.end_margin:
-            warnings.warn(f"Engraving stopped by end of cylinder.")
-            break
-        else:
-            path_points_cyl.append(cyl2cart(radius, phase, elevation))
-            path_points_plane.append((x, y, z))
+    radius = p.R-p.depth
+    phase, elevation, nb_points = cylinder_path(amplitudes, np.arange(len(amplitudes)) * p.speed_angular/frame_rate)
+    path_points_cyl = g.cyl2cart_points(np.stack([np.full(nb_points, radius), phase[:nb_points], elevation[:nb_points]], axis=-1))
+    path_points_plane = np.stack([radius * phase[:nb_points], elevation[:nb_points], np.full(nb_points, p.R)], axis=-1)
 
     used_length = path_points_cyl[-1][-1] - p.start_pos - 2*p.end_margin
-    print(f"Path contains {i+1}/{len(amplitudes)} points ({round((i+1)/len(amplitudes)*100,3)} %) from the audio segment.")
+    print(f"Path contains {nb_points}/{len(amplitudes)} points ({round(nb_points/len(amplitudes)*100,3)} %) from the audio segment.")
     print(f"Engraving takes {round(used_length, 3)} mm, {round(used_length/(p.L - 2*p.end_margin)*100, 3)} % of the available space of the cylinder.")
 
-    builder3d.create_tip_path_wire(path_points_cyl, p.output_folder+p.output_filename+'_cyl.stp', "STEP")
-    builder3d.create_tip_path_wire(path_points_plane, p.output_folder+p.output_filename+'_plane.dxf', "DXF")
+    if p.wire_tolerance > 0:
+        # Half of the tolerance on the unrolled path, half on the chord of the segments across the curvature of the cylinder
+        keep = kernels.simplify_path(path_points_plane[:, 0], path_points_plane[:, 1], p.wire_tolerance/2, max_length=2*np.sqrt(radius*p.wire_tolerance))
+        path_points_cyl, path_points_plane = path_points_cyl[keep], path_points_plane[keep]
+        print(f"Wire simplified to {len(path_points_cyl)}/{nb_points} points (tolerance {p.wire_tolerance} mm).")
+
+    import builder3d
+    builder3d.create_tip_path_wire(path_points_cyl.tolist(), p.output_folder+p.output_filename+'_cyl.stp', "STEP")
+    builder3d.create_tip_path_wire(path_points_plane.tolist(), p.output_folder+p.output_filename+'_plane.dxf', "DXF")
 
 def check_intersection(pts: np.ndarray, frame_rate: float) -> int:
     """
@@ -369,20 +548,107 @@ def check_intersection(pts: np.ndarray, frame_rate: float) -> int:
     -------
     Number of detected intersections.
     """
-    intersections = 0
     pts_per_turn = 2 * np.pi * p.R / p.speed * frame_rate
     nb_turns = floor(pts[-1, 0] / (2 * np.pi))
+    if nb_turns < 2:
+        return 0
 
     # For each "angle", check if engraving points X coord. are strictly increasing with enough margin 
-    for i in range(int(pts_per_turn)):
-        curr_pts_elev = [pts[int(min(j*pts_per_turn+i, pts.shape[0]-1)) , 1] for j in range(nb_turns)]
-
-        # Check that the elevation is strictly increasing
-        for k in range(len(curr_pts_elev)-1):
-            if curr_pts_elev[k+1] - curr_pts_elev[k] <= p.width + p.intersection_margin:
-                intersections += 1
-                if intersections >= 1: 
-                    warnings.warn(f"Engraving path intersects itself at least at angle {round(np.rad2deg(pts[i, 0]) % 360, 2)}°, loop {k+1}&{k+2}. \t{curr_pts_elev}")
-                warnings.warn(f"Engraving path intersects itself at least at angle {round(np.rad2deg(pts[i, 0]) % 360, 2)}°, loop {k+1}&{k+2}. \t{curr_pts_elev}")
-                print(curr_pts_elev)
-    return intersections
\ No newline at end of file
+    angle_idx = np.arange(int(pts_per_turn))
+    idx = np.minimum(np.arange(nb_turns)[None, :]*pts_per_turn + angle_idx[:, None], pts.shape[0]-1).astype(np.int64)
+    pts_elev = pts[idx, 1]
+    too_close = np.diff(pts_elev, axis=1) <= p.width + p.intersection_margin
+    for i, k in zip(*np.nonzero(too_close)):
+        warnings.warn(f"Engraving path intersects itself at least at angle {round(np.rad2deg(pts[i, 0]) % 360, 2)}°, loop {k+1}&{k+2}. \t{pts_elev[i].tolist()}")
+    return int(np.count_nonzero(too_close))
+
+def intersection_hotspots(amplitudes: np.ndarray, frame_rate: float) -> np.ndarray:
+    """
+    Find the samples where the next turn of the engraving path comes too close.
+
+    The distance between consecutive turns is the pitch, plus the difference of the amplitudes
+    one turn apart. It must stay larger than the width of the cut plus the intersection margin.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    Boolean array, True for the samples whose distance to the next turn is too small.
+    """
+    pts_per_turn = 2 * np.pi / p.speed_angular * frame_rate
+    next_turn_amplitudes = g.value_at_turn(amplitudes, pts_per_turn, 1)
+    gap = p.pitch + (next_turn_amplitudes - amplitudes) * p.max_amplitude/2
+    return gap <= p.width + p.intersection_margin
+
+def truncate_path(beyond_surface: np.ndarray, message: str) -> int:
+    """
+    Count the points of a path before the first one beyond the engraving surface.
+
+    A warning is raised if the path is truncated.
+
+    Parameters
+    ----------
+    beyond_surface : np.ndarray
+        Boolean array, True for the points beyond the engraving surface.
+    message : str
+        Warning message.
+
+    Returns
+    -------
+    Number of points to keep.
+    """
+    if np.any(beyond_surface):
+        warnings.warn(message)
+        return int(np.argmax(beyond_surface))
+    return len(beyond_surface)
+
+def cylinder_path(amplitudes: np.ndarray, phase: np.ndarray) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Compute the helical path on a cylinder.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    phase : np.ndarray
+        Phase of each sample [rad], positive.
+
+    Returns
+    -------
+    Phase (negative for right threads) [rad], elevation [mm], and number of points before the end of the cylinder.
+    """
+    elevation = phase*p.pitch/(2*pi) + np.asarray(amplitudes, dtype=float)*p.max_amplitude/2 + p.end_margin + p.start_pos + p.offset_from_centerline
+    if p.right_thread: phase = -phase
+    nb_points = truncate_path(elevation > p.L - p.end_margin, "Engraving stopped by end of cylinder.")
+    return phase, elevation, nb_points
+
+def disc_path(amplitudes: np.ndarray, frame_rate: float) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Compute the spiral path on a disc, from the outside to the center, at constant angular or linear velocity (`disc_speed`).
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    Radius [mm], angle [rad], and number of points before the center of the disc.
+    """
+    R_max, R_min = p.R - p.end_margin - p.start_pos, p.end_margin
+    if p.disc_speed == 'linear':
+        # Constant linear velocity: each angle step depends on the radius of the previous point
+        teta = kernels.clv_spiral(len(amplitudes), R_max, R_max*p.pitch/(2*pi*(R_max - R_min)), p.speed/frame_rate)
+    else:
+        teta = np.concatenate([[0.0], np.cumsum(np.full(len(amplitudes)-1, 2 * asin(p.speed_angular/(2*frame_rate))))])
+    r = R_max * (1 - teta*p.pitch/(2*pi*(R_max - R_min))) + np.asarray(amplitudes, dtype=float)*p.max_amplitude/2 + p.offset_from_centerline
+    r[0] = R_max+p.offset_from_centerline+float(amplitudes[0])*p.max_amplitude/2
+    nb_points = 1 + truncate_path(r[1:] < R_min, "Engraving stopped by center of disc.")
+    return r, teta, nb_points
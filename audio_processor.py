@@ -1,10 +1,12 @@
-from pydub import AudioSegment
+from collections.abc import Iterable, Iterator
 import numpy as np
-import scipy.signal as signal
-import matplotlib.pyplot as plt
 import warnings
 
-def mp3_to_amplitude_series(mp3_file_path: str, channels: str='left', start_time: float = 0.0, duration: float = 1e9, target_volume: float = -18.0) -> tuple[np.ndarray, float, float, int]:
+import kernels
+
+# pydub, scipy and matplotlib are slow to import, so they are only imported by the functions using them
+
+def mp3_to_amplitude_series(mp3_file_path: str, channels: str='left', start_time: float = 0.0, duration: float = 1e9, target_volume: float = -18.0, dtype: type = np.float64) -> tuple[np.ndarray, float, float, int]:
     """
     Load an MP3 file and convert it to a numpy array of amplitude values.
     
@@ -13,8 +15,11 @@ def mp3_to_amplitude_series(mp3_file_path: str, channels: str='left', start_time
     :param start_time: How many seconds to crop from the start of the audio. Default is 0
     :param duration: Duration of the audio signal, in seconds. Default is 1e9
     :param target_volume: Target volume for the audio signal, in dBFS. Default is -18.0
+    :param dtype: Float type of the amplitudes. float32 represents the 16-bit samples exactly, with half the memory. Default is float64
     :return: A numpy array of amplitude values, the frame rate, sample width, and number of channels.
     """
+    from pydub import AudioSegment
+
     # Load the MP3 file
     audio = AudioSegment.from_mp3(mp3_file_path)
     audio = match_target_amplitude(audio, target_volume)
@@ -57,7 +62,7 @@ def mp3_to_amplitude_series(mp3_file_path: str, channels: str='left', start_time
         raise ValueError(f"Invalid channel '{channels}'. Choose from ['left', 'right', 'both']")
     
     # Normalize the audio data to voltage values (assuming 16-bit audio)
-    amplitude_series = audio_data / (2**(8 * sample_width - 1))
+    amplitude_series = audio_data.astype(dtype) / (2**(8 * sample_width - 1))
     
     return amplitude_series, frame_rate, sample_width, num_channels
 
@@ -68,15 +73,18 @@ def apply_low_pass_filter(amplitude_series: np.ndarray, frame_rate: float, cutof
     :param amplitude_series: A numpy array of audio amplitude values.
     :param frame_rate: The frame rate of the audio.
     :param cutoff_freq: The cutoff frequency of the low-pass filter.
-    :return: A numpy array of filtered audio amplitude values and the new frame rate.
+    :return: A numpy array of filtered audio amplitude values, with the float type of the input, and the new frame rate.
     """
+    import scipy.signal as signal
+
     # Design the low-pass filter
     nyquist_rate = frame_rate / 2.0
     normal_cutoff = cutoff_freq / nyquist_rate
     b, a = signal.butter(5, normal_cutoff, btype='low', analog=False)
     
-    # Apply the filter to the voltage series
-    filtered_amplitude_series = signal.filtfilt(b, a, amplitude_series)
+    # Apply the filter to the voltage series. It is computed in float64, and compact float32 inputs stay float32
+    # in the resampling and the following stages
+    filtered_amplitude_series = signal.filtfilt(b, a, amplitude_series).astype(amplitude_series.dtype, copy=False)
     # filtered_amplitude_series = signal.filtfilt(b_hp, a_hp, filtered_amplitude_series)
 
     if downsample:
@@ -89,8 +97,26 @@ def apply_low_pass_filter(amplitude_series: np.ndarray, frame_rate: float, cutof
 
     return filtered_amplitude_series, new_frame_rate
 
+def apply_limiter(amplitude_series: np.ndarray, frame_rate: float, threshold: float = 1.0, lookahead_time: float = 0.002, release_time: float = 0.050) -> np.ndarray:
+    """
+    Apply a look-ahead peak limiter to an audio signal.
+
+    The gain ramps down before each peak so that the amplitudes stay within ±threshold, then recovers.
+
+    :param amplitude_series: A numpy array of audio amplitude values.
+    :param frame_rate: The frame rate of the audio.
+    :param threshold: The largest amplitude after the limiter. Default is 1.0
+    :param lookahead_time: Time over which the gain ramps down before a peak, in seconds. Default is 0.002
+    :param release_time: Time over which the gain recovers after a peak, in seconds. Default is 0.050
+    :return: A numpy array of limited audio amplitude values, with the float type of the input.
+    """
+    gain = kernels.limiter_gain(amplitude_series, threshold, 1/(lookahead_time*frame_rate), 1/(release_time*frame_rate))
+    limited = np.count_nonzero(gain < 1)
+    if limited:
+        print(f"Limiter reduced the gain of {limited}/{len(gain)} samples (min gain {gain.min():.3f}).")
+    return (amplitude_series * gain).astype(amplitude_series.dtype, copy=False)
 
-def export_to_mp3(amplitude_series: np.ndarray, frame_rate: float, sample_width: float, num_channels: int, output_file_path: str) -> None:
+def export_to_mp3(amplitude_series: np.ndarray, frame_rate: float, sample_width: float, num_channels: int, output_file_path: str, format: str = "mp3") -> None:
     """
     Export an audio signal to an MP3 file.
 
@@ -99,7 +125,10 @@ def export_to_mp3(amplitude_series: np.ndarray, frame_rate: float, sample_width:
     :param sample_width: The sample width of the audio.
     :param num_channels: The number of channels in the audio.
     :param output_file_path: The path to save the output MP3 file.
+    :param format: The format of the output file. Default is 'mp3'. ['mp3', 'wav', ...]
     """
+    from pydub import AudioSegment
+
     # Denormalize the voltage series to integer values (assuming 16-bit audio)
     audio_data = np.array(amplitude_series * (2**(8 * sample_width - 1))).astype(np.int16)
     
@@ -116,7 +145,7 @@ def export_to_mp3(amplitude_series: np.ndarray, frame_rate: float, sample_width:
     )
     
     # Export the AudioSegment to an MP3 file
-    audio_segment.export(output_file_path, format="mp3")
+    audio_segment.export(output_file_path, format=format)
 
 def add_silent_start(amplitude_series: np.ndarray, frame_rate: float, duration: float) -> np.ndarray:
     """
@@ -129,10 +158,10 @@ def add_silent_start(amplitude_series: np.ndarray, frame_rate: float, duration:
     """
     # Calculate the number of samples to add
     num_samples = int(frame_rate * duration)
-    silent_start = np.zeros(num_samples)
+    silent_start = np.zeros(num_samples, dtype=amplitude_series.dtype)
     return np.concatenate([silent_start, amplitude_series])
 
-def match_target_amplitude(audio: AudioSegment, target_dBFS: float) -> AudioSegment:
+def match_target_amplitude(audio: 'AudioSegment', target_dBFS: float) -> 'AudioSegment':
     '''
     Match the target amplitude of the audio segment to the specified dBFS level.
 
@@ -152,6 +181,8 @@ def plot_amplitude_series(amplitude_series: np.ndarray, frame_rate: float, displ
     :param displacement_series: (Optional) A numpy array of displacement values to plot alongside the amplitude series.
     :return: None
     """
+    import matplotlib.pyplot as plt
+
     time = np.arange(len(amplitude_series)) / frame_rate
     plt.figure(figsize=(12, 6))
     if displacement_series is not None:
@@ -186,6 +217,8 @@ def acceleration_to_displacement(amplitudes: np.ndarray, frame_rate: float, filt
     :param cutoff_freq: Cutoff frequency for the high-pass filter [Hz]. Default is 5.0 Hz.
     :return: displacement normalized to [-1, 1].
     """
+    import scipy.signal as signal
+
     # Remove DC offset
     amplitudes = amplitudes - np.mean(amplitudes)
 
@@ -207,6 +240,116 @@ def acceleration_to_displacement(amplitudes: np.ndarray, frame_rate: float, filt
 
     return displacement
 
+# Time constants of the RIAA curve [s], and of the usual extra pole limiting the pre-emphasis at high frequencies
+RIAA_TIME_CONSTANTS = (3180e-6, 318e-6, 75e-6, 3.18e-6)
+EQ_REFERENCE_FREQ = 1000.0  # The equalization curves have a gain of 1 at this frequency [Hz]
+
+def equalization_response(freqs: np.ndarray, curve: str, corner_freq: float = 20.0, curve_points: np.ndarray = None) -> np.ndarray:
+    """
+    Complex gain of a recording curve, normalized to 1 at EQ_REFERENCE_FREQ.
+
+    :param freqs: Frequencies [Hz].
+    :param curve: 'displacement': the amplitudes are the air pressure, proportional to the acceleration of the stylus.
+        They are integrated twice, with a flat response below corner_freq so that the displacement does not drift.
+        'riaa': RIAA recording pre-emphasis, for velocity-sensitive playback.
+        'custom': zero-phase gain interpolated in log-frequency between curve_points.
+    :param corner_freq: Low-frequency corner of the displacement curve [Hz]. Default is 20.0
+    :param curve_points: Array of (frequency [Hz], gain [dB]) points of the custom curve, sorted by frequency.
+    :return: Complex gain at each frequency.
+    """
+    def response(f):
+        s = 2j*np.pi*np.asarray(f, dtype=float)
+        match curve:
+            case 'displacement':
+                wc = 2*np.pi*corner_freq
+                return 1 / (s + wc)**2
+            case 'riaa':
+                t1, t2, t3, t4 = RIAA_TIME_CONSTANTS
+                return (1 + s*t1) * (1 + s*t3) / ((1 + s*t2) * (1 + s*t4))
+            case 'custom':
+                log_f = np.log10(np.maximum(np.abs(f), curve_points[0, 0]))
+                return (10 ** (np.interp(log_f, np.log10(curve_points[:, 0]), curve_points[:, 1]) / 20)).astype(complex)
+        raise ValueError(f"Invalid equalization curve '{curve}'. Choose from ['displacement', 'riaa', 'custom']")
+    return response(freqs) / np.abs(response(EQ_REFERENCE_FREQ))
+
+def equalization_fir(frame_rate: float, curve: str, corner_freq: float = 20.0, curve_points: np.ndarray = None) -> tuple[np.ndarray, int]:
+    """
+    FIR filter of a recording curve, designed by frequency sampling.
+
+    The impulse response is centered in the filter, with a delay of half its length, so that the parts of the
+    response wrapped around by the frequency sampling are kept. The length covers 12 times the longest time
+    constant of the curve on each side of the center, so that the truncation of the response is negligible.
+
+    :param frame_rate: The frame rate of the audio.
+    :return: The coefficients of the filter and its delay in samples.
+    """
+    match curve:
+        case 'displacement':
+            time_constant = 1 / (2*np.pi*corner_freq)
+        case 'riaa':
+            time_constant = RIAA_TIME_CONSTANTS[0]
+        case _:
+            time_constant = 1 / (2*np.pi*curve_points[0, 0])
+    length = max(256, 1 << int(np.ceil(np.log2(24 * time_constant * frame_rate))))
+    response = equalization_response(np.fft.rfftfreq(length, 1/frame_rate), curve, corner_freq, curve_points)
+    fir = np.roll(np.fft.irfft(response, length), length//2) * np.hanning(length)
+    return fir, length//2
+
+def overlap_add_blocks(blocks: Iterable[np.ndarray], fir: np.ndarray, block_size: int) -> Iterator[np.ndarray]:
+    """
+    Convolve a stream of audio blocks with a FIR filter, by FFT overlap-add.
+
+    The memory is bounded by the block size and the filter length, and the time is O(n log(block_size)).
+
+    :param blocks: Blocks of audio amplitude values, of at most block_size samples.
+    :param fir: The coefficients of the filter.
+    :param block_size: Largest size of a block.
+    :return: Blocks of the convolution, with the same sizes as the input blocks, then its last len(fir) - 1 samples.
+    """
+    nfft = 1 << int(np.ceil(np.log2(block_size + len(fir) - 1)))
+    fir_spectrum = np.fft.rfft(fir, nfft)
+    tail = np.zeros(len(fir) - 1)
+    for block in blocks:
+        convolved = np.fft.irfft(np.fft.rfft(block, nfft) * fir_spectrum, nfft)[:len(block) + len(fir) - 1]
+        convolved[:len(tail)] += tail
+        yield convolved[:len(block)]
+        tail = convolved[len(block):]    # Overlaps the next blocks
+    yield tail
+
+def apply_equalization(amplitude_series: np.ndarray, frame_rate: float, curve: str, corner_freq: float = 20.0, curve_file: str = None,
+                       normalize: bool = True) -> np.ndarray:
+    """
+    Apply a recording curve to an audio signal, with a block-based overlap-add FFT filter.
+
+    :param amplitude_series: A numpy array of audio amplitude values.
+    :param frame_rate: The frame rate of the audio.
+    :param curve: Equalization curve, see `equalization_response`. ['displacement', 'riaa', 'custom']
+    :param corner_freq: Low-frequency corner of the displacement curve [Hz]. Default is 20.0
+    :param curve_file: CSV file of (frequency [Hz], gain [dB]) points, for the custom curve.
+    :param normalize: Scale the output to the peak amplitude of the input. Default is True
+    :return: A numpy array of equalized audio amplitude values, with the float type of the input.
+    """
+    curve_points = np.loadtxt(curve_file, delimiter=',', ndmin=2) if curve == 'custom' else None
+    fir, delay = equalization_fir(frame_rate, curve, corner_freq, curve_points)
+    block_size = 4 * len(fir)
+
+    # The convolution is delayed by the FIR delay, the first samples are dropped and the tail is cut
+    equalized = np.empty(len(amplitude_series), dtype=amplitude_series.dtype)
+    blocks = (amplitude_series[i:i+block_size] for i in range(0, len(amplitude_series), block_size))
+    position = -delay
+    for block in overlap_add_blocks(blocks, fir, block_size):
+        start, end = max(position, 0), min(position + len(block), len(equalized))
+        if end > start:
+            equalized[start:end] = block[start - position:end - position]
+        position += len(block)
+
+    if normalize and len(equalized):
+        peak_in, peak_out = np.max(np.abs(amplitude_series)), np.max(np.abs(equalized))
+        if peak_out > 0:
+            equalized *= peak_in / peak_out
+    print(f"Equalization '{curve}' applied with a FIR of {len(fir)} samples.")
+    return equalized
+
 
 # Example usage
 if __name__ == "__main__":
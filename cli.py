@@ -0,0 +1,208 @@
+"""
+Command-line entry point.
+
+Usage examples:
+    python cli.py gcode --input_filename french.mp3 --pitch 0.4
+    python cli.py image --params ./3d_files/25_100_500_squeezie_path_parameters.txt --pixel_size 0.02
+    python cli.py batch job1_parameters.txt job2_parameters.txt --plot none
+    python cli.py simulate --stylus_radius 0.015
+    python cli.py verify --params ./3d_files/50_100_500_DJSaphir2_path_parameters.txt
+    python cli.py split --duration 600 --split_workers 4
+    python cli.py restart --pass 2 --turn 14 --at_angle -120.5 --params ./3d_files/50_100_500_DJSaphir2_path_parameters.txt
+
+Every ParameterSet field can be overridden with --<field> <value>. Heavy backends (PIL, cadquery, matplotlib,
+pydub, scipy) are only imported when the selected output type or stage needs them.
+"""
+import argparse
+import os
+from typing import Literal, get_args, get_origin
+import attrs
+
+from parameters import ParameterSet, default_parameters as p
+
+
+OUTPUT_TYPES = ('gcode', 'points', 'image', 'wire', 'mesh')
+
+
+def parse_bool(value: str) -> bool:
+    """
+    Convert a command-line value to a boolean.
+    """
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise argparse.ArgumentTypeError(f"Invalid boolean value '{value}'.")
+
+def add_parameter_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add one optional argument per initialized field of ParameterSet.
+    """
+    group = parser.add_argument_group("parameters", "Override the parameters of parameters.py (or of --params).")
+    group.add_argument('--params', default=argparse.SUPPRESS, metavar='FILE', help="Parameters file exported by a previous run (*_parameters.txt).")
+    for field in attrs.fields(ParameterSet):
+        if not field.init:
+            continue
+        if get_origin(field.type) is Literal:
+            group.add_argument(f'--{field.name}', choices=get_args(field.type), default=argparse.SUPPRESS)
+        elif field.type is bool:
+            group.add_argument(f'--{field.name}', type=parse_bool, default=argparse.SUPPRESS, metavar='{true,false}')
+        else:
+            group.add_argument(f'--{field.name}', type=field.type, default=argparse.SUPPRESS, metavar=field.type.__name__.upper())
+
+def apply_parameters(args: argparse.Namespace, params_file: str = None) -> None:
+    """
+    Update the shared parameters from a parameters file and from the command-line overrides.
+
+    :param args: Parsed command-line arguments.
+    :param params_file: Parameters file to load before the overrides. Default is args.params.
+    """
+    params_file = params_file or getattr(args, 'params', None)
+    if params_file is not None:
+        # A missing or invalid file stops the run instead of engraving the default parameters
+        if not os.path.isfile(params_file):
+            raise SystemExit(f"Parameters file '{params_file}' not found.")
+        try:
+            loaded = ParameterSet.load_txt(params_file)
+        except (OSError, ValueError, TypeError) as e:
+            raise SystemExit(f"Invalid parameters file '{params_file}': {e}")
+        print(f"Parameters loaded from {params_file}")
+        p.update(**{f.name: getattr(loaded, f.name) for f in attrs.fields(ParameterSet) if f.init})
+
+    overrides = {f.name: getattr(args, f.name) for f in attrs.fields(ParameterSet) if f.init and hasattr(args, f.name)}
+    if args.command in OUTPUT_TYPES:
+        overrides['ENGRAVING_OUTPUT_TYPE'] = args.command
+    p.update(**overrides)
+
+def run() -> None:
+    """
+    Create the engraving file selected by the shared parameters.
+    """
+    import pipeline
+
+    # Extract amplitudes from audio
+    amplitudes, frame_rate, key = pipeline.audio_stage()
+    match p.plot:
+        case 'interactive':
+            import audio_processor as ap
+            ap.plot_amplitude_series(amplitudes, frame_rate)
+        case 'png':
+            import preview
+            import amp2engraving as a2e
+            hotspots = a2e.intersection_hotspots(amplitudes, frame_rate)
+            preview.render_preview_png(amplitudes, frame_rate, p.output_folder+p.output_filename+"_preview.png", hotspots)
+
+    amplitudes, key = pipeline.silent_start_stage(amplitudes, frame_rate, key)
+
+    # Convert amplitudes to engraving file, only recomputing the stages whose parameters changed
+    pipeline.engraving_stage(amplitudes, frame_rate, key)
+
+    # Export parameters to a text file, and archive it with the output files
+    p.export_parameters_to_txt()
+    import exporter
+    exporter.archive_file(p.output_folder+p.output_filename+"_parameters.txt")
+
+def run_split() -> None:
+    """
+    Split the audio on as many surfaces as needed and create the engraving file of each part in parallel.
+    """
+    import pipeline
+    import splitter
+
+    amplitudes, frame_rate, key = pipeline.audio_stage()
+    splitter.split_and_engrave(amplitudes, frame_rate, key)
+    p.export_parameters_to_txt()
+
+def run_simulation() -> None:
+    """
+    Simulate the engraving selected by the shared parameters and export the audio read by a virtual stylus.
+    """
+    import pipeline
+    import simulator
+
+    simulator.check_parameters()
+    amplitudes, frame_rate, key = pipeline.audio_stage()
+    amplitudes, key = pipeline.silent_start_stage(amplitudes, frame_rate, key)
+    simulator.simulate_to_audio(amplitudes, frame_rate, p.output_folder+p.output_filename+"_simulated.wav")
+
+def run_verification() -> None:
+    """
+    Check the G-code files of the shared parameters against the expected toolpath and render a back-plot.
+
+    Exits with status 1 if the G-code has errors.
+    """
+    import pipeline
+    import verifier
+
+    verifier.check_parameters()
+    amplitudes, frame_rate, key = pipeline.audio_stage()
+    amplitudes, key = pipeline.silent_start_stage(amplitudes, frame_rate, key)
+    check = verifier.verify_gcode(expected=verifier.expected_gcode_path(amplitudes, frame_rate),
+                                  backplot_filename=p.output_folder+p.output_filename+"_backplot.png")
+    if not check.ok:
+        raise SystemExit(1)
+
+def run_restart(args: argparse.Namespace) -> None:
+    """
+    Write a G-code program restarting the engraving at the position given on the command line.
+    """
+    import restart
+
+    index, _ = restart.load_gcode_index(restart.index_filename())
+    if args.file_number is not None:
+        entry = restart.restart_entry_at_line(index, args.file_number, args.line)
+    else:
+        entry = restart.restart_entry(index, args.pass_number, args.turn, args.at_angle)
+    restart.export_restart_gcode(entry)
+
+def main(argv: list[str] = None) -> None:
+    """
+    Parse the command line and run the pipeline.
+
+    Without command, the output type of the parameters is used.
+    """
+    parser = argparse.ArgumentParser(prog="engraver", description="Create engraving files from audio files.")
+    subparsers = parser.add_subparsers(dest='command')
+    for output_type in OUTPUT_TYPES:
+        add_parameter_arguments(subparsers.add_parser(output_type, help=f"Create the {output_type} engraving file."))
+    add_parameter_arguments(subparsers.add_parser('simulate', help="Simulate the groove and export the audio read by a virtual stylus."))
+    add_parameter_arguments(subparsers.add_parser('split', help="Split a long audio on several cylinders or discs and create the files of each part."))
+    add_parameter_arguments(subparsers.add_parser('verify', help="Check the G-code files and render a back-plot of their toolpath."))
+    restart_parser = subparsers.add_parser('restart', help="Write a G-code program restarting the engraving from a pass, turn and angle, or from a line of a file.")
+    position = restart_parser.add_argument_group("restart position", "Position of the restart, rounded down to the previous entry of the restart index.")
+    position.add_argument('--pass', dest='pass_number', type=int, default=1, help="Pass, from 1.")
+    position.add_argument('--turn', type=int, default=1, help="Turn of the pass, from 1.")
+    position.add_argument('--at_angle', type=float, default=None, help="A of the position [°]. Default is the start of the turn.")
+    position.add_argument('--file_number', type=int, default=None, help="G-code file, from 1. Replaces the pass, turn and angle.")
+    position.add_argument('--line', type=int, default=1, help="Line of the G-code file, from 1.")
+    add_parameter_arguments(restart_parser)
+    batch_parser = subparsers.add_parser('batch', help="Run the pipeline for each parameters file, with its own output type.")
+    batch_parser.add_argument('params_files', nargs='+', metavar='FILE', help="Parameters files (*_parameters.txt).")
+    add_parameter_arguments(batch_parser)
+    add_parameter_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.command == 'batch':
+        for params_file in args.params_files:
+            print("-"*10 + f" {params_file} " + "-"*10)
+            apply_parameters(args, params_file)
+            run()
+    elif args.command == 'simulate':
+        apply_parameters(args)
+        run_simulation()
+    elif args.command == 'split':
+        apply_parameters(args)
+        run_split()
+    elif args.command == 'restart':
+        apply_parameters(args)
+        run_restart(args)
+    elif args.command == 'verify':
+        apply_parameters(args)
+        run_verification()
+    else:
+        apply_parameters(args)
+        run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,13 @@
-from math import floor, pi
+import gzip
+import json
+import lzma
+import numpy as np
 import os
+import queue
+import shutil
+import threading
 import warnings
+import attrs
 # from OCC.Core.STEPControl import STEPControl_Writer, STEPControl_AsIs
 # from OCC.Core.IFSelect import IFSelect_RetDone
 # from OCC.Core.TopoDS import TopoDS_Shape
@@ -9,6 +16,132 @@ from parameters import default_parameters as p
 import geometry as g
 
 
+# Maximal number of files waiting for the writer thread
+WRITER_QUEUE_SIZE = 2
+ARCHIVE_EXTENSIONS = {'gzip': '.gz', 'xz': '.xz', 'zstd': '.zst'}
+
+
+def write_file(filename: str, data) -> None:
+    """
+    Write a file atomically: to a temporary file, then renamed.
+
+    :param filename: The file to write.
+    :param data: Text, bytes, or function writing the content to a binary file object.
+    """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w' if isinstance(data, str) else 'wb') as f:
+        if callable(data):
+            data(f)
+        else:
+            f.write(data)
+    os.replace(tmp_filename, filename)
+
+def open_compressed(filename: str, compression: str):
+    """
+    Open a file for writing through a gzip, xz or zstd compressor.
+    """
+    match compression:
+        case 'gzip':
+            return gzip.open(filename, 'wb')
+        case 'xz':
+            return lzma.open(filename, 'wb')
+        case 'zstd':
+            # zstandard is an optional dependency, only needed for zstd archives
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("archive_compression = 'zstd' requires the zstandard package (pip install zstandard).")
+            return zstandard.ZstdCompressor(threads=-1).stream_writer(open(filename, 'wb'), closefd=True)
+    raise ValueError(f"Unknown archive compression: {compression}. Please choose 'none', 'gzip', 'xz' or 'zstd'.")
+
+def archive_file(filename: str, compression: str = None) -> str:
+    """
+    Write a compressed copy of a file to the archive folder.
+
+    The path relative to the output folder is kept, e.g. ./3d_files/x_files/x_001.csv is archived
+    as ./archive/x_files/x_001.csv.gz.
+
+    :param filename: The file to archive.
+    :param compression: 'none', 'gzip', 'xz' or 'zstd'. Default is `archive_compression`.
+    :return: The archived filename, or None if compression is 'none'.
+    """
+    compression = p.archive_compression if compression is None else compression
+    if compression == 'none':
+        return None
+    relative = os.path.relpath(filename, p.output_folder)
+    if relative.startswith('..'):
+        relative = os.path.basename(filename)
+    archive_filename = os.path.join(p.archive_folder, relative) + ARCHIVE_EXTENSIONS.get(compression, '')
+    os.makedirs(os.path.dirname(archive_filename), exist_ok=True)
+    with open(filename, 'rb') as src, open_compressed(archive_filename + ".tmp", compression) as dst:
+        shutil.copyfileobj(src, dst, 16*1024*1024)
+    os.replace(archive_filename + ".tmp", archive_filename)
+    return archive_filename
+
+class BackgroundWriter:
+    """
+    Write files in a background thread.
+
+    Files are handed to the thread through a bounded queue, so that the formatting of the next file overlaps
+    with the writing of the previous one, with at most `queue_size` files waiting in memory. Files are written
+    atomically and, if `archive_compression` is set, a compressed copy is written to `archive_folder`.
+    An error of the thread is raised by the next `write`, or by `close`.
+
+    Usage:
+        with BackgroundWriter() as writer:
+            for filename, text in ...:
+                writer.write(filename, text)
+    """
+    def __init__(self, queue_size: int = WRITER_QUEUE_SIZE, compression: str = None):
+        self.compression = p.archive_compression if compression is None else compression
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="BackgroundWriter", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while (item := self.queue.get()) is not None:
+            # After an error, the remaining files are dropped so that the producer is never blocked
+            if self.error is None:
+                filename, data = item
+                try:
+                    write_file(filename, data)
+                    archive_file(filename, self.compression)
+                except BaseException as e:
+                    self.error = e
+
+    def write(self, filename: str, data) -> None:
+        """
+        Hand a file to the writer thread. Blocks while the queue is full.
+
+        :param filename: The file to write.
+        :param data: Text, bytes, or function writing the content to a binary file object.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((filename, data))
+
+    def close(self) -> None:
+        """
+        Wait until all files are written.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original exception
+            self.queue.put(None)
+            self.thread.join()
+
+
 def export_path_to_csv(path: list[tuple[float, float, float]], filename: str, split_files: bool=True, files_per_turn: float = 4, cyl_coord: bool=True) -> None:
     """
     Export a path as one or multiple CSV files in cartesian coordinates.
@@ -30,58 +163,220 @@ def export_path_to_csv(path: list[tuple[float, float, float]], filename: str, sp
         # for f in files:
         #     os.remove(f)
 
-        # Split the path into each loop
-        start = 0
-        loops = []
-        nb_loops = floor(abs(path[-1][1] / (2*pi/files_per_turn)))
-        for i in range(nb_loops):
-            end = next((index for index, point in enumerate(path) if abs(point[1]) >= (i+1)*2*pi/files_per_turn), len(path))
-            loops.append(path[start:end])
-            start = end - 2 # -2 so that the next loop has 2 points in common with the previous one
-
-        for i, loop in enumerate(loops):
-            # Format i as string with three numbers
-            loop_filename = f"{folder}/{filename}_{i :03d}.csv"
-            export_path_to_csv(loop, loop_filename, False)
+        # Split the path into each loop, so that the next loop has 2 points in common with the previous one
+        path = np.asarray(path, dtype=float)
+        ends = g.turn_boundaries(path[:, 1], files_per_turn)
+        starts = np.concatenate([[0], ends[:-1] - 2])
+        with BackgroundWriter() as writer:
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                # Format i as string with three numbers
+                loop_filename = f"{folder}/{filename}_{i :03d}.csv"
+                writer.write(loop_filename, path_to_csv_text(path[start:end], cyl_coord))
         print(f"CSV files created successfully in folder '{folder}'.")
     else:
-        filename += '.csv'
-        with open(filename, "w") as file:
-            for point in path:
-                if cyl_coord: x, y, z = g.cyl2cart(*point)
-                else: x, y, z = point
-                file.write(f"{x/1000}, {y/1000}, {z/1000}\n")
+        with BackgroundWriter() as writer:
+            writer.write(filename + '.csv', path_to_csv_text(path, cyl_coord))
         # print(f"CSV file '{filename}' created successfully.")
 
-def export_text_to_gcode(text: str, x0: float, a0: float) -> None:
+def path_to_csv_text(path: np.ndarray, cyl_coord: bool=True) -> str:
+    """
+    Format a path as CSV lines of cartesian coordinates in meters.
+
+    :param path: The path, in cylindrical [r, φ, z] or cartesian [x, y, z] coordinates [mm].
+    :param cyl_coord: True if the path is in cylindrical coordinates.
+    """
+    path = np.asarray(path, dtype=float).reshape(-1, 3)
+    if cyl_coord: path = g.cyl2cart_points(path)
+    return "".join(f"{x}, {y}, {z}\n" for x, y, z in (path/1000).tolist())
+
+def export_path_to_npz(path: np.ndarray, filename: str, split_files: bool=True, files_per_turn: float = 4, cyl_coord: bool=True) -> str:
+    """
+    Export a path as a binary file, in cartesian coordinates.
+
+    The .npz file contains:
+    - points: float32 array of shape (N, 3), cartesian coordinates in mm,
+    - chunk_starts, chunk_ends: index range of each chunk (loop) of the path, with 2 points in common between chunks,
+    - header: JSON string with the format, units, frame and the parameters that generated the path.
+    It is about 5 times smaller than the CSV files and is loaded at once with `load_path_from_npz` or numpy.load.
+
+    :param path: The path to export, in cylindrical [r, φ, z] or unrolled [x, y, z] coordinates [mm].
+    :param filename: Filename for the npz file. Can include .npz or not.
+    :param split_files: If True, the path is split into chunks of 1/files_per_turn turn. If False, the path is a single chunk.
+    :param files_per_turn: Number of chunks per turn.
+    :param cyl_coord: True if the path is in cylindrical coordinates, False if it is unrolled on a plane.
+    :return: The exported filename.
+    """
+    if filename.endswith(".npz") or filename.endswith(".csv"):
+        filename = filename[:-4]
+    filename += ".npz"
+
+    path = np.asarray(path, dtype=float).reshape(-1, 3)
+    if split_files and len(path):
+        # Unrolled paths are split by their angle as well, at the radius of the engraving tip
+        phase = path[:, 1] if cyl_coord else path[:, 0] / (p.R - p.depth)
+        chunk_ends = np.append(g.turn_boundaries(phase, files_per_turn), len(path))
+        chunk_ends = chunk_ends[np.append(np.diff(chunk_ends) > 0, True)]
+        chunk_starts = np.concatenate([[0], np.maximum(chunk_ends[:-1] - 2, 0)])
+    else:
+        chunk_starts, chunk_ends = np.array([0]), np.array([len(path)])
+
+    header = {
+        'format': 'engraver-path',
+        'version': 1,
+        'units': 'mm',
+        'frame': 'cartesian',
+        'source_frame': 'cylindrical' if cyl_coord else 'plane',
+        'surface': p.SURFACE_TYPE,
+        'parameters': attrs.asdict(p),
+    }
+    points = g.cyl2cart_points(path) if cyl_coord else path
+    arrays = {'points': points.astype(np.float32), 'chunk_starts': chunk_starts.astype(np.int64),
+              'chunk_ends': chunk_ends.astype(np.int64), 'header': np.array(json.dumps(header))}
+    with BackgroundWriter() as writer:
+        writer.write(filename, lambda f: np.savez(f, **arrays))
+    print(f"Path of {len(points)} points in {len(chunk_starts)} chunks exported to {filename}")
+    return filename
+
+def load_path_from_npz(filename: str) -> tuple[list[np.ndarray], dict]:
+    """
+    Load a path exported by `export_path_to_npz`.
+
+    :param filename: The npz file.
+    :return: The points of each chunk (cartesian coordinates [mm]) and the header.
+    """
+    with np.load(filename) as data:
+        header = json.loads(str(data['header']))
+        points = data['points'].astype(float)
+        chunks = [points[start:end] for start, end in zip(data['chunk_starts'], data['chunk_ends'])]
+    return chunks, header
+
+def export_image_to_tiff(image: np.ndarray, filename: str) -> None:
+    """
+    Export a depth map as an uncompressed TIFF image, with the pixel size as resolution.
+
+    :param image: Grayscale image.
+    :param filename: Filename for the TIFF file.
+    """
+    # PIL is slow to import, so it is only imported when exporting images
+    from PIL import Image
+
+    with BackgroundWriter() as writer:
+        writer.write(filename, lambda f: Image.fromarray(image).save(f,
+                                format="TIFF",
+                                quality=100, 
+                                compression=None, 
+                                dpi=(25.4/p.pixel_size, 25.4/p.pixel_size),
+                                artist="Vincent Philippoz",
+                                description=f"Plan de gravure pour un cylindre de {p.L} mm de long et {p.R*2} mm de diametre.",
+                                copyright="Hublot SA",
+                                software="Python 3",
+                                ))
+
+def export_text_to_gcode(text: str, headers: list[str]) -> list[str]:
     """
     Export the given text to a G-code file.
 
-    INITIAL_GCODE and FINAL_GCODE are included in the exported file. 
+    The header of each file and FINAL_GCODE are included in the exported file. 
     If the file size exceeds the maximum limit, it is split into multiple files.
 
     Parameters
     ----------
     text : str
         The text to export.
+    headers : list[str]
+        INITIAL_GCODE of each file, from `amp2engraving.gcode_chunk_headers`.
+
+    Returns
+    -------
+    List of the exported filenames.
+    """
+    filenames = []
+    with BackgroundWriter() as writer:
+        for file_num, (start, end) in enumerate(gcode_chunk_bounds(text)):
+            # Export chunk to G-code file, while the next chunk is prepared
+            filename = gcode_filename(file_num+1)
+            chunk = headers[file_num] + text[start:end] + p.FINAL_GCODE
+            writer.write(filename, chunk)
+            filenames.append(filename)
+            print(f"G-code exported to {filename}")
+    return filenames
+
+def gcode_chunk_bounds(text: str) -> list[tuple[int, int]]:
+    """
+    Split the G-code text into chunks of at most `max_text_size` characters, cut at the end of a line.
+
+    :return: Start and end index of each chunk in the text. Each chunk but the first starts with a newline.
     """
-    # Split the text into chunks if it exceeds the maximum size
+    bounds = []
     prev_newline_idx = 0
-    for file_num, idx in enumerate(range(0, len(text), p.max_text_size)):
+    for idx in range(0, len(text), p.max_text_size):
         # Cut the text at the end of a line
-        newline_idx = text.rfind('\n', idx, idx+p.max_text_size)
+        newline_idx = text.rfind('\n', idx, idx+p.max_text_size) if idx+p.max_text_size < len(text) else len(text)
         if newline_idx == -1: 
             warnings.warn("No newline found, splitting at max size.")
             newline_idx = idx+p.max_text_size
-        chunk = text[prev_newline_idx:newline_idx]
+        bounds.append((prev_newline_idx, newline_idx))
         prev_newline_idx = newline_idx
+    return bounds
+
+def gcode_filename(file_number: int) -> str:
+    """
+    Name of a G-code file of the engraving, numbered from 1.
+    """
+    return p.output_folder+p.output_filename+f"_{file_number}."+p.file_format
+
+def rewrite_gcode_headers(filenames: list[str], headers: list[str], index_filename: str = None) -> None:
+    """
+    Rewrite the header of existing G-code files without regenerating their content.
+
+    The INITIAL_GCODE block is replaced, as well as the spindle speed and feed rate of the depth change
+    sequences (side approach of a cylinder or plunge into a disc). It is used when only tool, spindle or feed parameters changed.
+    The byte offsets of the restart index are updated, as the length of the rewritten lines may change.
+
+    Parameters
+    ----------
+    filenames : list[str]
+        G-code files written by `export_text_to_gcode`, in order.
+    headers : list[str]
+        INITIAL_GCODE of each file, from `amp2engraving.gcode_chunk_headers`.
+    index_filename : str
+        Restart index of the files (see restart.py). Default is no index.
+    """
+    header_nb_lines = p.INITIAL_GCODE().count('\n') + 1
+    spindle_line = f"M13S{round(p.spindle_speed, 0)}\n"
+    feed_line = f"G1Y0.F{round(p.feed_rate,3)}\n"
+    plunge_feed = f"F{round(p.feed_rate,3)}\n"
+    # Restart index: entries and the step they were sampled with
+    index_data = dict(np.load(index_filename)) if index_filename and os.path.exists(index_filename) else None
+    index = index_data['entries'] if index_data is not None else None
+    newline_size = len(os.linesep)
 
-        # Export chunk to G-code file
-        filename = p.output_folder+p.output_filename+f"_{file_num+1}."+p.file_format
-        chunk = p.INITIAL_GCODE(str(x0), str(a0), str(file_num+1)) + chunk + p.FINAL_GCODE
-        with open(filename, 'w') as f:
-            f.write(chunk)
-        print(f"G-code exported to {filename}")
+    for file_num, filename in enumerate(filenames):
+        # Index entries of the file, by line number
+        in_file = [] if index is None else np.flatnonzero(index['file'] == file_num+1)
+        indexed_lines = {int(index['line'][i]): i for i in in_file}
+        tmp_filename = filename + ".tmp"
+        with open(filename, 'r') as src, open(tmp_filename, 'w') as dst:
+            header = headers[file_num] + "\n"
+            dst.write(header)
+            offset, line_number = len(header.encode()) + (newline_size-1)*header.count('\n'), header.count('\n')
+            for _ in range(header_nb_lines):
+                src.readline()
+            for line in src:
+                if line.startswith("M13S"): line = spindle_line
+                elif line.startswith("G1Y0.F"): line = feed_line
+                elif line.startswith("G1Z"): line = line[:line.index("F")] + plunge_feed    # Disc plunge, at the depth of the pass
+                line_number += 1
+                if line_number in indexed_lines:
+                    # The index points to the newline before the block
+                    index['offset'][indexed_lines[line_number]] = offset - newline_size
+                dst.write(line)
+                offset += len(line.encode()) + (newline_size-1)*line.endswith('\n')
+        os.replace(tmp_filename, filename)
+        archive_file(filename)
+        print(f"G-code header rewritten in {filename}")
+    if index is not None:
+        write_file(index_filename, lambda f: np.savez(f, **index_data))
 
 # def export_shape_to_step(shape: TopoDS_Shape, filename: str) -> None:
 #     """
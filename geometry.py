@@ -1,26 +1,161 @@
-from math import sqrt, atan2, cos, sin
+import attrs
+import numpy as np
+
+# All functions accept scalars or numpy arrays, and broadcast like numpy operations.
+# Arrays of points have shape (N, 3), in cartesian [x, y, z], cylindrical [r, φ, z] or unrolled [x, y, z] coordinates.
 
 def cart2cyl(x: float, y: float, z: float) -> tuple[float, float, float]:
-    r = sqrt(x**2 + y**2)
-    φ = atan2(y, x)
+    r = np.hypot(x, y)
+    φ = np.arctan2(y, x)
     return (r, φ, z)
 
 def cyl2cart(r: float, φ: float, z: float) -> tuple[float, float, float]:
-    x = r * cos(φ)
-    y = r * sin(φ)
+    x = r * np.cos(φ)
+    y = r * np.sin(φ)
     return (x, y, z)
 
+def cart2cyl_points(points: np.ndarray) -> np.ndarray:
+    points = np.asarray(points, dtype=float)
+    return np.stack(np.broadcast_arrays(*cart2cyl(points[..., 0], points[..., 1], points[..., 2])), axis=-1)
+
+def cyl2cart_points(points: np.ndarray) -> np.ndarray:
+    points = np.asarray(points, dtype=float)
+    return np.stack(np.broadcast_arrays(*cyl2cart(points[..., 0], points[..., 1], points[..., 2])), axis=-1)
+
 def midpoint(a: tuple[float, float, float], b: tuple[float, float, float]) -> tuple[float, float, float]:
-    pt = [(a[i] + b[i]) / 2 for i in range(min(len(a), len(b)))]
-    return pt
+    n = min(np.shape(a)[-1], np.shape(b)[-1])
+    return (np.asarray(a, dtype=float)[..., :n] + np.asarray(b, dtype=float)[..., :n]) / 2
 
 def distance_cart(a: tuple[float, float, float], b: tuple[float, float, float]) -> float:
-    dist = 0
-    for i in range(len(a)):
-        dist += (a[i] - b[i])**2
-    return sqrt(dist)
+    return np.sqrt(np.sum((np.asarray(a, dtype=float) - np.asarray(b, dtype=float))**2, axis=-1))
 
 def distance_cyl(a: tuple[float, float, float], b: tuple[float, float, float]) -> float:
-    a = cyl2cart(*a)
-    b = cyl2cart(*b)
-    return distance_cart(a, b)
\ No newline at end of file
+    return distance_cart(cyl2cart_points(a), cyl2cart_points(b))
+
+def segment_lengths_cyl(r: np.ndarray, φ: np.ndarray, z: np.ndarray) -> np.ndarray:
+    """
+    Length of the straight segments between consecutive points given in cylindrical coordinates.
+    """
+    r, φ, z = np.broadcast_arrays(r, φ, z)
+    chord2 = r[:-1]**2 + r[1:]**2 - 2*r[:-1]*r[1:]*np.cos(np.diff(φ)) + np.diff(z)**2
+    return np.sqrt(np.maximum(chord2, 0))
+
+def cumulative_length_cyl(r: np.ndarray, φ: np.ndarray, z: np.ndarray) -> np.ndarray:
+    """
+    Length along a path given in cylindrical coordinates (helix on a cylinder, spiral on a disc), starting at 0.
+    """
+    return np.concatenate([[0.0], np.cumsum(segment_lengths_cyl(r, φ, z))])
+
+def unroll_cylinder(points_cyl: np.ndarray, radius: float) -> np.ndarray:
+    """
+    Unroll points from cylindrical coordinates to the plane tangent to a cylinder of given radius.
+
+    The angle is developed along x at the given radius, the elevation is y, and z is the radius.
+    """
+    points_cyl = np.asarray(points_cyl, dtype=float)
+    return np.stack(np.broadcast_arrays(radius * points_cyl[..., 1], points_cyl[..., 2], radius), axis=-1)
+
+def wrap_plane(points_plane: np.ndarray, radius: float) -> np.ndarray:
+    """
+    Wrap points of the unrolled plane back to cylindrical coordinates. Inverse of `unroll_cylinder`.
+    """
+    points_plane = np.asarray(points_plane, dtype=float)
+    return np.stack(np.broadcast_arrays(points_plane[..., 2], points_plane[..., 0] / radius, points_plane[..., 1]), axis=-1)
+
+def turn_boundaries(φ: np.ndarray, parts_per_turn: float = 1) -> np.ndarray:
+    """
+    Index of the first point of each part of turn, for a path whose absolute angle is increasing.
+
+    Part i ends at the first point whose absolute angle is at least (i+1) * 2π / parts_per_turn.
+    Only complete parts are returned.
+    """
+    abs_φ = np.abs(φ)
+    nb_parts = int(np.floor(abs_φ[-1] / (2*np.pi/parts_per_turn)))
+    return np.searchsorted(abs_φ, np.arange(1, nb_parts+1)*2*np.pi/parts_per_turn, side='left')
+
+def value_at_turn(series: np.ndarray, pts_per_turn: float, turns: float = 1) -> np.ndarray:
+    """
+    Value of a series sampled along a path, at the same angle a number of turns later (or earlier if negative).
+
+    The value is linearly interpolated between samples, and NaN where the path does not exist.
+    """
+    idx = np.arange(len(series))
+    return np.interp(idx + turns*pts_per_turn, idx, series, left=np.nan, right=np.nan)
+
+def nearest_turn(lateral: np.ndarray, origin: float, turn_spacing: float) -> np.ndarray:
+    """
+    Index of the turn closest to a lateral position (elevation on a cylinder, radius on a disc).
+
+    :param origin: Lateral position of the first turn.
+    :param turn_spacing: Signed lateral distance between two turns.
+    """
+    return np.rint((np.asarray(lateral) - origin) / turn_spacing).astype(np.int64)
+
+def interp_samples(series: np.ndarray, positions: np.ndarray, left: float = np.nan, right: float = np.nan) -> np.ndarray:
+    """
+    Linear interpolation of a series at fractional sample positions, like np.interp over the sample indices.
+
+    Only the two samples around each position are read, so the series can be a `TurnSeries`.
+    """
+    positions = np.asarray(positions, dtype=float)
+    i0 = np.clip(np.floor(positions).astype(np.int64), 0, max(len(series) - 2, 0))
+    i1 = np.minimum(i0 + 1, len(series) - 1)
+    v0 = series[i0]
+    values = (series[i1] - v0) * (positions - i0) + v0
+    values = np.where(positions < 0, left, values)
+    return np.where(positions > len(series) - 1, right, values)
+
+
+@attrs.define
+class TurnSeries:
+    """
+    Series sampled along a path (phase, elevation, radius), stored as float32 offsets from a float64 origin per turn.
+
+    Within one turn, the offsets are bounded by the variation of the series over a turn: 2π for the phase,
+    pitch + max_amplitude for the lateral position. Rounding an offset to float32 changes it by at most
+    2**-24 times its magnitude, so the worst-case coordinate error is `max_error` = 2**-24 * max|offset|,
+    e.g. 4e-8 mm for a pitch of 0.5 mm and an amplitude of 0.1 mm, or 4e-7 rad (10 nm at a radius of 26.5 mm)
+    for the phase. Indexing returns float64 values, so the series can replace an array read by slices.
+    """
+    origins:        np.ndarray  # Value at the first sample of each turn, float64
+    offsets:        np.ndarray  # Value minus the origin of its turn, float32
+    pts_per_turn:   float
+
+    @classmethod
+    def from_series(cls, series: np.ndarray, pts_per_turn: float) -> 'TurnSeries':
+        series = np.asarray(series, dtype=float)
+        first = np.ceil(np.arange(int(np.ceil(len(series) / pts_per_turn)) + 1) * pts_per_turn).astype(np.int64)
+        origins = series[first[first < len(series)]]
+        offsets = (series - origins[cls.turn_of(np.arange(len(series)), pts_per_turn, len(origins))]).astype(np.float32)
+        return cls(origins, offsets, pts_per_turn)
+
+    @staticmethod
+    def turn_of(idx: np.ndarray, pts_per_turn: float, nb_turns: int) -> np.ndarray:
+        # Turn k holds the samples from ceil(k * pts_per_turn) to ceil((k+1) * pts_per_turn) - 1
+        turn = np.floor(idx / pts_per_turn).astype(np.int64)
+        turn += np.ceil(turn * pts_per_turn) > idx  # Rounding of the division at the turn boundaries
+        turn -= np.ceil((turn + 1) * pts_per_turn) <= idx
+        return np.clip(turn, 0, nb_turns - 1)
+
+    @property
+    def max_error(self) -> float:
+        return float(np.max(np.abs(self.offsets), initial=0)) * 2**-24
+
+    @property
+    def nbytes(self) -> int:
+        return self.origins.nbytes + self.offsets.nbytes
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, key) -> np.ndarray:
+        # Sample indices of the key, without an index array of the whole series. In a tuple key
+        # (e.g. series[start:end, None]), the first element selects the samples.
+        sample_key, extra_axes = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(sample_key, slice):
+            idx = np.arange(*sample_key.indices(len(self)))
+        else:
+            idx = np.asarray(sample_key)
+            idx = np.flatnonzero(idx) if idx.dtype == bool else np.where(idx < 0, idx + len(self), idx)
+        origins = self.origins[self.turn_of(idx, self.pts_per_turn, len(self.origins))]
+        return (origins[(Ellipsis,) + extra_axes] if extra_axes else origins) + self.offsets[key]
@@ -0,0 +1,371 @@
+"""
+Kernels for the sequential recurrences of the pipeline, with interchangeable backends.
+
+Some computations cannot be written as NumPy broadcasts, because each step depends on the previous one:
+the spiral of a disc at constant linear velocity, the gain of the look-ahead limiter, the feed planning of the
+machine and the simplification of a path. Each kernel has a reference implementation in plain Python, written
+so that Numba can compile it. The backends are:
+    - 'numba': the reference implementation compiled by Numba (optional dependency, compiled on first use),
+    - 'numpy': for the kernels that can be vectorized exactly with NumPy (the limiter, with running minima,
+      and the feed planning, by relaxing only the junctions whose speed changed),
+    - 'python': the reference implementation.
+
+The spiral and the path simplification have no NumPy backend: each step depends on the full state of the
+previous one. All backends give bit-identical results. The fastest backend installed for each kernel is used,
+unless the environment variable ENGRAVER_KERNEL_BACKEND forces one that the kernel has. `python kernels.py`
+compares the backends on the bundled audio files.
+"""
+import importlib.util
+import math
+import os
+import time
+import warnings
+import numpy as np
+
+# numba is slow to import and optional, so it is only imported when a kernel is compiled
+
+BACKENDS = ('numba', 'numpy', 'python')
+BACKEND_VARIABLE = 'ENGRAVER_KERNEL_BACKEND'
+
+# Implementations of each kernel, by kernel name and backend. 'numba' compiles the reference ('python') one.
+KERNELS: dict[str, dict[str, callable]] = {}
+
+
+def kernel(name: str, backend: str = 'python'):
+    """
+    Decorator registering a function as the implementation of a kernel for a backend.
+    """
+    def register(function):
+        KERNELS.setdefault(name, {})[backend] = function
+        return function
+    return register
+
+def numba_available() -> bool:
+    return importlib.util.find_spec('numba') is not None
+
+def available_backends(name: str = None) -> list[str]:
+    """
+    Installed backends, fastest first, of a kernel or of any kernel.
+
+    :param name: Name of the kernel, key of KERNELS. Default is all backends.
+    """
+    return [b for b in BACKENDS if (b != 'numba' or numba_available()) and (name is None or b in KERNELS[name] or b == 'numba')]
+
+def selected_backend(name: str = None) -> str:
+    """
+    Backend forced by the environment variable ENGRAVER_KERNEL_BACKEND, otherwise the fastest installed one.
+
+    :param name: Name of the kernel. The forced backend only applies to the kernels that have it,
+        the others use their fastest one. Default is any kernel.
+    """
+    backend = os.environ.get(BACKEND_VARIABLE, '').strip().lower()
+    if backend and backend not in BACKENDS:
+        raise ValueError(f"Invalid kernel backend '{backend}' in {BACKEND_VARIABLE}. Choose from {list(BACKENDS)}")
+    if backend == 'numba' and not numba_available():
+        raise ImportError(f"{BACKEND_VARIABLE} is set to 'numba', but numba is not installed (pip install numba).")
+    available = available_backends(name)
+    return backend if backend in available else available[0]
+
+def get_kernel(name: str, backend: str = None) -> callable:
+    """
+    Implementation of a kernel for a backend.
+
+    :param name: Name of the kernel, key of KERNELS.
+    :param backend: One of `available_backends(name)`. Default is the selected backend of the kernel.
+    """
+    backend = backend or selected_backend(name)
+    if backend not in available_backends(name):
+        raise ValueError(f"Kernel '{name}' has no '{backend}' backend. Choose from {available_backends(name)}")
+    implementations = KERNELS[name]
+    if backend == 'numba' and 'numba' not in implementations:
+        import numba
+        implementations['numba'] = numba.njit(cache=True)(implementations['python'])
+    return implementations[backend]
+
+
+def clv_spiral(nb_points: int, r_start: float, dr_dteta: float, step_length: float, backend: str = None) -> np.ndarray:
+    """
+    Angles of the points of a spiral read at constant linear velocity.
+
+    The nominal radius decreases linearly with the angle, r = r_start - dr_dteta * teta. Each angle step is the one
+    of a chord of `step_length` at the radius of the previous point, so it grows as the spiral gets closer to the center.
+
+    Parameters
+    ----------
+    nb_points : int
+        Number of points.
+    r_start : float
+        Radius of the first point [mm].
+    dr_dteta : float
+        Decrease of the radius per radian [mm/rad].
+    step_length : float
+        Distance between two points [mm].
+    backend : str
+        One of `available_backends('clv_spiral')`. Default is the selected backend.
+
+    Returns
+    -------
+    Angle of each point [rad], starting at 0.
+    """
+    return get_kernel('clv_spiral', backend)(int(nb_points), float(r_start), float(dr_dteta), float(step_length))
+
+@kernel('clv_spiral')
+def clv_spiral_python(nb_points, r_start, dr_dteta, step_length):
+    teta = np.empty(nb_points)
+    angle = 0.0
+    for i in range(nb_points):
+        teta[i] = angle
+        # Near the center, the step is at most half a turn
+        radius = max(r_start - dr_dteta*angle, step_length/2)
+        angle += 2*math.asin(step_length/(2*radius))
+    return teta
+
+
+def limiter_gain(amplitudes: np.ndarray, threshold: float, attack_step: float, release_step: float, backend: str = None) -> np.ndarray:
+    """
+    Gain of a look-ahead peak limiter.
+
+    The gain is the largest one keeping the amplitudes within ±threshold, that ramps down before each peak
+    by at most `attack_step` per sample (look-ahead) and recovers after it by at most `release_step` per sample.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    threshold : float
+        Largest amplitude after the limiter.
+    attack_step, release_step : float
+        Largest gain change per sample before and after a peak.
+    backend : str
+        One of `available_backends('limiter_gain')`. Default is the selected backend.
+
+    Returns
+    -------
+    Gain of each sample, between 0 and 1.
+    """
+    amplitudes = np.ascontiguousarray(amplitudes, dtype=np.float64)
+    return get_kernel('limiter_gain', backend)(amplitudes, float(threshold), float(attack_step), float(release_step))
+
+@kernel('limiter_gain')
+def limiter_gain_python(amplitudes, threshold, attack_step, release_step):
+    # The gain at i is set by a single binding sample j: target[j] + |j - i| * step. The binding sample minimizes
+    # target[j] + j*step before the peaks (backward pass) and gain[j] - j*step after them (forward pass).
+    n = len(amplitudes)
+    target = np.empty(n)
+    for i in range(n):
+        level = abs(amplitudes[i])
+        target[i] = threshold/level if level > threshold else 1.0
+    gain = np.empty(n)
+    # Backward pass: the gain ramps down before each peak
+    best, best_key = n, math.inf
+    for i in range(n-1, -1, -1):
+        key = target[i] + i*attack_step
+        if key <= best_key:
+            best, best_key = i, key
+        gain[i] = target[best] + (best - i)*attack_step
+    # Forward pass: the gain recovers after each peak
+    recovered = np.empty(n)
+    best, best_key = -1, math.inf
+    for i in range(n):
+        key = gain[i] - i*release_step
+        if key <= best_key:
+            best, best_key = i, key
+        recovered[i] = gain[best] + (i - best)*release_step
+    return recovered
+
+@kernel('limiter_gain', 'numpy')
+def limiter_gain_numpy(amplitudes, threshold, attack_step, release_step):
+    # Same binding samples as the reference, found with running minima of the keys
+    n = len(amplitudes)
+    idx = np.arange(n)
+    level = np.abs(amplitudes)
+    target = np.divide(threshold, level, out=np.ones(n), where=level > threshold)
+    key = target + idx*attack_step
+    later_min = np.append(np.minimum.accumulate(key[::-1])[::-1][1:], np.inf)
+    best = np.minimum.accumulate(np.where(key <= later_min, idx, n)[::-1])[::-1]
+    gain = target[best] + (best - idx)*attack_step
+
+    key = gain - idx*release_step
+    earlier_min = np.concatenate([[np.inf], np.minimum.accumulate(key)[:-1]])
+    best = np.maximum.accumulate(np.where(key <= earlier_min, idx, -1))
+    return gain[best] + (idx - best)*release_step
+
+
+def feed_profile(lengths: np.ndarray, max_speeds: np.ndarray, acceleration: float, backend: str = None) -> np.ndarray:
+    """
+    Speed of the machine at the junctions of consecutive blocks, with a limited acceleration.
+
+    A forward pass limits the speed reachable from the previous junction, and a backward pass the speed
+    from which the next junction can still be reached.
+
+    Parameters
+    ----------
+    lengths : np.ndarray
+        Length of each block [mm], shape (N,).
+    max_speeds : np.ndarray
+        Largest speed at each junction [mm/s], shape (N+1,), from the start of the first block to the end of the last one.
+    acceleration : float
+        Largest acceleration of the machine [mm/s²].
+    backend : str
+        One of `available_backends('feed_profile')`. Default is the selected backend.
+
+    Returns
+    -------
+    Speed at each junction [mm/s], shape (N+1,).
+    """
+    lengths = np.ascontiguousarray(lengths, dtype=np.float64)
+    max_speeds = np.ascontiguousarray(max_speeds, dtype=np.float64)
+    return get_kernel('feed_profile', backend)(lengths, max_speeds, float(acceleration))
+
+@kernel('feed_profile')
+def feed_profile_python(lengths, max_speeds, acceleration):
+    n = len(lengths)
+    speeds = np.empty(n + 1)
+    speeds[0] = max_speeds[0]
+    for i in range(n):
+        speeds[i+1] = min(max_speeds[i+1], math.sqrt(speeds[i]*speeds[i] + 2*acceleration*lengths[i]))
+    for i in range(n-1, -1, -1):
+        speeds[i] = min(speeds[i], math.sqrt(speeds[i+1]*speeds[i+1] + 2*acceleration*lengths[i]))
+    return speeds
+
+@kernel('feed_profile', 'numpy')
+def feed_profile_numpy(lengths, max_speeds, acceleration):
+    # The speeds only decrease from max_speeds. Relaxing every junction at once, then again only the junctions
+    # after (forward) or before (backward) a lowered one, reaches the speeds of the reference with the same
+    # operations. The number of rounds is the length of the longest acceleration ramp, a few blocks.
+    n = len(lengths)
+    speeds = max_speeds.copy()
+    active = np.arange(n)
+    while len(active):
+        reach = np.sqrt(speeds[active]*speeds[active] + 2*acceleration*lengths[active])
+        lowered = reach < speeds[active+1]
+        speeds[active[lowered]+1] = reach[lowered]
+        active = active[lowered] + 1
+        active = active[active < n]
+    active = np.arange(n)
+    while len(active):
+        reach = np.sqrt(speeds[active+1]*speeds[active+1] + 2*acceleration*lengths[active])
+        lowered = reach < speeds[active]
+        speeds[active[lowered]] = reach[lowered]
+        active = active[lowered] - 1
+        active = active[active >= 0]
+    return speeds
+
+
+def simplify_path(x: np.ndarray, y: np.ndarray, tolerance: float, max_length: float = math.inf, backend: str = None) -> np.ndarray:
+    """
+    Select the points of a 2D path to keep, so that the removed points are within a tolerance of the simplified path.
+
+    From each kept point, the path is extended while a common direction passes within `tolerance` of all the
+    following points (sector bound algorithm, linear time). The first and last points are always kept.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Coordinates of the points [mm].
+    tolerance : float
+        Largest distance of a removed point to the simplified path [mm].
+    max_length : float
+        Largest length of a segment of the simplified path [mm]. Default is no limit.
+    backend : str
+        One of `available_backends('simplify_path')`. Default is the selected backend.
+
+    Returns
+    -------
+    Boolean array, True for the points to keep.
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    return get_kernel('simplify_path', backend)(x, y, float(tolerance), float(max_length))
+
+@kernel('simplify_path')
+def simplify_path_python(x, y, tolerance, max_length):
+    n = len(x)
+    keep = np.zeros(n, dtype=np.bool_)
+    if n == 0:
+        return keep
+    keep[0] = True
+    keep[n-1] = True
+    anchor = 0
+    reference = 0.0
+    low, high = -math.inf, math.inf     # Directions passing close to all points since the anchor, relative to the reference
+    i = 1
+    while i < n:
+        dx, dy = x[i] - x[anchor], y[i] - y[anchor]
+        distance = math.sqrt(dx*dx + dy*dy)
+        if distance > tolerance:
+            direction = math.atan2(dy, dx)
+            if low == -math.inf:
+                reference = direction
+            direction -= reference
+            if direction > math.pi:
+                direction -= 2*math.pi
+            elif direction <= -math.pi:
+                direction += 2*math.pi
+            if distance > max_length or direction < low or direction > high:
+                # The segment from the anchor cannot reach this point: the previous point is kept
+                anchor = i - 1 if i - 1 > anchor else i
+                keep[anchor] = True
+                low, high = -math.inf, math.inf
+                if anchor == i:
+                    i += 1
+                continue
+            half_angle = math.asin(tolerance/distance)
+            low, high = max(low, direction - half_angle), min(high, direction + half_angle)
+        i += 1
+    return keep
+
+
+def self_test(input_folder: str = None, duration: float = 10.0) -> bool:
+    """
+    Compare the results of the available backends with the reference backend, on the bundled audio files.
+
+    :param input_folder: Folder of the audio files. Default is input_folder of the parameters.
+    :param duration: Duration of audio read from each file [s].
+    :return: True if all backends give bit-identical results.
+    """
+    import audio_processor as ap
+    import geometry as g
+    from parameters import default_parameters as p
+
+    input_folder = input_folder or p.input_folder
+    signals = {}
+    for filename in sorted(os.listdir(input_folder)):
+        try:
+            amplitudes, frame_rate, _, _ = ap.mp3_to_amplitude_series(input_folder + filename, duration=duration)
+        except Exception as e:
+            warnings.warn(f"Could not decode {filename} ({type(e).__name__}: {e}).")
+            continue
+        signals[filename] = (amplitudes, frame_rate)
+    if not signals:
+        warnings.warn("No audio file could be decoded, the backends are compared on a synthetic signal.")
+        rng = np.random.default_rng(0)
+        signals['synthetic'] = (np.clip(np.cumsum(rng.normal(0, 0.01, int(44100*duration))), -1, 1), 44100)
+
+    ok = True
+    print(f"Kernel backends: {available_backends()}, selected: {selected_backend()}")
+    for filename, (amplitudes, frame_rate) in signals.items():
+        phase = np.arange(len(amplitudes)) * p.speed_angular/frame_rate
+        x, y = (p.R - p.depth) * phase, phase*p.pitch/(2*np.pi) + amplitudes*p.max_amplitude/2
+        lengths = g.segment_lengths_cyl(p.R - p.depth, phase, y)
+        cases = {
+            'clv_spiral': (len(amplitudes), p.R, p.pitch/(2*np.pi), p.speed/frame_rate),
+            'limiter_gain': (amplitudes, 0.5, 1/(0.002*frame_rate), 1/(0.05*frame_rate)),
+            'feed_profile': (lengths, np.concatenate([[0], np.full(len(lengths)-1, p.feed_rate/60), [0]]), 500.0),
+            'simplify_path': (x, y, 0.001),
+        }
+        for name, args in cases.items():
+            function = globals()[name]
+            reference = function(*args, backend='python')
+            for backend in available_backends(name):
+                start = time.perf_counter()
+                result = function(*args, backend=backend)
+                elapsed = time.perf_counter() - start
+                identical = result.dtype == reference.dtype and np.array_equal(result, reference)
+                ok &= identical
+                print(f"{filename:>16} {name:>14} {backend:>7}: {elapsed*1e3:9.1f} ms {'identical' if identical else 'DIFFERENT'}")
+    return ok
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if self_test() else 1)
@@ -0,0 +1,307 @@
+"""
+Watertight mesh of the engraved cylinder or disc, built without CAD booleans.
+
+The path is resampled with a fixed number of columns per turn, so that column j and column j + M
+(M columns per turn) are at the same angle on consecutive turns. Each column holds a V cross-section
+(start-side edge, tip, end-side edge). The groove is a triangle strip along the columns, and the surface
+between consecutive turns is a strip joining column j to column j + M. The surface before the first turn
+and after the last one is joined to the rims of the part, which are closed by the caps.
+
+Triangles are generated in chunks of columns and streamed to a binary STL or a 3MF file.
+"""
+from math import pi
+import struct
+import zipfile
+import numpy as np
+
+from parameters import default_parameters as p
+import geometry as g
+from simulator import groove_lateral
+
+
+class GrooveMesh:
+    """
+    Vertices and triangles of the engraved part.
+
+    Vertex indices: 3j, 3j+1 and 3j+2 are the start-side edge, the tip and the end-side edge of column j.
+    They are followed by the extra vertices of the rims and caps.
+    """
+    def __init__(self, amplitudes: np.ndarray, frame_rate: float, columns_per_turn: int = None):
+        lateral, _, pts_per_turn = groove_lateral(amplitudes, frame_rate)
+        self.M = columns_per_turn or int(round(pts_per_turn))
+        step = pts_per_turn / self.M
+        self.N = int((len(lateral) - 1) / step) + 1
+        if self.N < 2*self.M + 2:
+            raise ValueError(f"Path is too short to be meshed: {self.N} columns for {self.M} columns per turn. It needs more than two turns.")
+        self.lateral = g.interp_samples(lateral, np.arange(self.N) * step)
+        if p.compact:
+            self.lateral = g.TurnSeries.from_series(self.lateral, self.M)
+
+        self.disc = p.SURFACE_TYPE == 'disc'
+        self.direction = -1 if self.disc else 1  # Direction of the lateral coordinate from one turn to the next
+        self.phase_step = 2*pi/self.M * (-1 if p.right_thread and not self.disc else 1)
+
+        # Extra vertices, after the 3N vertices of the groove
+        ring_phases = np.arange(self.M) * self.phase_step
+        extra = []
+        if self.disc:
+            # Outer rim on the engraved face (start ring), center of the engraved face (end), outer rim and center of the bottom face
+            extra.append(self.surface_points(np.full(self.M, p.R), ring_phases))
+            extra.append([[0, 0, p.L]])
+            extra.append(self.surface_points(np.full(self.M, p.R), ring_phases, 0.0))
+            extra.append([[0, 0, 0]])
+        else:
+            # Rims at both ends of the cylinder (start and end rings) and centers of the caps
+            extra.append(self.surface_points(np.full(self.M, 0.0), ring_phases))
+            extra.append(self.surface_points(np.full(self.M, p.L), ring_phases))
+            extra.append([[0, 0, 0], [0, 0, p.L]])
+        self.extra = np.concatenate([np.asarray(e, dtype=float) for e in extra])
+        self.first_extra = 3*self.N
+
+    @property
+    def nb_vertices(self) -> int:
+        return 3*self.N + len(self.extra)
+
+    def surface_points(self, lateral: np.ndarray, phase: np.ndarray, height: float = None) -> np.ndarray:
+        """
+        Cartesian coordinates of points given by their lateral position and phase.
+
+        :param height: Depth below the engraved surface [mm], or z for a disc. Default is on the engraved surface.
+        """
+        if self.disc:
+            z = p.L if height is None else height
+            return np.stack(np.broadcast_arrays(*g.cyl2cart(lateral, phase, z)), axis=-1)
+        radius = p.R if height is None else p.R - height
+        return np.stack(np.broadcast_arrays(*g.cyl2cart(radius, phase, lateral)), axis=-1)
+
+    def groove_vertices(self, start: int, end: int) -> np.ndarray:
+        """
+        Coordinates of the vertices of columns start to end, shape ((end-start)*3, 3).
+        """
+        lateral = self.lateral[start:end]
+        phase = np.arange(start, end) * self.phase_step
+        half_width = self.direction * p.width/2
+        if self.disc:
+            tip = self.surface_points(lateral, phase, p.L - p.depth)
+        else:
+            tip = self.surface_points(lateral, phase, p.depth)
+        edges = [self.surface_points(lateral - half_width, phase), tip, self.surface_points(lateral + half_width, phase)]
+        return np.stack(edges, axis=1).reshape(-1, 3)
+
+    def vertices(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Coordinates of vertices given by their indices.
+        """
+        coords = np.empty(indices.shape + (3,))
+        is_groove = indices < self.first_extra
+        groove = indices[is_groove]
+        if len(groove):
+            lo, hi = groove.min() // 3, groove.max() // 3 + 1
+            coords[is_groove] = self.groove_vertices(lo, hi)[groove - 3*lo]
+        coords[~is_groove] = self.extra[indices[~is_groove] - self.first_extra]
+        return coords
+
+    def rings(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Indices of the start and end rings, by column modulo M.
+        """
+        ring = self.first_extra + np.arange(self.M)
+        if self.disc:
+            return ring, np.full(self.M, self.first_extra + self.M)
+        return ring, ring + self.M
+
+    def surface_triangles(self, start: int, end: int) -> np.ndarray:
+        """
+        Triangles of the engraved face starting at columns start to end, shape (nb_triangles, 3).
+        """
+        N, M = self.N, self.M
+        a = lambda j: 3*j
+        t = lambda j: 3*j + 1
+        b = lambda j: 3*j + 2
+        S, E = self.rings()
+        quads = []
+
+        # Groove strips
+        j = np.arange(start, min(end, N-1))
+        quads += [(a(j), a(j+1), t(j+1), t(j)), (t(j), t(j+1), b(j+1), b(j))]
+        # Surface between consecutive turns
+        j = np.arange(start, min(end, N-M-1))
+        quads.append((b(j), b(j+1), a(j+M+1), a(j+M)))
+        # Surface before the first turn and after the last one
+        j = np.arange(start, min(end, M-1))
+        quads.append((S[j], S[j+1], a(j+1), a(j)))
+        j = np.arange(max(start, N-M), min(end, N-1))
+        quads.append((b(j), b(j+1), E[(j+1) % M], E[j % M]))
+
+        triangles = [np.stack([q[0], q[1], q[2]], axis=-1) for q in quads] + [np.stack([q[0], q[2], q[3]], axis=-1) for q in quads]
+        fans = []
+        if start <= M-1 < end:
+            # Seam at the angle of the first column: the surface before the first turn meets the start of the groove
+            fans.append((a(M-1), [S[M-1], S[0], a(0), b(0), a(M)]))
+        if start <= N-M-1 < end:
+            # Seam at the angle of the last column: the end of the groove meets the surface after the last turn
+            fans.append((b(N-M), [E[(N-M) % M], E[(N-1) % M], b(N-1), a(N-1), b(N-M-1)]))
+        for center, border in fans:
+            triangles.append(np.array([[center, border[k], border[k+1]] for k in range(len(border)-1)]))
+        if start == 0:
+            triangles.append(np.array([[a(0), t(0), b(0)]]))
+        if start <= N-1 < end:
+            triangles.append(np.array([[a(N-1), t(N-1), b(N-1)]]))
+
+        triangles = np.concatenate([tri.reshape(-1, 3) for tri in triangles]).astype(np.int64)
+        return remove_degenerate(triangles)
+
+    def closing_triangles(self) -> np.ndarray:
+        """
+        Triangles closing the part: caps of the cylinder, or side wall and bottom face of the disc.
+        """
+        m = np.arange(self.M)
+        S, E = self.rings()
+        if self.disc:
+            bottom_ring = self.first_extra + self.M + 1 + m
+            bottom_center = self.first_extra + 2*self.M + 1
+            triangles = [np.stack([S[m], S[(m+1) % self.M], bottom_ring[(m+1) % self.M]], axis=-1),
+                         np.stack([S[m], bottom_ring[(m+1) % self.M], bottom_ring[m]], axis=-1),
+                         np.stack([bottom_ring[m], bottom_ring[(m+1) % self.M], np.full(self.M, bottom_center)], axis=-1)]
+        else:
+            centers = self.first_extra + 2*self.M
+            triangles = [np.stack([S[m], S[(m+1) % self.M], np.full(self.M, centers)], axis=-1),
+                         np.stack([E[m], E[(m+1) % self.M], np.full(self.M, centers + 1)], axis=-1)]
+        return np.concatenate(triangles)
+
+    def orient(self, triangles: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Order the vertices of each triangle so that its normal points out of the part.
+
+        :return: The oriented triangles and their vertex coordinates, shape (nb_triangles, 3, 3).
+        """
+        coords = self.vertices(triangles)
+        normals = np.cross(coords[:, 1] - coords[:, 0], coords[:, 2] - coords[:, 0])
+        centroids = coords.mean(axis=1)
+
+        # Engraved face: outwards is +z for a disc, radial for a cylinder
+        if self.disc:
+            outward = np.zeros_like(centroids)
+            outward[:, 2] = 1
+            outward[centroids[:, 2] < p.L - p.depth - 1e-9] = [0, 0, -1]
+            on_rim = np.all(triangles >= self.first_extra, axis=1) & (np.abs(normals[:, 2]) < 1e-12)
+            outward[on_rim] = centroids[on_rim] * [1, 1, 0]
+        else:
+            outward = centroids * [1, 1, 0]
+            cap = np.all(triangles >= self.first_extra, axis=1)
+            outward[cap] = [0, 0, 1]
+            outward[cap & (centroids[:, 2] < p.L/2)] = [0, 0, -1]
+
+        # Ends of the groove face the inside of the groove
+        for end, neighbour in ((0, 1), (self.N-1, self.N-2)):
+            is_cap = np.all(triangles == [3*end, 3*end+1, 3*end+2], axis=1)
+            if np.any(is_cap):
+                tip, tip_neighbour = self.vertices(np.array([3*end+1, 3*neighbour+1]))
+                outward[is_cap] = tip_neighbour - tip
+
+        flip = np.einsum('ij,ij->i', normals, outward) < 0
+        triangles[flip] = triangles[flip][:, [0, 2, 1]]
+        coords[flip] = coords[flip][:, [0, 2, 1]]
+        return triangles, coords
+
+    def triangle_chunks(self, chunk_size: int = 65536):
+        """
+        Generate the oriented triangles of the part by chunks of columns.
+
+        :return: Iterator of (triangles, coordinates).
+        """
+        for start in range(0, self.N, chunk_size):
+            yield self.orient(self.surface_triangles(start, min(start + chunk_size, self.N)))
+        yield self.orient(self.closing_triangles())
+
+
+def remove_degenerate(triangles: np.ndarray) -> np.ndarray:
+    """
+    Remove the triangles using the same vertex twice.
+    """
+    keep = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 0] != triangles[:, 2])
+    return triangles[keep]
+
+def export_mesh_to_stl(mesh: GrooveMesh, filename: str) -> int:
+    """
+    Stream the mesh to a binary STL file.
+
+    :return: Number of triangles.
+    """
+    record = np.dtype([('normal', '<f4', 3), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+    nb_triangles = 0
+    with open(filename, 'wb') as f:
+        f.write(b'Engraver groove mesh'.ljust(80, b' '))
+        f.write(struct.pack('<I', 0))
+        for _, coords in mesh.triangle_chunks():
+            normals = np.cross(coords[:, 1] - coords[:, 0], coords[:, 2] - coords[:, 0])
+            normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-30)
+            data = np.zeros(len(coords), dtype=record)
+            data['normal'], data['vertices'] = normals, coords
+            f.write(data.tobytes())
+            nb_triangles += len(coords)
+        f.seek(80)
+        f.write(struct.pack('<I', nb_triangles))
+    return nb_triangles
+
+def export_mesh_to_3mf(mesh: GrooveMesh, filename: str, chunk_size: int = 65536) -> int:
+    """
+    Stream the mesh to a 3MF file.
+
+    :return: Number of triangles.
+    """
+    content_types = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                     '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+                     '</Types>')
+    rels = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+            '</Relationships>')
+    nb_triangles = 0
+    with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', content_types)
+        zf.writestr('_rels/.rels', rels)
+        with zf.open('3D/3dmodel.model', 'w', force_zip64=True) as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                    b'<model unit="millimeter" xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">'
+                    b'<resources><object id="1" type="model"><mesh><vertices>\n')
+            for start in range(0, mesh.N, chunk_size):
+                coords = mesh.groove_vertices(start, min(start + chunk_size, mesh.N))
+                f.write(''.join(f'<vertex x="{x:.6f}" y="{y:.6f}" z="{z:.6f}"/>\n' for x, y, z in coords.tolist()).encode())
+            f.write(''.join(f'<vertex x="{x:.6f}" y="{y:.6f}" z="{z:.6f}"/>\n' for x, y, z in mesh.extra.tolist()).encode())
+            f.write(b'</vertices><triangles>\n')
+            for triangles, _ in mesh.triangle_chunks(chunk_size):
+                f.write(''.join(f'<triangle v1="{i}" v2="{j}" v3="{k}"/>\n' for i, j, k in triangles.tolist()).encode())
+                nb_triangles += len(triangles)
+            f.write(b'</triangles></mesh></object></resources><build><item objectid="1"/></build></model>\n')
+    return nb_triangles
+
+def amplitudes_to_mesh(amplitudes: np.ndarray, frame_rate: float, columns_per_turn: int = None) -> None:
+    """
+    Convert a series of sound amplitudes to a watertight mesh of the engraved cylinder or disc.
+
+    The mesh is generated based on the parameters defined in the `parameters.py` file.
+    It is exported in the format given by `mesh_format` (binary STL or 3MF).
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+    columns_per_turn : int
+        Number of cross-sections per turn. Default is the number of samples per turn.
+
+    Returns
+    -------
+    None
+    """
+    mesh = GrooveMesh(amplitudes, frame_rate, columns_per_turn)
+    filename = p.output_folder + p.output_filename + "." + p.mesh_format
+    if p.mesh_format == '3mf':
+        nb_triangles = export_mesh_to_3mf(mesh, filename)
+    else:
+        nb_triangles = export_mesh_to_stl(mesh, filename)
+    print(f"Mesh with {mesh.nb_vertices} vertices and {nb_triangles} triangles ({mesh.N // mesh.M} turns) exported to {filename}")
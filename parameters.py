@@ -1,7 +1,7 @@
 from math import tan, radians, sqrt
 from datetime import date
 import attrs
-from typing import Literal
+from typing import Literal, get_args, get_origin
 import json
 
 
@@ -13,18 +13,20 @@ class ParameterSet:
     L:                      float = attrs.field(default=100.0)  # Length of the cylinder [mm]
 
     # Engraving
-    ENGRAVING_OUTPUT_TYPE:  Literal['gcode', 'points', 'image', 'wire'] = attrs.field(default='gcode')
+    ENGRAVING_OUTPUT_TYPE:  Literal['gcode', 'points', 'image', 'wire', 'mesh'] = attrs.field(default='gcode')
     depth:                  float = attrs.field(default=0.050)  # Depth of the cut [mm]
     angle:                  float = attrs.field(default=60.0)  # Angle of the cut [°]
     width:                  float = attrs.field(init=False, default=None)  # Width of the cut [mm] - calculated, not initialized
     pitch:                  float = attrs.field(default=0.500) # Pitch of the spiral [mm]
     max_amplitude:          float = attrs.field(default=0.100) # Maximal amplitude of the engraved audio signal (peak-peak) [mm]
     speed_angular:          float = attrs.field(default=11.32) # Rotational speed the cylinder [rad/s]
+    disc_speed:             Literal['angular', 'linear'] = attrs.field(default='angular') # Discs: constant angular velocity (speed_angular), or constant linear velocity (speed at every radius)
     speed:                  float = attrs.field(init=False) # Longitudinal reading speed of the tip in the engraving [mm/s] - calculated
     end_margin:             float = attrs.field(default=2) # Margin at the start and end of the engraving surface [mm]
     start_pos:              float = attrs.field(default=0) # Position of the start of the engraving
     split_files:            bool = attrs.field(default=False) # True if the path must be split into multiple files
     files_per_turn:         int = attrs.field(default=20) # Number of files per turn of the cylinder
+    path_format:            Literal['csv', 'npz'] = attrs.field(default='csv') # Format of the path points: csv (SolidWorks and FreeCAD macros) or npz (binary, FreeCAD macros only)
     offset_from_centerline: float = attrs.field(default=0.0) #-width/2 # Used to create the path of the corner of the triangle on the surface [mm]
     intersection_margin:    float = attrs.field(default=0.010) # Margin
     right_thread:           bool = attrs.field(default=True) # True if the engraving spiral is right threaded, otherwise left threaded
@@ -32,6 +34,12 @@ class ParameterSet:
     # Audio
     filter_active:          bool = attrs.field(default=True)
     cutoff_freq_high:       int = attrs.field(default=3000) # Hz
+    limiter_active:         bool = attrs.field(default=False) # Look-ahead peak limiter after the low-pass filter, keeps the amplitudes within ±1
+    limiter_lookahead:      float = attrs.field(default=0.002) # Time over which the limiter gain ramps down before a peak [s]
+    limiter_release:        float = attrs.field(default=0.050) # Time over which the limiter gain recovers after a peak [s]
+    equalization:           Literal['none', 'displacement', 'riaa', 'custom'] = attrs.field(default='none') # Recording curve applied after the filter: pressure to displacement, RIAA pre-emphasis or eq_curve_file
+    eq_corner_freq:         float = attrs.field(default=20.0) # Low-frequency corner of the displacement curve, below which the response is flat [Hz]
+    eq_curve_file:          str = attrs.field(default="") # CSV file of (frequency [Hz], gain [dB]) points for the custom curve
     # cutoff_freq_low:        float = attrs.field(default=5.0) # Hz
     start_time:             float = attrs.field(default=0) # How many seconds to crop from the start of the audio
     duration:               float = attrs.field(default=100) # Duration of the audio signal [s]
@@ -45,14 +53,40 @@ class ParameterSet:
     white:                  int = attrs.field(default=255) # Color for the engraving
     black:                  int = attrs.field(default=0) # Color for the engraving
 
+    # Split of long recordings on several parts
+    split_search_duration:  float = attrs.field(default=2.0) # The cut between two parts is at the quietest point in this duration before the end of a part [s]
+    split_workers:          int = attrs.field(default=0) # Number of parts engraved in parallel, 0 for the number of CPUs
+    disc_sides:             int = attrs.field(default=1) # Engraved sides of each disc (1 or 2)
+
+    # Wire
+    wire_tolerance:         float = attrs.field(default=0.0) # Largest distance between the simplified wire and the path [mm], 0 keeps every point
+
+    # Mesh
+    mesh_format:            Literal['stl', '3mf'] = attrs.field(default='stl') # Format of the engraved part mesh
+
+    # Simulation
+    stylus_radius:          float = attrs.field(default=0.020) # Radius of the tip of the virtual stylus [mm]
+    sim_resolution:         float = attrs.field(default=0.0005) # Lateral resolution of the simulated groove [mm]
+
+    # Preview
+    plot:                   Literal['interactive', 'png', 'none'] = attrs.field(default='none') # Audio preview: matplotlib window, <output_filename>_preview.png, or nothing
+
+    # Memory
+    compact:                bool = attrs.field(default=False) # Audio stages in float32 and simulated or meshed path in float32 offsets per turn (see geometry.TurnSeries). The G-code may differ by 1 um in rare blocks
+
     # Folders and file name
     input_folder:           str = attrs.field(default="./audio_files/")
     input_filename:         str = attrs.field(default="DJSaphir2.mp3")
     output_folder:          str = attrs.field(default="./3d_files/") # "images" or "3d_files"
     output_filename:        str = attrs.field(init=False)
+    cache_folder:           str = attrs.field(default="./cache/") # Intermediate results of the pipeline stages
+    archive_folder:         str = attrs.field(default="./archive/") # Compressed copies of the output files
+    archive_compression:    Literal['none', 'gzip', 'xz', 'zstd'] = attrs.field(default='none') # Compression of the archived copies, 'none' to disable the archive
 
     # G-code
     feed_rate:              float = attrs.field(default=150.0) # [mm/min]
+    max_acceleration:       float = attrs.field(default=500.0) # [mm/s²] Used for the machining time estimate
+    junction_deviation:     float = attrs.field(default=0.005) # [mm] Deviation allowed at the junction of two blocks, limits the speed through sharp corners
     spindle_speed:          int = attrs.field(default=15000) # [rpm]
     clearance:              float = attrs.field(default=5.0) # [mm]
     depth_of_cut:           float = attrs.field(default=0.020) # [mm] Depth of cut for one pass
@@ -61,11 +95,25 @@ class ParameterSet:
     corrector_number:       int = attrs.field(default=22)
     file_format:            str = attrs.field(default="iso")
     max_text_size:          int = attrs.field(default=900*1024*1024) # [bytes] (= 900 MB)
+    gcode_index_step:       int = attrs.field(default=100) # [blocks] Distance between two entries of the restart index (*_index.npz)
+    disc_gcode_axes:        Literal['polar', 'xy'] = attrs.field(default='polar') # Disc blocks: radius X and rotary C [°], or X and Y with the center of the disc at the origin
+    gcode_block_rate:       float = attrs.field(default=1000.0) # [blocks/s] Blocks the controller processes per second. Disc blocks are merged near the center to stay below it at the feed rate
     FINAL_GCODE:            str = attrs.field(init=False)
 
-    def INITIAL_GCODE(self, x0: str = '0.0', a0: str = '0.0', file_ID: str = '') -> str:
-        # Start outside of the cylinder and penetrate from the side
-        depth_first_pass = self.depth_of_cut + self.start_depth
+    @property
+    def gcode_axes(self) -> tuple[str, str]:
+        """
+        Axes of the engraving blocks: X and A on a cylinder, X (radius) and C or X and Y on a disc.
+        """
+        if self.SURFACE_TYPE == 'disc':
+            return ('X', 'C') if self.disc_gcode_axes == 'polar' else ('X', 'Y')
+        return 'X', 'A'
+
+    def INITIAL_GCODE(self, x0: str = '0.0', a0: str = '0.0', file_ID: str = '', depth: float = None) -> str:
+        # Start outside of the cylinder and penetrate from the side, at the depth of the first pass by default
+        depth_first_pass = self.depth_of_cut + self.start_depth if depth is None else depth
+        if self.SURFACE_TYPE == 'disc':
+            return self.disc_initial_gcode(x0, a0, file_ID, depth_first_pass)
         y0 = round(2*sqrt(2*self.R*depth_first_pass - depth_first_pass**2), 3) 
         return f"""%
 O0001 ({self.input_filename.split(".")[0]} {file_ID})
@@ -83,7 +131,7 @@ G90G54
 M11
 G0X{x0}Y{y0}A{a0}
 G43Z150.H{self.corrector_number}M13S{round(self.spindle_speed, 0)}
-G0Z{round(self.R-self.start_depth-self.depth_of_cut,3)}
+G0Z{round(self.R-depth_first_pass,3)}
 G1Y0.F{round(self.feed_rate,3)}"""
 
     def depth_change_sequence(self, desired_depth: float, x0: float, a0: float) -> str:
@@ -95,6 +143,8 @@ G1Y0.F{round(self.feed_rate,3)}"""
         :param desired_depth: The depth of the engraving for the next pass.
         :return: The G-code for changing the depth.
         '''
+        if self.SURFACE_TYPE == 'disc':
+            return self.disc_depth_change_sequence(desired_depth, x0, a0)
         y0 = round(2*sqrt(2*self.R*desired_depth - desired_depth**2), 3)
         return f"""
 ( Depth change to {round(1e3*desired_depth,0)} um )
@@ -106,14 +156,53 @@ M13S{round(self.spindle_speed, 0)}
 G0Z{round(self.R-desired_depth,3)}
 G1Y0.F{round(self.feed_rate,3)}"""
 
+    def disc_initial_gcode(self, x0: str, a0: str, file_ID: str, depth: float) -> str:
+        # Start above the first block of the disc and plunge vertically to the depth of the pass
+        first, second = self.gcode_axes
+        return f"""%
+O0001 ({self.input_filename.split(".")[0]} {file_ID})
+( PART NAME : {self.output_filename} )
+( MACH TYPE : Fraiseuse vert. 4 axes )
+( POST TYPE : Fraisage 4axes Fanuc 0iM.GCv11 )
+( {date.today()} )
+( OUTPUT IN ABSOLUTE MILLIMETERS )
+G21
+G53Z0.
+G49
+G17G80G40G94
+M6T{self.tool_number}
+G90G54
+M11
+G0{first}{x0}{second}{a0}
+G43Z150.H{self.corrector_number}M13S{round(self.spindle_speed, 0)}
+G0Z{round(self.L+self.clearance,3)}
+G1Z{round(self.L-depth,3)}F{round(self.feed_rate,3)}"""
+
+    def disc_depth_change_sequence(self, desired_depth: float, x0: float, a0: float) -> str:
+        '''
+        Generate the G-code for changing the depth of the engraving on a disc.
+
+        Goes up, to the first block, then plunges vertically to the next depth.
+        '''
+        first, second = self.gcode_axes
+        return f"""
+( Depth change to {round(1e3*desired_depth,0)} um )
+G0Z{round(self.L+self.clearance,3)}
+G0{first}{x0}{second}{a0}
+M01
+( New depth: {round(1e3*desired_depth,0)} um )
+M13S{round(self.spindle_speed, 0)}
+G1Z{round(self.L-desired_depth,3)}F{round(self.feed_rate,3)}"""
+
     def __attrs_post_init__(self):
         # Calculate derived attributes
         self.width = 2 * self.depth * tan(radians(self.angle/2))
         self.speed = self.speed_angular * self.R
         self.engraving_pixel_width = round(self.width / self.pixel_size)
         self.output_filename = f'{round(self.depth*1e3)}_{round(self.max_amplitude*1e3)}_{round(self.pitch*1e3)}_{self.input_filename.split(".")[0]}_path'
+        top = self.L if self.SURFACE_TYPE == 'disc' else self.R
         self.FINAL_GCODE = f"""
-G0Z{round(self.R-self.depth+self.clearance,3)}
+G0Z{round(top-self.depth+self.clearance,3)}
 G0Z150.
 G49G53Z0.
 M15
@@ -130,6 +219,16 @@ M30
         txt += f'\nCreated on {date.today()}'
         return txt
     
+    def update(self, **changes) -> None:
+        """
+        Change some parameters and recompute the calculated ones.
+
+        The object is modified in place, so that all modules sharing `default_parameters` see the changes.
+        """
+        updated = attrs.evolve(self, **changes)
+        for a in attrs.fields(self.__class__):
+            setattr(self, a.name, getattr(updated, a.name))
+
     def export_parameters_to_txt(self) -> None:
         """
         Exports the ParameterSet object to a text file in JSON format.
@@ -137,32 +236,62 @@ M30
         with open(self.output_folder+self.output_filename+"_parameters.txt", 'w') as f:
             json.dump(attrs.asdict(self), f, indent=4)
 
+    @classmethod
+    def load_txt(cls, filename: str) -> "ParameterSet":
+        """
+        Imports a ParameterSet object from a text file in JSON format, without falling back to the defaults.
+
+        Raises FileNotFoundError if the file does not exist, and ValueError if it is not a JSON object,
+        or if it has an unknown key or a value that does not match the type of its field.
+        """
+        with open(filename, 'r') as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON format: {e}") from e
+        if not isinstance(data, dict):
+            raise ValueError("The parameters must be a JSON object.")
+
+        fields = {field.name: field for field in attrs.fields(cls)}
+        unknown = sorted(set(data) - set(fields))
+        if unknown:
+            raise ValueError(f"Unknown parameters: {', '.join(unknown)}.")
+        # Calculated fields are exported too, and computed again
+        return cls(**{name: checked_value(fields[name], value) for name, value in data.items() if fields[name].init})
+
     @classmethod
     def from_txt(cls, filename: str) -> "ParameterSet":
         """
         Imports a ParameterSet object from a text file in JSON format.
+
+        Returns the default ParameterSet if the file is missing or invalid, see `load_txt` for a strict import.
         """
         print(f"Importing parameters from {filename}")
         
         try:
-            with open(filename, 'r') as f:
-                data = json.load(f)
-
-                # Remove keys that are calculated
-                non_init_fields = [field.name for field in attrs.fields(cls) if field.init is False]
-                for field_name in non_init_fields:
-                    data.pop(field_name, None)
-
-                return cls(**data)
+            return cls.load_txt(filename)
         except FileNotFoundError:
             print(f"Error: File '{filename}' not found. Returning default ParameterSet.")
             return cls()  # Return a default ParameterSet
-        except json.JSONDecodeError:
-            print(f"Error: Invalid JSON format in '{filename}'. Returning default ParameterSet.")
-            return cls()  # Return a default ParameterSet
-        except TypeError as e:
-            print(f"Error: Type mismatch or invalid value in file: {e}. Returning default ParameterSet.")
+        except (ValueError, TypeError) as e:
+            print(f"Error: Invalid parameters in '{filename}': {e} Returning default ParameterSet.")
             return cls()  # Return a default ParameterSet
+
+def checked_value(field: attrs.Attribute, value):
+    """
+    Check that a value read from a parameters file matches the type of its field.
+
+    Integers are accepted for float fields and converted. Raises ValueError otherwise.
+    """
+    if get_origin(field.type) is Literal:
+        valid, expected = value in get_args(field.type), " or ".join(repr(choice) for choice in get_args(field.type))
+    elif field.type in (int, float):
+        valid, expected = isinstance(value, (int, field.type)) and not isinstance(value, bool), field.type.__name__
+    else:
+        valid, expected = isinstance(value, field.type), field.type.__name__
+    if not valid:
+        raise ValueError(f"Invalid value {value!r} for {field.name}, expected {expected}.")
+    return float(value) if field.type is float else value
     
 default_parameters = ParameterSet()
 # default_parameters = ParameterSet.from_txt("./3d_files/25_100_500_squeezie_path_parameters.txt")
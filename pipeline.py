@@ -0,0 +1,295 @@
+"""
+Pipeline stages with content-addressed caching.
+
+Each stage declares the ParameterSet fields it reads. Its output is stored in the cache folder
+under a hash of those fields and of the hashes of its upstream stages. A rerun only recomputes
+the stages invalidated by a parameter change.
+"""
+import hashlib
+import json
+import os
+import attrs
+import numpy as np
+
+import audio_processor as ap
+import amp2engraving as a2e
+import exporter
+import restart
+from parameters import default_parameters as p
+
+
+@attrs.define(frozen=True)
+class Stage:
+    name:       str
+    fields:     tuple[str, ...]         # ParameterSet fields read by the stage
+    upstream:   tuple[str, ...] = ()    # Stages whose output is read by the stage
+
+
+# Fields defining the engraving path
+PATH_FIELDS = ('R', 'L', 'depth', 'angle', 'pitch', 'max_amplitude', 'speed_angular', 'end_margin', 'start_pos',
+               'offset_from_centerline', 'intersection_margin', 'right_thread', 'disc_speed')
+OUTPUT_FIELDS = ('output_folder', 'output_filename')
+
+# The G-code files and time of a disc read the output of 'disc_gcode_pass' as their 'gcode_pass'
+STAGES = {stage.name: stage for stage in [
+    Stage('decode',         ('input_folder', 'input_filename', 'start_time', 'duration', 'target_volume', 'compact')),
+    Stage('filter',         ('filter_active', 'cutoff_freq_high', 'limiter_active', 'limiter_lookahead', 'limiter_release'), ('decode',)),
+    Stage('equalize',       ('equalization',), ('filter',)),    # eq_corner_freq and eq_curve_file when used, see equalize_stage_key
+    Stage('silent_start',   ('silent_start_duration',), ('equalize',)),
+    Stage('gcode_pass',     PATH_FIELDS, ('silent_start',)),
+    Stage('disc_gcode_pass', PATH_FIELDS + ('disc_gcode_axes', 'feed_rate', 'gcode_block_rate'), ('silent_start',)),
+    Stage('gcode_files',    ('start_depth', 'depth_of_cut', 'clearance', 'max_text_size', 'file_format') + OUTPUT_FIELDS, ('gcode_pass',)),
+    Stage('gcode_header',   ('feed_rate', 'spindle_speed', 'tool_number', 'corrector_number')),
+    Stage('gcode_time',     ('feed_rate', 'max_acceleration', 'junction_deviation'), ('gcode_pass',)),
+    Stage('points',         PATH_FIELDS + ('SURFACE_TYPE', 'split_files', 'files_per_turn', 'path_format') + OUTPUT_FIELDS, ('silent_start',)),
+    Stage('image',          PATH_FIELDS + ('SURFACE_TYPE', 'pixel_size', 'interpolate', 'white', 'black') + OUTPUT_FIELDS, ('silent_start',)),
+    Stage('wire',           PATH_FIELDS + ('wire_tolerance',) + OUTPUT_FIELDS, ('silent_start',)),
+    Stage('mesh',           PATH_FIELDS + ('SURFACE_TYPE', 'mesh_format') + OUTPUT_FIELDS, ('silent_start',)),
+]}
+
+
+def stage_key(name: str, upstream_keys: dict[str, str] = {}, extra: str = '') -> str:
+    """
+    Compute the content hash of a stage.
+
+    :param name: Name of the stage, key of STAGES.
+    :param upstream_keys: Hashes of the upstream stages, by stage name.
+    :param extra: Additional content the stage depends on (e.g. hash of an input file).
+    :return: The hash of the stage, as a hexadecimal string.
+    """
+    stage = STAGES[name]
+    content = {
+        'stage': name,
+        'fields': {field: getattr(p, field) for field in stage.fields},
+        'upstream': [upstream_keys[u] for u in stage.upstream],
+        'extra': extra,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def cached(name: str, key: str, compute) -> dict[str, np.ndarray]:
+    """
+    Return the output of a stage from the cache, or compute and store it.
+
+    :param name: Name of the stage.
+    :param key: Hash of the stage, from `stage_key`.
+    :param compute: Function without argument returning the stage output as a dictionary of arrays.
+    :return: The stage output.
+    """
+    filename = f"{p.cache_folder}{name}_{key}.npz"
+    if os.path.exists(filename):
+        print(f"Stage '{name}' is up to date ({key}).")
+        with np.load(filename) as data:
+            return dict(data)
+
+    result = {k: np.asarray(v) for k, v in compute().items()}
+    os.makedirs(p.cache_folder, exist_ok=True)
+    with open(filename + ".tmp", 'wb') as f:
+        np.savez(f, **result)
+    os.replace(filename + ".tmp", filename)
+    return result
+
+def file_hash(filename: str) -> str:
+    """
+    Hash the content of a file.
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def equalize_stage_key(filter_key: str) -> str:
+    """
+    Hash of the equalize stage. The corner frequency and the curve file only change the key of the curve that uses them.
+    """
+    match p.equalization:
+        case 'displacement':
+            extra = p.eq_corner_freq
+        case 'custom':
+            extra = file_hash(p.eq_curve_file)
+        case _:
+            extra = None
+    return stage_key('equalize', {'filter': filter_key}, extra=extra)
+
+def audio_stage() -> tuple[np.ndarray, float, str]:
+    """
+    Decode, filter and equalize the input audio file.
+
+    :return: The amplitudes, the frame rate and the hash of the stage.
+    """
+    input_file = p.input_folder + p.input_filename
+    decode_key = stage_key('decode', extra=file_hash(input_file))
+    decoded = cached('decode', decode_key, lambda: dict(zip(
+        ('amplitudes', 'frame_rate', 'sample_width', 'num_channels'),
+        ap.mp3_to_amplitude_series(input_file, channels='left', start_time=p.start_time, duration=p.duration, target_volume=p.target_volume, dtype=np.float32 if p.compact else np.float64))))
+
+    def apply_filter():
+        amplitudes, frame_rate = decoded['amplitudes'], decoded['frame_rate'].item()
+        if p.filter_active:
+            amplitudes, frame_rate = ap.apply_low_pass_filter(amplitudes, frame_rate, cutoff_freq=p.cutoff_freq_high, downsample=True)
+        if p.limiter_active:
+            amplitudes = ap.apply_limiter(amplitudes, frame_rate, lookahead_time=p.limiter_lookahead, release_time=p.limiter_release)
+        return {'amplitudes': amplitudes, 'frame_rate': frame_rate}
+
+    filter_key = stage_key('filter', {'decode': decode_key})
+    filtered = cached('filter', filter_key, apply_filter)
+
+    # Without equalization, the filtered audio is passed through instead of being stored twice
+    equalize_key = equalize_stage_key(filter_key)
+    if p.equalization != 'none':
+        filtered = cached('equalize', equalize_key, lambda: {
+            'amplitudes': ap.apply_equalization(filtered['amplitudes'], filtered['frame_rate'].item(), p.equalization,
+                                                corner_freq=p.eq_corner_freq, curve_file=p.eq_curve_file),
+            'frame_rate': filtered['frame_rate']})
+    return filtered['amplitudes'], filtered['frame_rate'].item(), equalize_key
+
+def silent_start_stage(amplitudes: np.ndarray, frame_rate: float, equalize_key: str) -> tuple[np.ndarray, str]:
+    """
+    Add the silent start to the amplitudes.
+
+    The stage is cheap, so it is never stored, but its hash is propagated to the downstream stages.
+
+    :return: The amplitudes and the hash of the stage.
+    """
+    key = stage_key('silent_start', {'equalize': equalize_key})
+    return ap.add_silent_start(amplitudes, frame_rate, duration=p.silent_start_duration), key
+
+def engraving_stage(amplitudes: np.ndarray, frame_rate: float, silent_start_key: str) -> None:
+    """
+    Convert amplitudes to the engraving file selected by ENGRAVING_OUTPUT_TYPE.
+
+    The output files are only written if the stage hash differs from the one of the last build,
+    or if some output files are missing.
+    """
+    if p.ENGRAVING_OUTPUT_TYPE == 'gcode':
+        gcode_stage(amplitudes, frame_rate, silent_start_key)
+        return
+    if p.ENGRAVING_OUTPUT_TYPE not in ('points', 'image', 'wire', 'mesh'):
+        raise ValueError(f"Unknown engraving output type: {p.ENGRAVING_OUTPUT_TYPE}. Please choose 'gcode', 'points', 'image', 'wire' or 'mesh'.")
+
+    key = stage_key(p.ENGRAVING_OUTPUT_TYPE, {'silent_start': silent_start_key})
+    manifest = load_build_manifest()
+    outputs = expected_outputs()
+    if manifest.get('key') == key and all(os.path.exists(f) for f in outputs):
+        print(f"Stage '{p.ENGRAVING_OUTPUT_TYPE}' is up to date ({key}).")
+        return
+
+    match (p.SURFACE_TYPE, p.ENGRAVING_OUTPUT_TYPE):
+        case ('cylinder', 'points'):
+            a2e.amplitudes_to_cylinder_points(amplitudes, frame_rate)
+        case ('cylinder', 'image'):
+            a2e.amplitudes_to_cylinder_image(amplitudes, frame_rate)
+        case ('disc', 'points'):
+            a2e.amplitudes_to_disc_points(amplitudes, frame_rate)
+        case ('disc', 'image'):
+            a2e.amplitudes_to_disc_image(amplitudes, frame_rate)
+        case (_, 'wire'):
+            a2e.amplitudes_to_wire(amplitudes, frame_rate)
+        case (_, 'mesh'):
+            import mesh
+            mesh.amplitudes_to_mesh(amplitudes, frame_rate)
+    save_build_manifest({'key': key, 'outputs': outputs})
+
+def gcode_stage(amplitudes: np.ndarray, frame_rate: float, silent_start_key: str) -> None:
+    """
+    Convert amplitudes to G-code files.
+
+    The blocks of one pass are cached. If only the header parameters changed since the last build,
+    the headers of the existing files are rewritten instead of exporting the files again.
+    """
+    def compute_pass():
+        match p.SURFACE_TYPE:
+            case 'cylinder':
+                gcode_one_pass, x0, a0, length_one_pass, used_length = a2e.amplitudes_to_gcode_pass(amplitudes, frame_rate)
+            case 'disc':
+                gcode_one_pass, x0, a0, length_one_pass, used_length = a2e.amplitudes_to_disc_gcode_pass(amplitudes, frame_rate)
+        return {'gcode_one_pass': np.frombuffer(gcode_one_pass.encode(), dtype=np.uint8),
+                'x0': x0, 'a0': a0, 'length_one_pass': length_one_pass, 'used_length': used_length}
+
+    # The blocks of a disc are merged near the center depending on the feed rate
+    pass_stage = 'disc_gcode_pass' if p.SURFACE_TYPE == 'disc' else 'gcode_pass'
+    pass_key = stage_key(pass_stage, {'silent_start': silent_start_key})
+    one_pass = cached(pass_stage, pass_key, compute_pass)
+    x0, a0 = one_pass['x0'].item(), one_pass['a0'].item()
+
+    files_key = stage_key('gcode_files', {'gcode_pass': pass_key})
+    header_key = stage_key('gcode_header')
+    manifest = load_build_manifest()
+    filenames = manifest.get('outputs', [])
+    passes_depth = a2e.passes_depths()
+    gcode_one_pass = one_pass['gcode_one_pass'].tobytes().decode()
+    text = None
+    if manifest.get('gcode_files') == files_key and filenames and all(os.path.exists(f) for f in filenames):
+        if manifest.get('gcode_header') == header_key:
+            print(f"Stage 'gcode_files' is up to date ({files_key}).")
+        else:
+            full_text, _ = a2e.gcode_pass_to_text(gcode_one_pass, x0, a0)
+            exporter.rewrite_gcode_headers(filenames, a2e.gcode_chunk_headers(full_text, gcode_one_pass, x0, a0), restart.index_filename())
+    else:
+        text, passes_depth = a2e.gcode_pass_to_text(gcode_one_pass, x0, a0)
+        filenames = exporter.export_text_to_gcode(text, a2e.gcode_chunk_headers(text, gcode_one_pass, x0, a0))
+
+    # Restart index, rebuilt with the files or if its step changed
+    if (text is not None or not os.path.exists(restart.index_filename())
+            or restart.load_gcode_index(restart.index_filename())[1] != p.gcode_index_step):
+        if text is None:
+            text, _ = a2e.gcode_pass_to_text(gcode_one_pass, x0, a0)
+        restart.export_gcode_index(restart.build_gcode_index(text, gcode_one_pass, x0, a0, len(filenames)), restart.index_filename())
+
+    save_build_manifest({'gcode_files': files_key, 'gcode_header': header_key, 'outputs': filenames})
+    timing = cached('gcode_time', stage_key('gcode_time', {'gcode_pass': pass_key}),
+                    lambda: {'time_one_pass': a2e.gcode_pass_time(amplitudes, frame_rate)})
+    a2e.print_gcode_summary(passes_depth, one_pass['length_one_pass'].item(), one_pass['used_length'].item(), timing['time_one_pass'].item())
+
+def expected_outputs() -> list[str]:
+    """
+    List the files written by the converter selected by SURFACE_TYPE and ENGRAVING_OUTPUT_TYPE.
+    """
+    base = p.output_folder + p.output_filename
+    ext = ".npz" if p.path_format == 'npz' else "_files" if p.split_files else ".csv"
+    match (p.SURFACE_TYPE, p.ENGRAVING_OUTPUT_TYPE):
+        case ('cylinder', 'points'):
+            return [base + '_cyl' + ext, base + '_plan' + ext]
+        case ('disc', 'points'):
+            return [base + ext]
+        case (_, 'image'):
+            return [base + ".tiff"]
+        case (_, 'wire'):
+            return [base + '_cyl.stp', base + '_plane.dxf']
+        case (_, 'mesh'):
+            return [base + "." + p.mesh_format]
+    return []
+
+def build_manifest_filename() -> str:
+    return p.output_folder + p.output_filename + "_build.json"
+
+def load_build_manifest() -> dict:
+    """
+    Load the stage hashes and outputs of the last build of the current output file and output type.
+
+    The manifest has one record per ENGRAVING_OUTPUT_TYPE, so that building another output type
+    with the same output file name does not invalidate the others.
+    """
+    try:
+        with open(build_manifest_filename(), 'r') as f:
+            record = json.load(f).get(p.ENGRAVING_OUTPUT_TYPE, {})
+    except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+        return {}
+    return record if isinstance(record, dict) else {}    # Manifests of older versions had no records
+
+def save_build_manifest(record: dict) -> None:
+    """
+    Save the stage hashes and outputs of the current build next to the output files, keeping the records
+    of the other output types.
+    """
+    try:
+        with open(build_manifest_filename(), 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    if not isinstance(manifest, dict) or not all(isinstance(r, dict) for r in manifest.values()):
+        manifest = {}
+    manifest[p.ENGRAVING_OUTPUT_TYPE] = record
+    with open(build_manifest_filename(), 'w') as f:
+        json.dump(manifest, f, indent=4)
@@ -0,0 +1,94 @@
+"""
+Non-interactive preview of an amplitude series.
+
+The preview is rendered directly to a PNG image, without matplotlib. The waveform is the exact min/max
+of the samples of each pixel column, computed in one vectorized pass, so that single-sample peaks are shown.
+"""
+import numpy as np
+from PIL import Image
+
+
+WAVEFORM_COLOR = (200, 30, 30)
+CLIP_COLOR = (0, 0, 0)
+CLIPPED_COLOR = (255, 0, 255)
+HOTSPOT_COLOR = (255, 160, 0)
+BACKGROUND_COLOR = (255, 255, 255)
+
+
+def minmax_envelope(series: np.ndarray, nb_columns: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the min/max envelope of a series, decimated to a number of columns.
+
+    Every sample is read, so that the peaks of a single sample reach the envelope.
+
+    :param series: The series to decimate.
+    :param nb_columns: Number of columns of the envelope.
+    :return: The minimum and maximum of each column.
+    """
+    nb_columns = max(1, min(nb_columns, len(series)))
+    # First sample of each column. Columns are at least one sample wide, so the starts are increasing
+    starts = np.linspace(0, len(series), nb_columns + 1).astype(np.int64)[:-1]
+    return np.minimum.reduceat(series, starts), np.maximum.reduceat(series, starts)
+
+def column_spectrogram(series: np.ndarray, nb_columns: int, nfft: int = 512) -> np.ndarray:
+    """
+    Compute a spectrogram with one FFT of `nfft` samples per column.
+
+    :param series: The series to analyse.
+    :param nb_columns: Number of columns of the spectrogram.
+    :param nfft: Number of samples of each FFT.
+    :return: Magnitude in dB, shape (nfft//2, nb_columns), lowest frequency in the last row.
+    """
+    centers = np.linspace(0, len(series), nb_columns, endpoint=False).astype(np.int64)
+    indices = centers[:, None] + np.arange(-nfft//2, nfft//2)[None, :]
+    valid = (indices >= 0) & (indices < len(series))
+    frames = np.where(valid, series[np.clip(indices, 0, len(series) - 1)], 0.0) * np.hanning(nfft)
+    magnitude = np.abs(np.fft.rfft(frames, axis=1))[:, 1:]
+    return 20 * np.log10(magnitude.T[::-1] + 1e-9)
+
+def render_preview_png(amplitudes: np.ndarray, frame_rate: float, filename: str, hotspots: np.ndarray = None,
+                       width: int = 1600, waveform_height: int = 300, spectrogram_height: int = 256) -> None:
+    """
+    Render a decimated waveform and a spectrogram of the amplitude series to a PNG image.
+
+    The clipping limits (amplitude of ±1, i.e. ±max_amplitude/2 on the engraving) are drawn as black lines.
+    Columns containing clipped samples are drawn in magenta, and columns containing intersection hotspots
+    are marked in orange at the bottom of the waveform.
+
+    :param amplitudes: A numpy array of audio amplitude values.
+    :param frame_rate: The frame rate of the audio.
+    :param filename: Path of the PNG image.
+    :param hotspots: (Optional) Boolean array, True for samples where consecutive turns of the path are too close.
+    :param width: Width of the image [px].
+    :param waveform_height: Height of the waveform [px].
+    :param spectrogram_height: Height of the spectrogram [px].
+    """
+    y_lim = 1.2
+    low, high = minmax_envelope(amplitudes, width)
+    width = len(low)
+    image = np.empty((waveform_height + spectrogram_height, width, 3), dtype=np.uint8)
+
+    # Waveform envelope
+    waveform = image[:waveform_height]
+    waveform[:] = BACKGROUND_COLOR
+    to_row = lambda v: np.clip(np.round((1 - (v + y_lim) / (2 * y_lim)) * (waveform_height - 1)), 0, waveform_height - 1).astype(np.int64)
+    rows = np.arange(waveform_height)[:, None]
+    inside = (rows >= to_row(high)[None, :]) & (rows <= to_row(low)[None, :])
+    clipped = (np.maximum(-low, high) > 1)[None, :] & inside
+    waveform[inside] = WAVEFORM_COLOR
+    waveform[clipped] = CLIPPED_COLOR
+    for limit in (-1, 1):
+        waveform[to_row(limit), ::4] = CLIP_COLOR
+
+    # Intersection hotspots
+    if hotspots is not None and np.any(hotspots):
+        _, hot_columns = minmax_envelope(hotspots.astype(np.uint8), width)
+        waveform[-8:, hot_columns.astype(bool)] = HOTSPOT_COLOR
+
+    # Spectrogram, normalized to 80 dB of dynamic range
+    spectrogram = column_spectrogram(amplitudes, width, nfft=2*spectrogram_height)
+    spectrogram = np.clip((spectrogram - spectrogram.max() + 80) / 80, 0, 1)
+    image[waveform_height:] = (255 * (1 - spectrogram))[:, :, None].astype(np.uint8)
+
+    Image.fromarray(image).save(filename, format="PNG")
+    print(f"Preview of {round(len(amplitudes)/frame_rate, 3)} s exported to {filename}")
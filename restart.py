@@ -0,0 +1,184 @@
+"""
+Restart index of the G-code files, and generation of programs restarting from any point of the engraving.
+
+The index is written next to the G-code files (*_index.npz) when they are exported, with the step it was built
+with. It has one entry every `gcode_index_step` blocks of each pass, with the file, line and byte offset of the block,
+its two axes (`gcode_axes`: X and A on a cylinder, X and C or X and Y on a disc), and the depth of the pass. It is
+computed from the layout of the passes, without scanning the text.
+
+A restart program is the INITIAL_GCODE approach at the position and depth of an index entry, followed by the
+rest of the G-code file from the byte offset of the entry. The original files are neither rescanned nor regenerated.
+"""
+import os
+import shutil
+import numpy as np
+
+import amp2engraving as a2e
+import exporter
+from parameters import default_parameters as p
+
+
+# Passes, turns, blocks, files and lines are numbered from 1. The offset points to the newline before the block.
+# x and a are the two axes of the block, angle is its angle around the axis of the surface [°].
+GCODE_INDEX_DTYPE = np.dtype([('pass', np.int16), ('turn', np.int32), ('angle', np.float32), ('block', np.int64),
+                              ('file', np.int16), ('line', np.int64), ('offset', np.int64),
+                              ('x', np.float64), ('a', np.float64), ('depth', np.float32)])
+
+
+def index_filename() -> str:
+    return p.output_folder + p.output_filename + "_index.npz"
+
+def block_angle(x: np.ndarray, a: np.ndarray) -> np.ndarray:
+    """
+    Angle of blocks around the axis of the surface [°], from their two axes: A or C, or the polar angle of X and Y.
+    """
+    return np.rad2deg(np.arctan2(a, x)) % 360 if p.gcode_axes[1] == 'Y' else a
+
+def build_gcode_index(text: str, gcode_one_pass: str, x0: float, a0: float, nb_files: int) -> np.ndarray:
+    """
+    Build the restart index of the G-code files exported from a text.
+
+    Parameters
+    ----------
+    text : str
+        G-code of all passes, from `amp2engraving.gcode_pass_to_text`.
+    gcode_one_pass : str
+        G-code blocks of one pass.
+    x0 : float
+        X of the first block.
+    a0 : float
+        Second axis (A, C or Y) of the first block.
+    nb_files : int
+        Number of exported files, to check that the index matches them.
+
+    Returns
+    -------
+    Index entries, structured array of GCODE_INDEX_DTYPE, sorted by pass and block.
+    """
+    # Blocks of one pass, sampled every gcode_index_step blocks. Each block is "\n<first><x><second><a>".
+    first, second = p.gcode_axes
+    newlines = np.flatnonzero(np.frombuffer(gcode_one_pass.encode(), dtype=np.uint8) == ord('\n'))
+    sampled = np.arange(0, len(newlines), max(p.gcode_index_step, 1))
+    line_ends = np.append(newlines[1:], len(gcode_one_pass))
+    x, a = np.array([gcode_one_pass[newlines[j]+1+len(first):line_ends[j]].split(second) for j in sampled], dtype=float).reshape(-1, 2).T
+    # A new turn starts where the angle wraps around
+    angle = block_angle(x, a)
+    turn = 1 + np.concatenate([[0], np.cumsum(np.abs(np.diff(angle)) > 180)])
+
+    sequences, passes_depth = a2e.depth_change_sequences(x0, a0)
+    depths = p.start_depth + np.cumsum(passes_depth)
+    pass_starts = np.cumsum([0] + [len(s) + len(gcode_one_pass) for s in sequences])
+    pass_newlines = np.cumsum([0] + [s.count('\n') + len(newlines) for s in sequences])
+
+    def newlines_before(pos: np.ndarray) -> np.ndarray:
+        # Number of newlines of the text before positions, from the layout of the passes
+        pos = np.asarray(pos)
+        i = np.clip(np.searchsorted(pass_starts, pos, side='right') - 1, 0, len(sequences) - 1)
+        within = pos - pass_starts[i]
+        seq_len = np.array([len(s) for s in sequences])[i]
+        in_sequence = [sequences[k].count('\n', 0, w) for k, w in zip(i.tolist(), np.minimum(within, seq_len).tolist())]
+        return pass_newlines[i] + in_sequence + np.searchsorted(newlines, np.maximum(within - seq_len, 0), side='left')
+
+    bounds = np.array(exporter.gcode_chunk_bounds(text))
+    if len(bounds) != nb_files:
+        raise ValueError(f"The text is split in {len(bounds)} files, but {nb_files} files were exported.")
+    headers = a2e.gcode_chunk_headers(text, gcode_one_pass, x0, a0)
+    header_bytes = np.array([len(h.encode()) for h in headers])
+    header_newlines = np.array([h.count('\n') for h in headers])
+    chunk_newlines = newlines_before(bounds[:, 0])
+    newline_extra = len(os.linesep) - 1    # Text files are written with the newlines of the platform
+
+    index = np.zeros(len(sequences) * len(sampled), dtype=GCODE_INDEX_DTYPE)
+    for i, sequence in enumerate(sequences):
+        entries = index[i*len(sampled):(i+1)*len(sampled)]
+        pos = pass_starts[i] + len(sequence) + newlines[sampled]
+        chunk = np.searchsorted(bounds[:, 0], pos, side='right') - 1
+        newlines_in_chunk = newlines_before(pos) - chunk_newlines[chunk]
+        entries['pass'], entries['turn'], entries['angle'], entries['block'] = i+1, turn, angle, sampled+1
+        entries['file'] = chunk + 1
+        entries['line'] = header_newlines[chunk] + newlines_in_chunk + 2
+        entries['offset'] = header_bytes[chunk] + pos - bounds[chunk, 0] + newline_extra * (header_newlines[chunk] + newlines_in_chunk)
+        entries['x'], entries['a'], entries['depth'] = x, a, depths[i]
+    return index
+
+def export_gcode_index(index: np.ndarray, filename: str) -> None:
+    """
+    Write the index entries and the `gcode_index_step` they were sampled with.
+    """
+    exporter.write_file(filename, lambda f: np.savez(f, entries=index, step=p.gcode_index_step))
+    print(f"Restart index exported to {filename} ({len(index)} entries)")
+
+def load_gcode_index(filename: str) -> tuple[np.ndarray, int]:
+    """
+    Read a restart index.
+
+    :return: The index entries and the number of blocks between two entries of a pass.
+    """
+    with np.load(filename) as data:
+        return data['entries'], int(data['step'])
+
+def restart_entry(index: np.ndarray, pass_number: int, turn: int = 1, angle: float = None) -> np.void:
+    """
+    Last index entry at or before a position of the engraving, so that no block is skipped.
+
+    :param pass_number: Pass of the engraving, from 1.
+    :param turn: Turn of the pass, from 1.
+    :param angle: Angle of the position [°]: A on a cylinder, C or the polar angle of X and Y on a disc. Default is the start of the turn.
+    """
+    entries = index[(index['pass'] == pass_number) & (index['turn'] == turn)]
+    if len(entries) == 0:
+        raise ValueError(f"No index entry for pass {pass_number}, turn {turn}. The engraving has {index['pass'].max()} passes "
+                         f"of {index['turn'].max()} turns.")
+    if angle is None:
+        return entries[0]
+    # Progress in the turn, in the direction of rotation. The spiral of a disc turns towards positive angles.
+    direction = -1 if p.right_thread and p.SURFACE_TYPE == 'cylinder' else 1
+    angles = block_angle(entries['x'], entries['a'])
+    progress = ((angles - angles[0]) * direction) % 360
+    target = ((angle - angles[0]) * direction) % 360
+    return entries[max(np.searchsorted(progress, target, side='right') - 1, 0)]
+
+def restart_entry_at_line(index: np.ndarray, file_number: int, line: int) -> np.void:
+    """
+    Last index entry at or before a line of a G-code file, as displayed by the machine.
+
+    :param file_number: G-code file, from 1.
+    :param line: Line of the file, from 1.
+    """
+    entries = index[(index['file'] == file_number) & (index['line'] <= line)]
+    if len(entries) == 0:
+        raise ValueError(f"No index entry before line {line} of file {file_number}.")
+    return entries[-1]
+
+def export_restart_gcode(entry: np.void, filename: str = None) -> str:
+    """
+    Write a program restarting the engraving at an index entry.
+
+    The tool approaches the position of the entry at the depth of its pass, then the blocks of the original
+    file are copied from the entry to the end of the file. The following files of the engraving are unchanged.
+
+    :param entry: Index entry, from `restart_entry` or `restart_entry_at_line`.
+    :param filename: Output file. Default is <output>_restart_<pass>_<block>.<file_format>.
+    :return: The name of the restart program.
+    """
+    source = exporter.gcode_filename(int(entry['file']))
+    filename = filename or p.output_folder + p.output_filename + f"_restart_{entry['pass']}_{entry['block']}." + p.file_format
+    first, second = p.gcode_axes
+    header = p.INITIAL_GCODE(str(entry['x']), str(entry['a']), f"restart pass {entry['pass']} turn {entry['turn']}", depth=float(entry['depth']))
+
+    with open(source, 'rb') as src:
+        src.seek(int(entry['offset']))
+        src.readline()
+        block = src.readline()
+        if block.strip() != f"{first}{entry['x']}{second}{entry['a']}".encode():
+            raise ValueError(f"The restart index does not match {source} (found {block.strip()[:40]} at byte {entry['offset']}). "
+                             "Export the G-code files again.")
+        src.seek(int(entry['offset']))
+
+        def write(f):
+            f.write(header.replace('\n', os.linesep).encode())
+            shutil.copyfileobj(src, f, 16*1024*1024)
+        exporter.write_file(filename, write)
+    print(f"Restart program exported to {filename}: pass {entry['pass']}, turn {entry['turn']}, block {entry['block']} "
+          f"(line {entry['line']} of {source}), {first}{entry['x']} {second}{entry['a']} at depth {round(float(entry['depth'])*1e3)} um")
+    return filename
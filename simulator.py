@@ -0,0 +1,198 @@
+"""
+Fast 2.5D simulation of the engraved groove, used to check an engraving before cutting it.
+
+The surface is represented as a heightfield in the (angle, lateral) frame of the engraving, where lateral
+is the elevation along the axis for a cylinder and the radius for a disc. Each path sample is a column of the
+heightfield, sampled across the groove. The V-tool of every pass is stamped in the column for the current turn
+and its neighbours, then a virtual spherical stylus is settled in the groove to recover the audio.
+"""
+from math import pi, asin, tan, radians, sqrt
+import numpy as np
+
+import amp2engraving as a2e
+import geometry as g
+from parameters import default_parameters as p
+
+
+def check_parameters() -> None:
+    """
+    Reject the parameters the simulation does not support, before the audio is decoded.
+
+    The grooves of the neighbouring turns are found a constant number of samples away, which is not the case
+    on a disc read at constant linear velocity.
+    """
+    if p.SURFACE_TYPE == 'disc' and p.disc_speed == 'linear':
+        raise ValueError("The simulation needs a constant number of samples per turn, which a disc at constant linear "
+                         "velocity does not have. Use disc_speed = 'angular'.")
+
+def groove_lateral(amplitudes: np.ndarray, frame_rate: float) -> tuple[np.ndarray, np.ndarray, float]:
+    """
+    Compute the lateral position of the groove for each sample, as done by the converters of amp2engraving.
+
+    The path is truncated where it reaches the end of the cylinder or the center of the disc.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    Lateral position of the groove [mm], lateral position without audio [mm] and number of samples per turn.
+    In compact mode, the lateral positions are `geometry.TurnSeries`.
+    """
+    check_parameters()
+    if p.SURFACE_TYPE == 'disc':
+        dphase = 2 * asin(p.speed_angular/(2*frame_rate))
+        lateral, _, nb_points = a2e.disc_path(amplitudes, frame_rate)
+    else:
+        dphase = p.speed_angular/frame_rate
+        _, lateral, nb_points = a2e.cylinder_path(amplitudes, np.arange(len(amplitudes)) * dphase)
+    nominal = lateral - amplitudes*p.max_amplitude/2
+    lateral, nominal = lateral[:nb_points], nominal[:nb_points]
+    if p.compact:
+        lateral, nominal = g.TurnSeries.from_series(lateral, 2*pi/dphase), g.TurnSeries.from_series(nominal, 2*pi/dphase)
+    return lateral, nominal, 2*pi/dphase
+
+def pass_depths(nb_passes: int = None) -> list[float]:
+    """
+    Total depth of the groove after each pass.
+
+    :param nb_passes: Number of passes to keep. Default is all passes.
+    """
+    depths = np.cumsum(a2e.passes_depths()) + p.start_depth
+    return list(depths[:nb_passes])
+
+def stamp_groove(lateral: np.ndarray, pts_per_turn: float, start: int, end: int, offsets: np.ndarray, depths: list[float]) -> np.ndarray:
+    """
+    Stamp the V-tool in the heightfield columns of samples start to end.
+
+    The columns are centered on the groove of the current turn. The grooves of the previous and next turns
+    are stamped as well, so that intersections between turns are simulated. All passes follow the same path,
+    so the groove left by the passes is the one of the deepest pass.
+
+    Parameters
+    ----------
+    lateral : np.ndarray or TurnSeries
+        Lateral position of the groove for all samples [mm].
+    pts_per_turn : float
+        Number of samples per turn.
+    start, end : int
+        Range of samples whose columns are computed.
+    offsets : np.ndarray
+        Lateral position of the heightfield rows, relative to the groove of the column [mm].
+    depths : list[float]
+        Total depth of the groove after each pass [mm].
+
+    Returns
+    -------
+    Heightfield relative to the surface [mm], shape (end - start, len(offsets)). Negative values are engraved.
+    """
+    idx = np.arange(start, end)
+    y = (lateral[start:end, None] + offsets[None, :]).astype(np.float32)
+    heights = np.zeros(y.shape, dtype=np.float32)
+    tool = np.empty(y.shape, dtype=np.float32)
+    slope = 1 / tan(radians(p.angle/2))
+    for shift in (-pts_per_turn, 0, pts_per_turn):
+        # Samples without a neighbouring turn are moved infinitely far away
+        centers = g.interp_samples(lateral, idx + shift, left=np.inf, right=np.inf).astype(np.float32)
+        np.subtract(y, centers[:, None], out=tool)
+        np.abs(tool, out=tool)
+        tool *= slope
+        tool -= max(depths)
+        np.minimum(heights, tool, out=heights)
+    return np.minimum(heights, 0, out=heights)
+
+def settle_stylus(heights: np.ndarray, resolution: float, stylus_radius: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the resting position of a spherical stylus in each column of the heightfield.
+
+    The height of the stylus center at a position is the highest contact with the surface under the sphere.
+    The stylus rests where this height is the lowest.
+
+    :param heights: Heightfield, shape (nb_columns, nb_rows).
+    :param resolution: Distance between two rows [mm].
+    :param stylus_radius: Radius of the stylus tip [mm].
+    :return: Resting row of the stylus (with sub-row interpolation) and height of its center [mm], for each column.
+    """
+    K = int(stylus_radius / resolution)
+    nb_rows = heights.shape[1]
+    if nb_rows <= 2*K + 2:
+        raise ValueError(f"Heightfield is too narrow ({nb_rows} rows) for a stylus of {stylus_radius} mm.")
+
+    center_height = np.full((heights.shape[0], nb_rows - 2*K), -np.inf, dtype=np.float32)
+    contact = np.empty_like(center_height)
+    for k in range(-K, K+1):
+        sphere = sqrt(max(stylus_radius**2 - (k*resolution)**2, 0))
+        np.add(heights[:, K+k:nb_rows-K+k], sphere, out=contact)
+        np.maximum(center_height, contact, out=center_height)
+
+    # Lowest position, refined with a parabola through the neighbouring rows
+    row = np.clip(np.argmin(center_height, axis=1), 1, center_height.shape[1] - 2)
+    cols = np.arange(len(row))
+    c_prev, c_mid, c_next = center_height[cols, row-1], center_height[cols, row], center_height[cols, row+1]
+    curvature = c_prev - 2*c_mid + c_next
+    shift = np.where(curvature > 0, 0.5 * (c_prev - c_next) / np.where(curvature > 0, curvature, 1), 0)
+    return row + K + np.clip(shift, -1, 1), c_mid
+
+def simulate_playback(amplitudes: np.ndarray, frame_rate: float, nb_passes: int = None, chunk_size: int = None) -> np.ndarray:
+    """
+    Simulate the engraving of the amplitudes and the playback by a stylus.
+
+    The stylus radius and the lateral resolution of the heightfield are defined by `stylus_radius`
+    and `sim_resolution` in the `parameters.py` file.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes, including the silent start.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+    nb_passes : int
+        Number of passes to engrave. Default is all passes.
+    chunk_size : int
+        Number of heightfield columns computed at once. It bounds the memory usage.
+        Default is 16384, or 4096 in compact mode.
+
+    Returns
+    -------
+    Amplitudes read by the stylus, with the same scale as the input amplitudes.
+    """
+    lateral, nominal, pts_per_turn = groove_lateral(amplitudes, frame_rate)
+    chunk_size = chunk_size or (4096 if p.compact else 16384)
+    depths = pass_depths(nb_passes)
+    half_width = p.width/2 + 2*p.stylus_radius + 2*p.sim_resolution
+    nb_rows_half = int(np.ceil(half_width / p.sim_resolution))
+    offsets = np.arange(-nb_rows_half, nb_rows_half+1) * p.sim_resolution
+
+    recovered = np.empty(len(lateral))
+    for start in range(0, len(lateral), chunk_size):
+        end = min(start + chunk_size, len(lateral))
+        heights = stamp_groove(lateral, pts_per_turn, start, end, offsets, depths)
+        rows, _ = settle_stylus(heights, p.sim_resolution, p.stylus_radius)
+        stylus_lateral = lateral[start:end] + offsets[0] + rows * p.sim_resolution
+        recovered[start:end] = (stylus_lateral - nominal[start:end]) / (p.max_amplitude/2)
+
+    error = recovered - amplitudes[:len(recovered)]
+    print(f"Simulated {len(recovered)}/{len(amplitudes)} samples with {len(depths)} passes (depth {round(depths[-1]*1e3, 1)} um).")
+    print(f"Playback error: RMS {np.sqrt(np.mean(error**2)):.2e}, max {np.max(np.abs(error)):.2e} (full scale = 1).")
+    return recovered
+
+def simulate_to_audio(amplitudes: np.ndarray, frame_rate: float, filename: str, nb_passes: int = None) -> np.ndarray:
+    """
+    Simulate the engraving and the playback, and export the recovered audio.
+
+    :param amplitudes: Array of sound amplitudes, including the silent start.
+    :param frame_rate: Frame rate of the audio signal in Hz.
+    :param filename: Output audio file. The format (e.g. wav or mp3) is given by the extension.
+    :param nb_passes: Number of passes to engrave. Default is all passes.
+    :return: Amplitudes read by the stylus.
+    """
+    import audio_processor as ap
+
+    recovered = simulate_playback(amplitudes, frame_rate, nb_passes)
+    ap.export_to_mp3(np.clip(recovered, -1, 1 - 2**-15), int(frame_rate), 2, 1, filename, format=filename.split('.')[-1])
+    print(f"Simulated playback exported to {filename}")
+    return recovered
@@ -0,0 +1,181 @@
+"""
+Split long recordings on several cylinders, discs or disc sides.
+
+The capacity of one surface is the number of samples the path can hold before the end of the cylinder or the
+center of the disc, including the silent start of the part. Each part is cut at the quietest point shortly before
+its capacity, gets its own silent start, and is engraved in a separate process. A manifest lists the audio time
+range and the output files of each part.
+"""
+import json
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import attrs
+import numpy as np
+
+import audio_processor as ap
+import amp2engraving as a2e
+import pipeline
+from parameters import ParameterSet, default_parameters as p
+
+
+QUIET_WINDOW = 0.010  # Duration over which the loudness is averaged to find a quiet cut point [s]
+
+
+@attrs.define
+class Part:
+    index:              int
+    surface:            str         # Label of the engraved surface, e.g. 'cylinder 2' or 'disc 1 side B'
+    start:              int         # First sample of the part in the audio (without silent start)
+    end:                int         # Sample after the last one
+    frame_rate:         float
+    output_filename:    str
+    outputs:            list[str] = attrs.field(factory=list)
+
+    @property
+    def start_time(self) -> float:
+        return self.start / self.frame_rate
+
+    @property
+    def end_time(self) -> float:
+        return self.end / self.frame_rate
+
+
+def surface_capacity(nb_samples: int, frame_rate: float, peak_amplitude: float) -> int:
+    """
+    Number of samples fitting on one surface, silent start included.
+
+    The path is computed with a constant amplitude equal to the peak of the audio, towards the end of the
+    cylinder or the center of the disc, so that any part of the audio fits in this number of samples.
+
+    :param nb_samples: Number of samples needed for the whole audio. The capacity is at most this number.
+    :param frame_rate: Frame rate of the audio signal in Hz.
+    :param peak_amplitude: Largest absolute amplitude of the audio.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if p.SURFACE_TYPE == 'disc':
+            _, _, capacity = a2e.disc_path(np.full(nb_samples, -peak_amplitude), frame_rate)
+        else:
+            _, _, capacity = a2e.cylinder_path(np.full(nb_samples, peak_amplitude), np.arange(nb_samples) * p.speed_angular/frame_rate)
+    return capacity
+
+def quiet_cut(amplitudes: np.ndarray, frame_rate: float, earliest: int, latest: int) -> int:
+    """
+    Sample between earliest and latest where the audio is the quietest, averaged over QUIET_WINDOW.
+    """
+    window = max(int(QUIET_WINDOW * frame_rate), 1)
+    segment = np.asarray(amplitudes[max(earliest - window, 0):latest], dtype=float)
+    energy = np.concatenate([[0.0], np.cumsum(segment**2)])
+    loudness = energy[window:] - energy[:-window]
+    # loudness[i] is the energy of the window ending at sample max(earliest - window, 0) + i + window
+    ends = max(earliest - window, 0) + window + np.arange(len(loudness))
+    candidates = ends >= earliest
+    if not np.any(candidates):
+        return latest
+    return int(ends[candidates][np.argmin(loudness[candidates])])
+
+def split_parts(amplitudes: np.ndarray, frame_rate: float) -> list[Part]:
+    """
+    Cut the audio into parts fitting on one surface each.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes, without silent start.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+
+    Returns
+    -------
+    List of parts, in the order of the audio.
+    """
+    silent_samples = int(frame_rate * p.silent_start_duration)
+    peak = float(np.max(np.abs(amplitudes), initial=0))
+    capacity = surface_capacity(len(amplitudes) + silent_samples, frame_rate, peak) - silent_samples
+    if capacity <= 0:
+        raise ValueError(f"The surface cannot hold more than the silent start ({p.silent_start_duration} s).")
+    search = int(p.split_search_duration * frame_rate)
+
+    cuts = [0]
+    while len(amplitudes) - cuts[-1] > capacity:
+        latest = cuts[-1] + capacity
+        cuts.append(quiet_cut(amplitudes, frame_rate, max(latest - search, cuts[-1] + 1), latest))
+    cuts.append(len(amplitudes))
+
+    parts = []
+    for i, (start, end) in enumerate(zip(cuts[:-1], cuts[1:])):
+        if p.SURFACE_TYPE == 'disc' and p.disc_sides == 2:
+            surface = f"disc {i//2 + 1} side {'AB'[i % 2]}"
+        else:
+            surface = f"{p.SURFACE_TYPE} {i + 1}"
+        parts.append(Part(i, surface, start, end, frame_rate, f"{p.output_filename}_part{i + 1:02d}"))
+    nb_surfaces = -(-len(parts) // p.disc_sides) if p.SURFACE_TYPE == 'disc' else len(parts)
+    print(f"Audio of {len(amplitudes)/frame_rate:.1f} s needs {len(parts)} parts on {nb_surfaces} {p.SURFACE_TYPE}(s), "
+          f"at most {capacity/frame_rate:.1f} s per part.")
+    return parts
+
+def engrave_part(parameters: dict, part: Part, amplitudes: np.ndarray, key: str) -> list[str]:
+    """
+    Engrave one part, in a worker process.
+
+    :param parameters: Initialized fields of the shared parameters.
+    :param part: Part to engrave.
+    :param amplitudes: Amplitudes of the part, without silent start.
+    :param key: Hash of the part, used as the silent start stage hash.
+    :return: Output files of the part.
+    """
+    p.update(**parameters)
+    p.output_filename = part.output_filename
+    print("-"*10 + f" Part {part.index + 1}: {part.surface}, {part.start_time:.2f}-{part.end_time:.2f} s " + "-"*10)
+    amplitudes = ap.add_silent_start(amplitudes, part.frame_rate, duration=p.silent_start_duration)
+    pipeline.engraving_stage(amplitudes, part.frame_rate, key)
+    p.export_parameters_to_txt()
+    return pipeline.load_build_manifest().get('outputs', [])
+
+def split_and_engrave(amplitudes: np.ndarray, frame_rate: float, audio_key: str) -> list[Part]:
+    """
+    Split the audio into parts and engrave them in parallel, then write the manifest of the parts.
+
+    Parameters
+    ----------
+    amplitudes : np.ndarray
+        Array of sound amplitudes, without silent start.
+    frame_rate : float
+        Frame rate of the audio signal in Hz.
+    audio_key : str
+        Hash of the equalize stage, from `pipeline.audio_stage`.
+
+    Returns
+    -------
+    List of the engraved parts, with their output files.
+    """
+    parts = split_parts(amplitudes, frame_rate)
+    parameters = {f.name: getattr(p, f.name) for f in attrs.fields(ParameterSet) if f.init}
+    os.makedirs(p.output_folder, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=p.split_workers or None) as pool:
+        futures = [pool.submit(engrave_part, parameters, part, amplitudes[part.start:part.end],
+                               pipeline.stage_key('silent_start', {'equalize': audio_key}, extra=f"part {part.start}-{part.end}"))
+                   for part in parts]
+        for part, future in zip(parts, futures):
+            part.outputs = future.result()
+
+    export_manifest(parts, p.output_folder + p.output_filename + "_split.json")
+    return parts
+
+def export_manifest(parts: list[Part], filename: str) -> None:
+    """
+    Write the audio time range, the surface and the output files of each part to a JSON file.
+    """
+    manifest = {
+        'input_filename': p.input_filename,
+        'surface_type': p.SURFACE_TYPE,
+        'output_type': p.ENGRAVING_OUTPUT_TYPE,
+        'silent_start_duration': p.silent_start_duration,
+        'parts': [{'part': part.index + 1, 'surface': part.surface,
+                   'start_time': p.start_time + part.start_time, 'end_time': p.start_time + part.end_time,
+                   'output_filename': part.output_filename, 'outputs': part.outputs} for part in parts],
+    }
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    print(f"Split manifest exported to {filename}")
@@ -0,0 +1,35 @@
+import os
+import sys
+import warnings
+
+import attrs
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parameters import ParameterSet, default_parameters as p
+
+
+@pytest.fixture(autouse=True)
+def parameters(tmp_path, monkeypatch):
+    """
+    Shared parameters writing to a temporary folder, restored after the test.
+    """
+    snapshot = {f.name: getattr(p, f.name) for f in attrs.fields(ParameterSet) if f.init}
+    monkeypatch.chdir(tmp_path)
+    p.update(output_folder=str(tmp_path) + os.sep, cache_folder=str(tmp_path / "cache") + os.sep)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield p
+    p.update(**snapshot)
+
+
+@pytest.fixture
+def amplitudes():
+    """
+    20 s of smooth random audio at 8 kHz.
+    """
+    rng = np.random.default_rng(0)
+    frame_rate = 8000
+    return np.clip(np.cumsum(rng.normal(0, 0.05, frame_rate*20)) * 0.05, -1, 1), frame_rate
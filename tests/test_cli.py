@@ -0,0 +1,65 @@
+import argparse
+import json
+
+import attrs
+import pytest
+
+import cli
+from parameters import ParameterSet, default_parameters as p
+
+
+def write_params(tmp_path, **changes):
+    p.update(**changes)
+    p.export_parameters_to_txt()
+    return p.output_folder + p.output_filename + "_parameters.txt"
+
+def parse_args(*argv):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    cli.add_parameter_arguments(subparsers.add_parser('gcode'))
+    return parser.parse_args(argv)
+
+def test_parameters_round_trip(tmp_path):
+    filename = write_params(tmp_path, pitch=0.4, SURFACE_TYPE='disc', tool_number=7)
+    loaded = ParameterSet.load_txt(filename)
+    assert attrs.asdict(loaded) == attrs.asdict(p)
+
+def test_integer_is_accepted_for_float(tmp_path):
+    filename = tmp_path / "params.txt"
+    filename.write_text(json.dumps({'pitch': 1}))
+    loaded = ParameterSet.load_txt(str(filename))
+    assert loaded.pitch == 1.0 and isinstance(loaded.pitch, float)
+
+@pytest.mark.parametrize('content, message', [
+    ({'pich': 0.4}, "Unknown parameters: pich"),
+    ({'pitch': "0.4"}, "Invalid value '0.4' for pitch"),
+    ({'tool_number': 1.5}, "Invalid value 1.5 for tool_number"),
+    ({'SURFACE_TYPE': 'cone'}, "Invalid value 'cone' for SURFACE_TYPE"),
+    ({'right_thread': 1}, "Invalid value 1 for right_thread"),
+    ([0.4], "JSON object"),
+])
+def test_invalid_parameters_are_rejected(tmp_path, content, message):
+    filename = tmp_path / "params.txt"
+    filename.write_text(json.dumps(content))
+    with pytest.raises(ValueError, match=message):
+        ParameterSet.load_txt(str(filename))
+
+@pytest.mark.parametrize('content', ["{'pitch': 0.4", json.dumps({'pich': 0.4}), json.dumps({'pitch': 'wide'})])
+def test_cli_stops_on_invalid_params_file(tmp_path, content):
+    filename = tmp_path / "params.txt"
+    filename.write_text(content)
+    pitch = p.pitch
+    with pytest.raises(SystemExit) as exit_info:
+        cli.main(['verify', '--params', str(filename)])
+    assert str(filename) in str(exit_info.value.code)
+    assert p.pitch == pitch
+
+def test_cli_stops_on_missing_params_file(tmp_path):
+    with pytest.raises(SystemExit, match="not found"):
+        cli.main(['gcode', '--params', str(tmp_path / "missing.txt")])
+
+def test_cli_overrides_params_file(tmp_path):
+    filename = write_params(tmp_path, pitch=0.4, tool_number=7)
+    p.update(pitch=1.0, tool_number=1)
+    cli.apply_parameters(parse_args('gcode', '--params', filename, '--tool_number', '3'))
+    assert p.pitch == 0.4 and p.tool_number == 3 and p.ENGRAVING_OUTPUT_TYPE == 'gcode'
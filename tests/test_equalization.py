@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import audio_processor as ap
+
+
+def gain_db(freqs, curve, **kwargs):
+    return 20 * np.log10(np.abs(ap.equalization_response(np.asarray(freqs, dtype=float), curve, **kwargs)))
+
+@pytest.mark.parametrize('curve', ['displacement', 'riaa', 'custom'])
+def test_response_is_normalized_at_reference(curve):
+    points = np.array([[20.0, -10.0], [1000.0, 3.0], [20000.0, 6.0]])
+    assert gain_db([ap.EQ_REFERENCE_FREQ], curve, curve_points=points)[0] == pytest.approx(0, abs=1e-9)
+
+def test_riaa_response():
+    # RIAA recording curve: -19.3 dB at 20 Hz, +19.6 dB at 20 kHz, less the 3.18 us pole
+    low, high = gain_db([20.0, 20000.0], 'riaa')
+    assert low == pytest.approx(-19.27, abs=0.05)
+    assert high == pytest.approx(19.0, abs=0.1)
+
+def test_displacement_response():
+    # Integrated twice above the corner frequency (-12 dB per octave), flat below
+    gains = gain_db([1.0, 2.0, 2000.0, 4000.0], 'displacement', corner_freq=20.0)
+    assert gains[0] - gains[1] == pytest.approx(0, abs=0.1)
+    assert gains[2] - gains[3] == pytest.approx(12.04, abs=0.01)
+
+def test_custom_response_follows_points():
+    points = np.array([[20.0, -10.0], [1000.0, 3.0], [20000.0, 6.0]])
+    gains = gain_db([10.0, 20.0, 20000.0, 30000.0], 'custom', curve_points=points) + 3.0
+    np.testing.assert_allclose(gains, [-10.0, -10.0, 6.0, 6.0], atol=1e-9)
+
+def test_overlap_add_matches_convolution():
+    rng = np.random.default_rng(0)
+    signal, fir = rng.normal(size=10000), rng.normal(size=300)
+    sizes = [1200, 1200, 7, 1200, 1193, 1200, 1200, 1200, 1200, 400]
+    blocks = np.split(signal, np.cumsum(sizes)[:-1])
+    convolved = np.concatenate(list(ap.overlap_add_blocks(blocks, fir, 1200)))
+    np.testing.assert_allclose(convolved, np.convolve(signal, fir), atol=1e-9)
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_equalization_matches_convolution(dtype):
+    frame_rate = 8000
+    amplitudes = np.random.default_rng(0).normal(0, 0.1, 3*frame_rate).astype(dtype)
+    equalized = ap.apply_equalization(amplitudes, frame_rate, 'riaa', normalize=False)
+    fir, delay = ap.equalization_fir(frame_rate, 'riaa')
+    expected = np.convolve(amplitudes.astype(np.float64), fir)[delay:delay + len(amplitudes)]
+    assert equalized.dtype == dtype
+    np.testing.assert_allclose(equalized, expected, atol=1e-9 if dtype == np.float64 else 1e-5)
+
+    normalized = ap.apply_equalization(amplitudes, frame_rate, 'riaa')
+    assert np.max(np.abs(normalized)) == pytest.approx(np.max(np.abs(amplitudes)), rel=1e-6)
+
+def test_fir_matches_response():
+    frame_rate = 8000
+    fir, delay = ap.equalization_fir(frame_rate, 'displacement', corner_freq=20.0)
+    freqs = np.array([100.0, 500.0, 1000.0, 3000.0])
+    response = np.abs(np.exp(-2j*np.pi*np.outer(freqs, np.arange(len(fir))) / frame_rate) @ fir)
+    np.testing.assert_allclose(20*np.log10(response), gain_db(freqs, 'displacement', corner_freq=20.0), atol=0.1)
+
+@pytest.mark.parametrize('downsample', [False, True])
+def test_compact_audio_stays_float32(downsample):
+    frame_rate = 8000
+    amplitudes = np.random.default_rng(0).normal(0, 0.1, 2*frame_rate).astype(np.float32)
+    filtered, frame_rate = ap.apply_low_pass_filter(amplitudes, frame_rate, 1000, downsample)
+    limited = ap.apply_limiter(filtered, frame_rate, threshold=0.05)
+    equalized = ap.apply_equalization(limited, frame_rate, 'displacement')
+    assert ap.add_silent_start(equalized, frame_rate, 0.1).dtype == np.float32
+    reference, _ = ap.apply_low_pass_filter(amplitudes.astype(np.float64), 8000, 1000, downsample)
+    np.testing.assert_allclose(filtered, reference, atol=1e-6)
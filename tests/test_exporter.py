@@ -0,0 +1,60 @@
+import glob
+import gzip
+import lzma
+import os
+
+import numpy as np
+import pytest
+
+import exporter
+import geometry as g
+from parameters import default_parameters as p
+
+
+def spiral(nb_turns=3, pts_per_turn=1000):
+    phase = np.arange(nb_turns * pts_per_turn) * 2*np.pi / pts_per_turn
+    return np.stack([np.full(len(phase), p.R), phase, 5 + phase / (2*np.pi) * p.pitch], axis=-1)
+
+def test_npz_chunks_match_csv_files(tmp_path):
+    path = spiral()
+    base = str(tmp_path / "path")
+    exporter.export_path_to_csv(path, base, files_per_turn=4)
+    filename = exporter.export_path_to_npz(path, base, files_per_turn=4)
+    chunks, header = exporter.load_path_from_npz(filename)
+
+    csv_files = sorted(glob.glob(base + "_files/*.csv"))
+    # The CSV files are the complete quarter turns, the last chunk of the npz file ends with the path
+    assert len(csv_files) == 11 and len(chunks) == 12
+    np.testing.assert_allclose(chunks[-1][-1], g.cyl2cart_points(path[-1:])[0], atol=1e-5)
+    for chunk, csv_file in zip(chunks, csv_files):
+        np.testing.assert_allclose(chunk, np.loadtxt(csv_file, delimiter=',') * 1000, atol=1e-5)
+    # Consecutive chunks have 2 points in common
+    for previous, chunk in zip(chunks, chunks[1:]):
+        np.testing.assert_array_equal(previous[-2:], chunk[:2])
+    assert header['frame'] == 'cartesian' and header['parameters']['pitch'] == p.pitch
+
+def test_npz_single_chunk(tmp_path):
+    path = spiral(1)
+    chunks, _ = exporter.load_path_from_npz(exporter.export_path_to_npz(path, str(tmp_path / "path.csv"), split_files=False))
+    assert len(chunks) == 1
+    np.testing.assert_allclose(chunks[0], g.cyl2cart_points(path), atol=1e-5)
+
+@pytest.mark.parametrize('compression, open_archive', [('gzip', gzip.open), ('xz', lzma.open)])
+def test_background_writer_archives_files(tmp_path, compression, open_archive):
+    p.update(archive_folder=str(tmp_path / "archive") + os.sep)
+    contents = {f"{p.output_folder}part_{i}.txt": f"line {i}\n" * 1000 for i in range(5)}
+    with exporter.BackgroundWriter(queue_size=1, compression=compression) as writer:
+        for filename, text in contents.items():
+            writer.write(filename, text)
+        writer.write(p.output_folder + "part.bin", lambda f: f.write(b"\x00\x01"))
+    for filename, text in contents.items():
+        with open(filename) as f:
+            assert f.read() == text
+        with open_archive(p.archive_folder + os.path.basename(filename) + exporter.ARCHIVE_EXTENSIONS[compression], 'rt') as f:
+            assert f.read() == text
+    assert not glob.glob(p.output_folder + "*.tmp")
+
+def test_background_writer_raises_errors(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        with exporter.BackgroundWriter(compression='none') as writer:
+            writer.write(str(tmp_path / "missing" / "part.txt"), "text")
@@ -0,0 +1,54 @@
+import math
+
+import numpy as np
+import pytest
+
+import geometry as g
+
+
+def helix(n=2000):
+    rng = np.random.default_rng(0)
+    phase = np.cumsum(rng.uniform(0, 0.02, n))
+    return np.stack([26.5 + rng.uniform(-0.05, 0.05, n), phase, phase / (2*np.pi) * 0.5], axis=-1)
+
+def test_coordinates_round_trip():
+    points = helix()
+    np.testing.assert_allclose(g.cart2cyl_points(g.cyl2cart_points(points))[:, [0, 2]], points[:, [0, 2]], atol=1e-12)
+    np.testing.assert_allclose(g.wrap_plane(g.unroll_cylinder(points, 26.5), 26.5)[:, 1:], points[:, 1:], atol=1e-12)
+
+def test_segment_lengths_match_point_distances():
+    points = helix()
+    expected = [g.distance_cyl(a, b) for a, b in zip(points[:-1], points[1:])]
+    np.testing.assert_allclose(g.segment_lengths_cyl(*points.T), expected, atol=1e-9)
+    assert g.cumulative_length_cyl(*points.T)[-1] == pytest.approx(sum(expected), rel=1e-9)
+
+@pytest.mark.parametrize('parts_per_turn', [1, 4, 2.5])
+def test_turn_boundaries_match_loop(parts_per_turn):
+    phase = -helix()[:, 1]
+    step = 2*math.pi / parts_per_turn
+    expected = [next(i for i, a in enumerate(phase) if abs(a) >= (k+1)*step) for k in range(math.floor(abs(phase[-1]) / step))]
+    assert g.turn_boundaries(phase, parts_per_turn).tolist() == expected
+
+def test_interp_samples_matches_interp():
+    series = np.random.default_rng(0).normal(size=1000)
+    positions = np.linspace(-2, 1001, 5000)
+    expected = np.interp(positions, np.arange(len(series)), series, left=np.nan, right=np.nan)
+    np.testing.assert_allclose(g.interp_samples(series, positions), expected, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(g.value_at_turn(series, 100.5), g.interp_samples(series, np.arange(1000) + 100.5), atol=1e-12)
+
+@pytest.mark.parametrize('pts_per_turn', [1000, 999.7, 1234.56])
+def test_turn_series_error_is_bounded(pts_per_turn):
+    n = 20000
+    series = 5 + np.arange(n) / pts_per_turn * 0.5 + np.sin(np.arange(n) * 0.37) * 0.1
+    turns = g.TurnSeries.from_series(series, pts_per_turn)
+    assert len(turns) == n and turns.nbytes < series.nbytes * 0.6
+    assert turns.max_error < 1e-7
+    np.testing.assert_allclose(turns[:], series, rtol=0, atol=turns.max_error)
+    # The first sample of each turn is exact, as are the other ways of indexing
+    first = np.ceil(np.arange(len(turns.origins)) * pts_per_turn).astype(np.int64)
+    np.testing.assert_array_equal(turns[first], series[first])
+    idx = np.array([0, 1, n-1, -1, 12345])
+    np.testing.assert_array_equal(turns[idx], turns[:][idx])
+    np.testing.assert_array_equal(turns[100:200, None], turns[:][100:200, None])
+    np.testing.assert_array_equal(turns[series > 6], turns[:][series > 6])
+    np.testing.assert_allclose(g.interp_samples(turns, [10.5, 5000.25]), g.interp_samples(series, [10.5, 5000.25]), atol=1e-7)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import audio_processor as ap
+import kernels
+
+
+def peaky_audio(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    amplitudes = np.sin(np.arange(n) * 0.01) * 0.8 + rng.normal(0, 0.1, n)
+    amplitudes[rng.integers(0, n, 20)] *= 3
+    return amplitudes
+
+@pytest.mark.parametrize('backend', kernels.available_backends('limiter_gain'))
+def test_limiter_backends_match_reference(backend):
+    amplitudes = peaky_audio()
+    reference = kernels.limiter_gain(amplitudes, 0.9, 1/16, 1/400, backend='python')
+    np.testing.assert_array_equal(kernels.limiter_gain(amplitudes, 0.9, 1/16, 1/400, backend=backend), reference)
+
+@pytest.mark.parametrize('backend', kernels.available_backends('limiter_gain'))
+def test_limiter_gain_bounds(backend):
+    amplitudes = peaky_audio()
+    attack_step, release_step = 1/16, 1/400
+    gain = kernels.limiter_gain(amplitudes, 0.9, attack_step, release_step, backend=backend)
+    assert np.all(np.abs(amplitudes * gain) <= 0.9 * (1 + 1e-12))
+    assert np.all((gain > 0) & (gain <= 1))
+    # The gain ramps down by at most attack_step per sample, and recovers by at most release_step
+    change = np.diff(gain)
+    assert change.min() >= -attack_step * (1 + 1e-9)
+    assert change.max() <= release_step * (1 + 1e-9)
+
+def test_limiter_keeps_quiet_audio_and_dtype():
+    amplitudes = (peaky_audio() * 0.1).astype(np.float32)
+    limited = ap.apply_limiter(amplitudes, 8000, threshold=0.9)
+    assert limited.dtype == np.float32
+    np.testing.assert_array_equal(limited, amplitudes)
+
+@pytest.mark.parametrize('backend', kernels.available_backends('feed_profile'))
+@pytest.mark.parametrize('seed', range(5))
+def test_feed_profile_backends_match_reference(backend, seed):
+    rng = np.random.default_rng(seed)
+    lengths = rng.uniform(0.001, 0.05, 5000)
+    max_speeds = rng.choice([0.5, 5.0, 50.0], 5001, p=[0.05, 0.25, 0.7])
+    reference = kernels.feed_profile(lengths, max_speeds, 100.0, backend='python')
+    speeds = kernels.feed_profile(lengths, max_speeds, 100.0, backend=backend)
+    np.testing.assert_array_equal(speeds, reference)
+    # The speed changes between junctions are reachable with the acceleration
+    assert np.all(speeds <= max_speeds)
+    assert np.all(np.abs(np.diff(speeds**2)) <= 2 * 100.0 * lengths * (1 + 1e-9))
+
+def test_kernels_have_their_own_backends(monkeypatch):
+    assert 'numpy' in kernels.available_backends('feed_profile')
+    assert 'numpy' not in kernels.available_backends('simplify_path')
+    assert 'numpy' not in kernels.available_backends('clv_spiral')
+    with pytest.raises(ValueError, match="no 'numpy' backend"):
+        kernels.get_kernel('simplify_path', 'numpy')
+    # A forced backend only applies to the kernels that have it
+    monkeypatch.setenv(kernels.BACKEND_VARIABLE, 'numpy')
+    assert kernels.selected_backend('feed_profile') == 'numpy'
+    assert kernels.selected_backend('simplify_path') in kernels.available_backends('simplify_path')
+    monkeypatch.setenv(kernels.BACKEND_VARIABLE, 'fortran')
+    with pytest.raises(ValueError, match="Invalid kernel backend"):
+        kernels.selected_backend()
@@ -0,0 +1,51 @@
+import os
+import zipfile
+
+import numpy as np
+import pytest
+
+import mesh
+from parameters import default_parameters as p
+
+
+def groove_mesh(amplitudes, surface_type, compact=False):
+    p.update(SURFACE_TYPE=surface_type, compact=compact)
+    samples, frame_rate = amplitudes
+    return mesh.GrooveMesh(samples[:2*frame_rate], frame_rate, columns_per_turn=64)
+
+@pytest.mark.parametrize('surface_type', ['cylinder', 'disc'])
+@pytest.mark.parametrize('compact', [False, True])
+def test_mesh_is_watertight(amplitudes, surface_type, compact):
+    groove = groove_mesh(amplitudes, surface_type, compact)
+    chunks = list(groove.triangle_chunks(chunk_size=50))
+    triangles = np.concatenate([t for t, _ in chunks])
+    coords = np.concatenate([c for _, c in chunks])
+
+    # Each edge is shared by two triangles, which use it in opposite directions
+    edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+    assert len(np.unique(edges, axis=0)) == len(edges)
+    assert set(map(tuple, edges)) == set(map(tuple, edges[:, ::-1]))
+    # Closed surface of genus 0, using all the vertices
+    assert len(np.unique(triangles)) == groove.nb_vertices
+    assert groove.nb_vertices - len(edges)//2 + len(triangles) == 2
+    # Normals point outwards: the volume is positive, and smaller than the blank
+    volume = np.einsum('ij,ij->i', coords[:, 0], np.cross(coords[:, 1], coords[:, 2])).sum() / 6
+    blank = np.pi * p.R**2 * p.L
+    assert 0.9 * blank < volume < blank
+
+def test_short_path_is_rejected(amplitudes):
+    p.update(SURFACE_TYPE='cylinder')
+    samples, frame_rate = amplitudes
+    with pytest.raises(ValueError, match="too short"):
+        mesh.GrooveMesh(samples[:frame_rate//10], frame_rate, columns_per_turn=64)
+
+def test_stl_and_3mf_have_the_same_triangles(amplitudes, tmp_path):
+    groove = groove_mesh(amplitudes, 'cylinder')
+    stl, model = str(tmp_path / "part.stl"), str(tmp_path / "part.3mf")
+    nb_triangles = mesh.export_mesh_to_stl(groove, stl)
+    assert os.path.getsize(stl) == 84 + 50 * nb_triangles
+    assert mesh.export_mesh_to_3mf(groove, model, chunk_size=50) == nb_triangles
+    with zipfile.ZipFile(model) as zf:
+        content = zf.read('3D/3dmodel.model').decode()
+    assert content.count('<triangle ') == nb_triangles
+    assert content.count('<vertex ') == groove.nb_vertices
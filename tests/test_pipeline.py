@@ -0,0 +1,99 @@
+import json
+import os
+
+import numpy as np
+
+import pipeline
+import restart
+from parameters import default_parameters as p
+
+
+def test_stage_key_depends_on_declared_fields_only():
+    key = pipeline.stage_key('filter', {'decode': 'abc'})
+    p.update(spindle_speed=p.spindle_speed + 1000)
+    assert pipeline.stage_key('filter', {'decode': 'abc'}) == key
+    p.update(cutoff_freq_high=p.cutoff_freq_high / 2)
+    assert pipeline.stage_key('filter', {'decode': 'abc'}) != key
+
+def test_stage_key_depends_on_upstream_and_extra():
+    key = pipeline.stage_key('filter', {'decode': 'abc'})
+    assert pipeline.stage_key('filter', {'decode': 'abd'}) != key
+    assert pipeline.stage_key('filter', {'decode': 'abc'}, extra='file') != key
+
+def test_equalize_key_ignores_unused_eq_fields(tmp_path):
+    p.update(equalization='none')
+    key = pipeline.equalize_stage_key('abc')
+    p.update(eq_corner_freq=p.eq_corner_freq * 2)
+    assert pipeline.equalize_stage_key('abc') == key
+
+    p.update(equalization='displacement')
+    key = pipeline.equalize_stage_key('abc')
+    p.update(eq_corner_freq=p.eq_corner_freq * 2)
+    assert pipeline.equalize_stage_key('abc') != key
+
+    curve_file = tmp_path / "curve.csv"
+    curve_file.write_text("20,0\n20000,0\n")
+    p.update(equalization='custom', eq_curve_file=str(curve_file))
+    key = pipeline.equalize_stage_key('abc')
+    p.update(eq_corner_freq=p.eq_corner_freq * 2)
+    assert pipeline.equalize_stage_key('abc') == key
+    curve_file.write_text("20,0\n20000,-6\n")
+    assert pipeline.equalize_stage_key('abc') != key
+
+def test_cached_computes_once():
+    calls = []
+    def compute():
+        calls.append(1)
+        return {'values': np.arange(5)}
+    first = pipeline.cached('filter', 'abc', compute)
+    second = pipeline.cached('filter', 'abc', compute)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(first['values'], second['values'])
+    pipeline.cached('filter', 'abd', compute)
+    assert len(calls) == 2
+
+def test_build_manifest_keeps_one_record_per_output_type():
+    p.update(ENGRAVING_OUTPUT_TYPE='gcode')
+    pipeline.save_build_manifest({'gcode_files': 'a', 'outputs': ['a_1.gcode']})
+    p.update(ENGRAVING_OUTPUT_TYPE='points')
+    assert pipeline.load_build_manifest() == {}
+    pipeline.save_build_manifest({'key': 'b', 'outputs': ['b.csv']})
+    p.update(ENGRAVING_OUTPUT_TYPE='gcode')
+    assert pipeline.load_build_manifest() == {'gcode_files': 'a', 'outputs': ['a_1.gcode']}
+    p.update(ENGRAVING_OUTPUT_TYPE='points')
+    assert pipeline.load_build_manifest() == {'key': 'b', 'outputs': ['b.csv']}
+
+def test_build_manifest_of_older_versions_is_ignored():
+    with open(pipeline.build_manifest_filename(), 'w') as f:
+        json.dump({'key': 'a', 'outputs': ['a.csv']}, f)
+    assert pipeline.load_build_manifest() == {}
+    pipeline.save_build_manifest({'key': 'b', 'outputs': []})
+    assert pipeline.load_build_manifest() == {'key': 'b', 'outputs': []}
+
+def test_header_rewrite_matches_fresh_export(tmp_path, amplitudes, capsys):
+    p.update(L=10.0, max_text_size=300000)
+    pipeline.gcode_stage(*amplitudes, 'key')
+    filenames = pipeline.load_build_manifest()['outputs']
+    assert len(filenames) > 1
+    capsys.readouterr()
+
+    # Only the header changes: the files are rewritten, not exported again
+    p.update(spindle_speed=p.spindle_speed + 1234, tool_number=p.tool_number + 1, feed_rate=p.feed_rate * 2)
+    pipeline.gcode_stage(*amplitudes, 'key')
+    output = capsys.readouterr().out
+    assert "G-code header rewritten" in output and "G-code exported" not in output
+    assert pipeline.load_build_manifest()['outputs'] == filenames
+    rewritten_index, _ = restart.load_gcode_index(restart.index_filename())
+
+    fresh_folder = tmp_path / "fresh"
+    fresh_folder.mkdir()
+    p.update(output_folder=str(fresh_folder) + os.sep)
+    pipeline.gcode_stage(*amplitudes, 'key')
+    fresh_filenames = pipeline.load_build_manifest()['outputs']
+    fresh_index, _ = restart.load_gcode_index(restart.index_filename())
+
+    assert len(fresh_filenames) == len(filenames)
+    for rewritten, fresh in zip(filenames, fresh_filenames):
+        with open(rewritten, 'rb') as f1, open(fresh, 'rb') as f2:
+            assert f1.read() == f2.read()
+    np.testing.assert_array_equal(rewritten_index, fresh_index)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+import preview
+
+
+@pytest.mark.parametrize('nb_columns', [1, 7, 100, 1000])
+def test_minmax_envelope_is_exact(nb_columns):
+    series = np.random.default_rng(0).normal(size=12345).astype(np.float32)
+    low, high = preview.minmax_envelope(series, nb_columns)
+    bounds = np.linspace(0, len(series), nb_columns + 1).astype(np.int64)
+    assert len(low) == len(high) == nb_columns
+    for j in range(nb_columns):
+        column = series[bounds[j]:bounds[j+1]]
+        assert low[j] == column.min() and high[j] == column.max()
+    assert low.dtype == high.dtype == series.dtype
+
+def test_minmax_envelope_keeps_single_sample_peaks():
+    series = np.zeros(100000)
+    series[[12345, 67890]] = 1.0, -1.0
+    low, high = preview.minmax_envelope(series, 640)
+    assert high.max() == 1.0 and low.min() == -1.0
+    assert np.count_nonzero(high) == 1 and np.count_nonzero(low) == 1
+
+def test_minmax_envelope_of_a_short_series():
+    low, high = preview.minmax_envelope(np.array([3.0, -2.0, 5.0]), 640)
+    np.testing.assert_array_equal(low, [3.0, -2.0, 5.0])
+    np.testing.assert_array_equal(high, [3.0, -2.0, 5.0])
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import exporter
+import pipeline
+import restart
+from parameters import default_parameters as p
+
+
+def export_gcode(amplitudes, **changes):
+    p.update(max_text_size=300000, **changes)
+    pipeline.gcode_stage(*amplitudes, 'key')
+    return restart.load_gcode_index(restart.index_filename())
+
+def check_entries(index):
+    first, second = p.gcode_axes
+    files = {}
+    for entry in index:
+        if entry['file'] not in files:
+            with open(exporter.gcode_filename(int(entry['file'])), 'rb') as f:
+                content = f.read()
+            files[entry['file']] = content, content.split(b'\n')
+        content, lines = files[entry['file']]
+        block = f"{first}{entry['x']}{second}{entry['a']}".encode()
+        # The offset points to the newline before the block, the line is the line of the block
+        offset = int(entry['offset'])
+        assert content[offset:offset+1] == b'\n'
+        assert content[offset+1:].split(b'\n', 1)[0].rstrip() == block
+        assert lines[int(entry['line']) - 1].rstrip() == block
+
+def test_index_points_to_the_blocks(amplitudes):
+    index, step = export_gcode(amplitudes, L=10.0, gcode_index_step=37)
+    assert step == 37
+    assert index['file'].max() > 1 and index['pass'].max() > 1 and index['turn'].max() > 1
+    assert np.all(np.diff(index['block'][index['pass'] == 1]) == 37)
+    check_entries(index)
+
+def test_index_follows_header_rewrite(amplitudes):
+    export_gcode(amplitudes, L=10.0)
+    index, _ = export_gcode(amplitudes, L=10.0, spindle_speed=p.spindle_speed + 12345, feed_rate=p.feed_rate * 2)
+    check_entries(index)
+
+def test_index_is_rebuilt_when_its_step_changes(amplitudes):
+    export_gcode(amplitudes, L=10.0)
+    index, step = export_gcode(amplitudes, L=10.0, gcode_index_step=10)
+    assert step == 10 and np.all(np.diff(index['block'][index['pass'] == 1]) == 10)
+    check_entries(index)
+
+def test_restart_entry(amplitudes):
+    index, _ = export_gcode(amplitudes, L=10.0)
+    turn = index[(index['pass'] == 2) & (index['turn'] == 3)]
+    assert restart.restart_entry(index, 2, 3) == turn[0]
+    for entry in turn[1:]:
+        assert restart.restart_entry(index, 2, 3, float(entry['a']))['block'] == entry['block']
+    with pytest.raises(ValueError, match="No index entry"):
+        restart.restart_entry(index, index['pass'].max() + 1)
+
+    entry = restart.restart_entry_at_line(index, 2, 500)
+    assert entry['file'] == 2 and entry['line'] <= 500
+    later = index[(index['file'] == 2) & (index['line'] > entry['line'])]
+    assert later['line'].min() > 500
+
+def test_restart_program(amplitudes):
+    index, _ = export_gcode(amplitudes, L=10.0)
+    entry = restart.restart_entry(index, 2, 3, 180.0)
+    filename = restart.export_restart_gcode(entry)
+    with open(filename, 'rb') as f:
+        program = f.read()
+    with open(exporter.gcode_filename(int(entry['file'])), 'rb') as f:
+        source = f.read()
+    assert program.endswith(source[int(entry['offset']):])
+    header = program[:len(program) - len(source) + int(entry['offset'])].decode()
+    assert f"restart pass {entry['pass']} turn {entry['turn']}" in header
+    assert f"{entry['x']}" in header and f"{entry['a']}" in header
+
+def test_restart_program_rejects_stale_index(amplitudes):
+    index, _ = export_gcode(amplitudes, L=10.0)
+    entry = index[len(index) // 2].copy()
+    entry['offset'] += 1
+    with pytest.raises(ValueError, match="does not match"):
+        restart.export_restart_gcode(entry)
+
+@pytest.mark.parametrize('disc_gcode_axes', ['polar', 'xy'])
+def test_disc_index_points_to_the_blocks(amplitudes, disc_gcode_axes):
+    index, _ = export_gcode(amplitudes, SURFACE_TYPE='disc', disc_gcode_axes=disc_gcode_axes)
+    assert index['file'].max() > 1 and index['turn'].max() > 1
+    check_entries(index)
+    np.testing.assert_allclose(index['angle'], restart.block_angle(index['x'], index['a']), atol=1e-4)
+
+    index, _ = export_gcode(amplitudes, SURFACE_TYPE='disc', disc_gcode_axes=disc_gcode_axes, spindle_speed=p.spindle_speed + 12345)
+    check_entries(index)
+    entry = restart.restart_entry(index, 2, 3, 90.0)
+    assert entry['pass'] == 2 and entry['turn'] == 3
+    assert restart.export_restart_gcode(entry)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import simulator
+from parameters import default_parameters as p
+
+
+def two_seconds(amplitudes):
+    samples, frame_rate = amplitudes
+    return samples[:2*frame_rate], frame_rate
+
+@pytest.mark.parametrize('surface_type', ['cylinder', 'disc'])
+def test_playback_recovers_the_audio(amplitudes, surface_type):
+    p.update(SURFACE_TYPE=surface_type, disc_speed='angular')
+    samples, frame_rate = two_seconds(amplitudes)
+    recovered = simulator.simulate_playback(samples, frame_rate)
+    assert len(recovered) == len(samples)
+    assert np.max(np.abs(recovered - samples)) < 1e-3
+
+def test_playback_does_not_depend_on_chunks_or_compact(amplitudes):
+    samples, frame_rate = two_seconds(amplitudes)
+    recovered = simulator.simulate_playback(samples, frame_rate)
+    np.testing.assert_array_equal(simulator.simulate_playback(samples, frame_rate, chunk_size=777), recovered)
+    p.update(compact=True)
+    np.testing.assert_allclose(simulator.simulate_playback(samples, frame_rate), recovered, atol=1e-4)
+
+def test_stylus_rests_in_the_middle_of_a_v_groove():
+    resolution, center = 0.001, 40.3
+    rows = np.arange(81)
+    heights = np.stack([-0.05 + np.abs(rows - c) * resolution * 0.5 for c in (center, 30.0, 50.7)])
+    resting, _ = simulator.settle_stylus(np.minimum(heights, 0).astype(np.float32), resolution, 0.005)
+    # Within a fraction of a row (the parabola fitted to a V is slightly biased)
+    np.testing.assert_allclose(resting, [center, 30.0, 50.7], atol=0.15)
+
+def test_linear_disc_is_rejected():
+    p.update(SURFACE_TYPE='disc', disc_speed='linear')
+    with pytest.raises(ValueError, match="constant number of samples"):
+        simulator.check_parameters()
@@ -0,0 +1,35 @@
+import numpy as np
+
+import splitter
+from parameters import default_parameters as p
+
+
+def test_parts_cover_the_audio_and_fit(amplitudes):
+    samples, frame_rate = amplitudes
+    p.update(L=10.0)
+    parts = splitter.split_parts(samples, frame_rate)
+    assert len(parts) > 1
+    assert parts[0].start == 0 and parts[-1].end == len(samples)
+    assert all(a.end == b.start for a, b in zip(parts, parts[1:]))
+    silent_samples = int(frame_rate * p.silent_start_duration)
+    capacity = splitter.surface_capacity(len(samples) + silent_samples, frame_rate, np.max(np.abs(samples)))
+    search = int(p.split_search_duration * frame_rate)
+    for part in parts[:-1]:
+        assert capacity - silent_samples - search <= part.end - part.start <= capacity - silent_samples
+    assert [part.surface for part in parts] == [f"cylinder {i+1}" for i in range(len(parts))]
+
+def test_two_sided_discs(amplitudes):
+    samples, frame_rate = amplitudes
+    p.update(SURFACE_TYPE='disc', disc_sides=2, R=15.0)
+    parts = splitter.split_parts(samples, frame_rate)
+    assert len(parts) > 2
+    assert [part.surface for part in parts[:3]] == ["disc 1 side A", "disc 1 side B", "disc 2 side A"]
+
+def test_cut_is_at_the_quietest_point():
+    frame_rate = 8000
+    samples = np.random.default_rng(0).normal(0, 0.3, 10*frame_rate)
+    samples[51000:51200] *= 0.01
+    cut = splitter.quiet_cut(samples, frame_rate, 40000, 60000)
+    assert 51080 <= cut <= 51200
+    # Without a quiet point after the earliest sample, the cut is in the search range
+    assert 40000 <= splitter.quiet_cut(samples, frame_rate, 40000, 40500) <= 40500
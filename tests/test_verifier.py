@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import pipeline
+import verifier
+from parameters import default_parameters as p
+
+
+def parse(text: str, window_size: int = 4*1024*1024):
+    filename = p.output_folder + "window.gcode"
+    with open(filename, 'w', newline='') as f:
+        f.write(text)
+    return list(verifier.gcode_events(filename, window_size))
+
+def test_parse_numbers_match_float():
+    rng = np.random.default_rng(0)
+    texts = [str(round(v, d)) for v, d in zip(rng.uniform(-400, 400, 5000).tolist(), rng.integers(0, 4, 5000).tolist())] + ["0", "-0.0", "7.", "-.5", "12345678", "-1234567", "123456.789", "-0.0001234"]
+    buf = np.frombuffer("".join(f"X{t}A{t}\n" for t in texts).encode(), dtype=np.uint8)
+    x, a, lines, others = verifier.parse_window(buf)
+    expected = [float(t) for t in texts]
+    assert others == [] and lines.tolist() == list(range(len(texts)))
+    np.testing.assert_array_equal(x, expected)
+    np.testing.assert_array_equal(a, expected)
+
+def test_parse_window_separates_blocks_and_other_lines():
+    text = ("%\n( Depth change )\nG0Z49.95\nX1.5A-359.999\nX-0.001A12\n"
+            "G1Y0.F100.0\nX1.2.3A5\nXA5\nX1A\nX1A2A3\nX2/A3\nX1-2A3\nX-A3\nX.A3\nX--1A2\nX1.2.3.4.5A1\nX10.25A0.5\n")
+    buf = np.frombuffer(text.encode(), dtype=np.uint8)
+    x, a, lines, others = verifier.parse_window(buf)
+    np.testing.assert_array_equal(x, [1.5, -0.001, 10.25])
+    np.testing.assert_array_equal(a, [-359.999, 12, 0.5])
+    assert lines.tolist() == [3, 4, 16]
+    assert [text for _, text in others] == ["%", "( Depth change )", "G0Z49.95", "G1Y0.F100.0",
+                                             "X1.2.3A5", "XA5", "X1A", "X1A2A3", "X2/A3",
+                                             "X1-2A3", "X-A3", "X.A3", "X--1A2", "X1.2.3.4.5A1"]
+
+def test_events_do_not_depend_on_window_size():
+    lines = [f"X{i/1000}A{(i*7) % 360}" if i % 50 else "G1Y0.F100.0" for i in range(3000)]
+    text = "\r\n".join(lines)    # Without a final newline, with the newlines of Windows
+    def blocks(events):
+        return np.concatenate([np.stack([x, a]) for kind, x, a in events if kind == 'blocks'], axis=1)
+    reference = parse(text)
+    np.testing.assert_array_equal(blocks(parse(text, window_size=1000)), blocks(reference))
+    assert [e[1] for e in parse(text, window_size=1000) if e[0] == 'line'] == [e[1] for e in reference if e[0] == 'line']
+    np.testing.assert_array_equal(blocks(reference)[0], [i/1000 for i in range(3000) if i % 50])
+
+def test_fresh_export_is_valid(amplitudes):
+    p.update(L=10.0, max_text_size=300000)
+    pipeline.gcode_stage(*amplitudes, 'key')
+    expected = verifier.expected_gcode_path(*amplitudes)
+    check = verifier.verify_gcode(expected=expected, window_size=65536, backplot_filename=p.output_folder + "backplot.png")
+    assert check.ok, check.errors
+    assert check.nb_files > 1 and check.deviations == 0 and check.out_of_bounds == 0
+    assert check.blocks_per_pass == [len(expected[0])] * len(check.pass_depths)
+
+def test_corrupted_block_is_detected(amplitudes):
+    p.update(L=10.0, max_text_size=300000)
+    pipeline.gcode_stage(*amplitudes, 'key')
+    filename = verifier.gcode_filenames()[1]
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+    i = [k for k, line in enumerate(lines) if line.startswith('X')][100]
+    x, a = lines[i][1:].split('A')
+    lines[i] = f"X{round(float(x) + 0.01, 3)}A{a}"
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+    check = verifier.verify_gcode(expected=verifier.expected_gcode_path(*amplitudes))
+    assert check.deviations == 1 and len(check.errors) == 1
+
+def test_missing_files_and_disc_are_rejected():
+    with pytest.raises(FileNotFoundError):
+        verifier.verify_gcode()
+    p.update(SURFACE_TYPE='disc')
+    with pytest.raises(ValueError, match="disc"):
+        verifier.check_parameters()
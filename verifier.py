@@ -0,0 +1,422 @@
+"""
+Streaming verification of the G-code files written by `exporter.export_text_to_gcode`.
+
+The files are memory-mapped and read by windows of a few megabytes. All X/A blocks of a window are parsed
+at once, each number being read as one 8-byte word and converted with integer arithmetic, so the memory usage
+is bounded and no Python code runs per block. The other lines (header, depth change sequences, end of program)
+are few and parsed in Python. The NumPy passes over each window are bound by memory bandwidth: parsing takes
+about 15 s per gigabyte of blocks and the whole check about 22 s (65 million blocks), on a single core.
+
+The toolpath is rebuilt from the blocks and checked for:
+- X out of the engraving surface (end_margin to L - end_margin) and A out of one turn,
+- jumps between consecutive blocks, including between two chunk files and after a repositioning,
+- the depth of each pass and the depth the tool enters each file at,
+- the number of blocks of each pass,
+- the deviation from the expected path, if given.
+"""
+import glob
+import os
+import re
+import warnings
+import attrs
+import numpy as np
+
+import amp2engraving as a2e
+from parameters import default_parameters as p
+
+
+# Constants of the 8-byte word parser
+_ZEROS = np.uint64(0x3030303030303030)
+_ONES = np.uint64(0x0101010101010101)
+_HIGHS = np.uint64(0x8080808080808080)
+_POW10 = 10.0 ** np.arange(8)
+
+BACKPLOT_COLOR = np.array((40, 40, 40))
+FLAGGED_COLOR = (230, 0, 0)
+LIMIT_COLOR = (0, 90, 230)
+BACKGROUND_COLOR = (255, 255, 255)
+
+
+@attrs.define
+class GcodeCheck:
+    nb_files:           int = 0
+    blocks_per_pass:    list[int] = attrs.field(factory=list)
+    pass_depths:        list[float] = attrs.field(factory=list)  # Total depth of each pass [mm]
+    x_range:            tuple[float, float] = (np.inf, -np.inf)  # [mm]
+    out_of_bounds:      int = 0     # Number of blocks out of the engraving surface
+    jumps:              int = 0     # Number of moves longer than max_jump
+    deviations:         int = 0     # Number of blocks further than tolerance from the expected path
+    max_deviation:      float = 0.0 # [mm]
+    errors:             list[str] = attrs.field(factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def gcode_filenames() -> list[str]:
+    """
+    List the chunk files of the current output file, in order.
+    """
+    base = p.output_folder + p.output_filename + "_"
+    filenames = glob.glob(glob.escape(base) + "*." + p.file_format)
+    numbers = [f[len(base):-len(p.file_format)-1] for f in filenames]
+    return [f for n, f in sorted((int(n), f) for n, f in zip(numbers, filenames) if n.isdigit())]
+
+def parse_numbers(words: np.ndarray, ends: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Parse decimal numbers of at most 8 characters (e.g. "-359.999") in a byte buffer.
+
+    Each number is read as the 8-byte word ending with its last character. The characters before the number
+    are replaced by '0', the sign and the decimal point are removed, and the 8 digits are converted at once.
+    The operations are done in place on the words, to limit the passes over memory. The result is identical to float().
+
+    :param words: Unaligned little-endian uint64 view of the buffer, words[i] holding bytes i to i+7.
+    :param ends: Index of the character following each number.
+    :param lengths: Number of characters of each number, from 1 to 8.
+    :return: The numbers, NaN for malformed ones (sign after the first character, several decimal points or no digit).
+    """
+    U = np.uint64
+    v = words[ends - 8]
+    shifts = ((8 - lengths) << 3).astype(np.uint64)
+    keep = np.left_shift(~U(0), shifts)
+    v &= keep
+    np.invert(keep, out=keep)
+    keep &= _ZEROS
+    v |= keep
+
+    # Minus sign, replaced by '0'
+    m = v ^ U(0x2D2D2D2D2D2D2D2D)
+    minus = m - _ONES
+    np.invert(m, out=m)
+    minus &= m
+    minus &= _HIGHS
+    neg = minus != 0
+    valid = minus == np.left_shift(U(0x80), shifts)
+    valid |= ~neg
+    minus >>= U(7)
+    minus *= U(0x2D ^ 0x30)
+    v ^= minus
+
+    # Decimal point, removed by shifting the integer part by one character
+    d = v ^ U(0x2E2E2E2E2E2E2E2E)
+    dot = d - _ONES
+    np.invert(d, out=d)
+    dot &= d
+    dot &= _HIGHS
+    dot >>= U(7)
+    valid &= (dot & (dot - U(1))) == 0
+    valid &= lengths > neg + (dot != 0)
+    no_dot = np.flatnonzero(dot == 0)
+    integers = v[no_dot]
+    decimals = U(7) - ((dot * U(0x0001020304050607)) >> U(56))
+    decimals[no_dot] = 0
+    decimals[~valid] = 0
+    low = dot - U(1)
+    dot *= U(0xFF)
+    dot |= low
+    np.invert(dot, out=dot)
+    dot &= v
+    v &= low
+    v <<= U(8)
+    v |= dot
+    v |= U(0x30)
+    v[no_dot] = integers
+
+    # 8 digits to integer
+    v -= _ZEROS
+    tens = v >> U(8)
+    v *= U(10)
+    v += tens
+    high = v >> U(16)
+    high &= U(0x000000FF000000FF)
+    high *= U(1 + (10000 << 32))
+    v &= U(0x000000FF000000FF)
+    v *= U(100 + (1000000 << 32))
+    v += high
+    v >>= U(32)
+    values = v.astype(np.float64)
+    values /= _POW10[decimals.astype(np.intp)]
+    values[neg] *= -1
+    values[~valid] = np.nan
+    return values
+
+def parse_window(buf: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, list[tuple[int, str]]]:
+    """
+    Parse the lines of a window of a G-code file.
+
+    The bytes other than digits, '-' and '.' (newlines, axis letters and the characters of the other lines)
+    are found in one pass. A block line has exactly three: the X that starts it, one A and its newline,
+    and a fourth one if the newline is the '\r\n' of Windows.
+
+    :param buf: Bytes of complete lines, the last one ending with a newline.
+    :return: X and A of the blocks, line index of the blocks, and (line index, text) of the other lines.
+    """
+    padded = np.concatenate([np.full(8, ord('0'), dtype=np.uint8), buf])
+    words = np.ndarray(shape=(len(padded) - 7,), dtype='<u8', buffer=padded, strides=(1,))
+
+    # '-', '.', '/' and the digits are the 13 characters from '-' to '9'
+    special = padded - np.uint8(ord('-'))
+    special = special > 12
+    special |= padded == ord('/')
+    pos = np.flatnonzero(special)
+    chars = padded[pos]
+    is_nl = chars == ord('\n')
+    nl = pos[is_nl]
+    ends = nl - (padded[nl - 1] == ord('\r'))
+    line_of = np.cumsum(is_nl) - is_nl
+    starts = np.concatenate([[8], nl[:-1] + 1])
+
+    # Blocks are exactly X<number>A<number>, anything else is handled as an other line
+    is_a = chars == ord('A')
+    is_block = padded[starts] == ord('X')
+    is_block &= np.bincount(line_of, minlength=len(nl)) == 3 + (ends < nl)
+    is_block &= np.bincount(line_of[is_a], minlength=len(nl)) == 1
+    a_pos, a_line = pos[is_a], line_of[is_a]
+    a_pos = a_pos[is_block[a_line]]
+    lines = np.flatnonzero(is_block)
+    x_lengths, a_lengths = a_pos - starts[lines] - 1, ends[lines] - a_pos - 1
+    is_block[lines[(x_lengths < 1) | (a_lengths < 1)]] = False
+    keep = is_block[lines]
+    lines, a_pos, x_lengths, a_lengths = lines[keep], a_pos[keep], x_lengths[keep], a_lengths[keep]
+
+    # Numbers longer than 8 characters are rare, they are parsed one by one
+    x = parse_numbers(words, a_pos, np.minimum(x_lengths, 8))
+    a = parse_numbers(words, ends[lines], np.minimum(a_lengths, 8))
+    for i in np.flatnonzero((x_lengths > 8) | (a_lengths > 8)):
+        try:
+            x[i], a[i] = (float(s) for s in padded[starts[lines[i]]+1:ends[lines[i]]].tobytes().split(b'A'))
+        except ValueError:
+            x[i] = np.nan
+    # Malformed numbers (e.g. "1.2.3") make malformed blocks
+    malformed = np.isnan(x) | np.isnan(a)
+    if malformed.any():
+        is_block[lines[malformed]] = False
+        x, a, lines = x[~malformed], a[~malformed], lines[~malformed]
+
+    others = [(int(i), padded[starts[i]:nl[i]].tobytes().decode('ascii', errors='replace').strip()) for i in np.flatnonzero(~is_block)]
+    return x, a, lines, others
+
+def gcode_events(filename: str, window_size: int = 4*1024*1024):
+    """
+    Read a G-code file by windows, in order.
+
+    :param filename: G-code file.
+    :param window_size: Number of bytes read at once [bytes].
+    :return: Generator of ('blocks', x, a) and ('line', text, None) events.
+    """
+    if os.path.getsize(filename) == 0:
+        return
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    start = 0
+    while start < len(data):
+        end = min(start + window_size, len(data))
+        buf = data[start:end]
+        if end < len(data):
+            newlines = np.flatnonzero(buf == ord('\n'))
+            if len(newlines) == 0:
+                raise ValueError(f"Line longer than {window_size} bytes in {filename}.")
+            end = start + int(newlines[-1]) + 1
+            buf = data[start:end]
+        elif buf[-1] != ord('\n'):
+            buf = np.append(buf, np.uint8(ord('\n')))
+        start = end
+
+        x, a, lines, others = parse_window(np.asarray(buf))
+        previous = 0
+        for line, text in others:
+            split = np.searchsorted(lines, line)
+            if split > previous:
+                yield 'blocks', x[previous:split], a[previous:split]
+            previous = split
+            yield 'line', text, None
+        if len(x) > previous:
+            yield 'blocks', x[previous:], a[previous:]
+    del data
+
+def check_parameters() -> None:
+    """
+    Reject the parameters the verification does not support, before the audio is decoded.
+
+    The bounds, the distances and the back-plot are those of the X/A blocks of a cylinder.
+    """
+    if p.SURFACE_TYPE == 'disc':
+        raise ValueError("The verifier only checks the X and A blocks of a cylinder, not the "
+                         f"{'/'.join(p.gcode_axes)} blocks of a disc. Use SURFACE_TYPE = 'cylinder'.")
+
+def expected_gcode_path(amplitudes: np.ndarray, frame_rate: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the X and A of the blocks of one pass, as written by `amp2engraving.amplitudes_to_gcode`.
+
+    :param amplitudes: Array of sound amplitudes, including the silent start.
+    :param frame_rate: Frame rate of the audio signal in Hz.
+    :return: X [mm] and A [°] of each block.
+    """
+    check_parameters()
+    _, elevation, angle, nb_points = a2e.gcode_path(amplitudes, frame_rate)
+    return elevation[:nb_points], angle[:nb_points]
+
+def arc_distance(dx: np.ndarray, da: np.ndarray) -> np.ndarray:
+    """
+    Distance on the surface of the cylinder between two points, from their X [mm] and A [°] differences.
+    """
+    da = da - 360 * np.round(da / 360)
+    return np.hypot(dx, p.R * np.radians(da))
+
+def verify_gcode(filenames: list[str] = None, expected: tuple[np.ndarray, np.ndarray] = None, tolerance: float = 0.002,
+                 max_jump: float = None, backplot_filename: str = None, width: int = 1600, height: int = 800,
+                 window_size: int = 4*1024*1024) -> GcodeCheck:
+    """
+    Check G-code files and rebuild their toolpath.
+
+    Parameters
+    ----------
+    filenames : list[str]
+        G-code chunk files, in order. Default is the files of the current output file.
+    expected : tuple[np.ndarray, np.ndarray]
+        (Optional) X [mm] and A [°] of the blocks of one pass, see `expected_gcode_path`.
+    tolerance : float
+        Maximal distance between a block and the expected path [mm]. The blocks are rounded to 1 um.
+    max_jump : float
+        Maximal move between two consecutive blocks [mm]. Default is max_amplitude + width: one sample
+        moves by a few micrometers along the path, and at most by max_amplitude across it.
+    backplot_filename : str
+        (Optional) PNG image of the toolpath unrolled on the surface of the cylinder.
+    width, height : int
+        Size of the back-plot [px], for one turn and the length of the cylinder.
+    window_size : int
+        Number of bytes read at once [bytes].
+
+    Returns
+    -------
+    Summary of the check. Errors are also raised as warnings.
+    """
+    check_parameters()
+    filenames = gcode_filenames() if filenames is None else filenames
+    if not filenames:
+        raise FileNotFoundError(f"No G-code file found for {p.output_folder + p.output_filename}_<n>.{p.file_format}, export the G-code first.")
+    max_jump = p.max_amplitude + p.width if max_jump is None else max_jump
+    x_low = p.end_margin + p.start_pos + p.offset_from_centerline - p.max_amplitude/2 - 0.0005
+    x_high = p.L - p.end_margin + 0.0005
+    check = GcodeCheck(nb_files=len(filenames))
+    density = np.zeros(height * width, dtype=np.int64)
+    flagged = np.zeros(height * width, dtype=bool)
+
+    def error(message: str) -> None:
+        check.errors.append(message)
+        warnings.warn(message)
+
+    def pixels(x: np.ndarray, a: np.ndarray) -> np.ndarray:
+        cols = np.clip((a % 360 / 360 * width).astype(np.int64), 0, width - 1)
+        rows = np.clip(((p.L - x) / p.L * height).astype(np.int64), 0, height - 1)
+        return rows * width + cols
+
+    position = None     # Last X and A of the tool
+    tool_depth = None   # Depth of the last plunge [mm]
+    new_pass = False
+    for file_num, filename in enumerate(filenames):
+        entry_checked = False
+        for kind, x, a in gcode_events(filename, window_size):
+            if kind == 'line':
+                text = x
+                if text.startswith('( Depth change'):
+                    new_pass = True
+                elif (match := re.fullmatch(r"G0Z(-?[\d.]+)", text)) and float(match[1]) < p.R:
+                    tool_depth = round(p.R - float(match[1]), 3)
+                    if new_pass or not check.pass_depths:
+                        check.pass_depths.append(tool_depth)
+                        check.blocks_per_pass.append(0)
+                        new_pass = False
+                elif match := re.match(r"G0X(-?[\d.]+)Y-?[\d.]+A(-?[\d.]+)", text):
+                    position = (float(match[1]), float(match[2]))
+                elif text.startswith('X'):
+                    error(f"{filename}: malformed block '{text}'.")
+                continue
+
+            if not check.pass_depths:
+                error(f"{filename}: blocks before the first plunge of the tool.")
+                check.pass_depths.append(tool_depth or 0.0)
+                check.blocks_per_pass.append(0)
+            pass_num = len(check.pass_depths) - 1
+            if not entry_checked:
+                entry_checked = True
+                if tool_depth is not None and abs(tool_depth - check.pass_depths[-1]) > 0.0005:
+                    error(f"{filename}: tool enters at {round(tool_depth*1e3)} um, but continues pass {pass_num+1} at {round(check.pass_depths[-1]*1e3)} um.")
+
+            # Bounds
+            check.x_range = (min(check.x_range[0], float(x.min())), max(check.x_range[1], float(x.max())))
+            outside = (x < x_low) | (x > x_high) | (np.abs(a) > 360)
+            check.out_of_bounds += int(np.count_nonzero(outside))
+
+            # Jumps, including from the previous position of the tool
+            steps = arc_distance(np.diff(x, prepend=np.nan if position is None else position[0]),
+                                 np.diff(a, prepend=np.nan if position is None else position[1]))
+            jumps = np.flatnonzero(steps > max_jump)
+            if len(jumps):
+                check.jumps += len(jumps)
+                i = jumps[0]
+                origin = position if i == 0 else (x[i-1], a[i-1])
+                error(f"{filename}: jump of {steps[i]:.3f} mm from X{origin[0]}A{origin[1]} to X{x[i]}A{a[i]} (pass {pass_num+1}, block {check.blocks_per_pass[-1]+i+1}).")
+            position = (x[-1], a[-1])
+
+            # Deviation from the expected path
+            deviating = np.zeros(len(x), dtype=bool)
+            if expected is not None:
+                offset = check.blocks_per_pass[-1]
+                n = max(0, min(len(x), len(expected[0]) - offset))
+                deviation = arc_distance(x[:n] - expected[0][offset:offset+n], a[:n] - expected[1][offset:offset+n])
+                deviating[:n] = deviation > tolerance
+                check.deviations += int(np.count_nonzero(deviating))
+                if n:
+                    check.max_deviation = max(check.max_deviation, float(deviation.max()))
+            check.blocks_per_pass[-1] += len(x)
+
+            # Back-plot
+            density += np.bincount(pixels(x, a), minlength=len(density))
+            bad = outside | deviating
+            bad[jumps] = True
+            flagged[pixels(x[bad], a[bad])] = True
+
+    # Passes
+    expected_depths = [round(d, 3) for d in np.cumsum(a2e.passes_depths()) + p.start_depth]
+    if len(check.pass_depths) != len(expected_depths) or not np.allclose(check.pass_depths, expected_depths, atol=0.0005):
+        error(f"Pass depths are {[round(d*1e3) for d in check.pass_depths]} um, expected {[round(d*1e3) for d in expected_depths]} um.")
+    expected_blocks = len(expected[0]) if expected is not None else (check.blocks_per_pass[0] if check.blocks_per_pass else 0)
+    if any(n != expected_blocks for n in check.blocks_per_pass):
+        error(f"Passes have {check.blocks_per_pass} blocks, expected {expected_blocks} each.")
+    if check.out_of_bounds:
+        error(f"{check.out_of_bounds} blocks are out of the engraving surface (X from {check.x_range[0]} to {check.x_range[1]} mm).")
+    if check.deviations:
+        error(f"{check.deviations} blocks are further than {tolerance} mm from the expected path (max {check.max_deviation:.4f} mm).")
+
+    print(f"Checked {check.nb_files} G-code files: {sum(check.blocks_per_pass)} blocks in {len(check.blocks_per_pass)} passes {[round(d*1e3) for d in check.pass_depths]} [um].")
+    print(f"X from {check.x_range[0]} to {check.x_range[1]} mm, {check.jumps} jumps" + (f", max deviation {check.max_deviation:.4f} mm." if expected is not None else "."))
+    print("G-code is valid." if check.ok else f"G-code has {len(check.errors)} errors.")
+
+    if backplot_filename is not None:
+        render_backplot_png(density.reshape(height, width), flagged.reshape(height, width), backplot_filename)
+    return check
+
+def render_backplot_png(density: np.ndarray, flagged: np.ndarray, filename: str) -> None:
+    """
+    Render the toolpath unrolled on the surface of the cylinder to a PNG image.
+
+    A is horizontal (one turn), X is vertical (length of the cylinder, X = 0 at the bottom). The limits of the
+    engraving surface are drawn in blue, and the flagged blocks in red.
+
+    :param density: Number of blocks in each pixel.
+    :param flagged: True for the pixels containing out-of-bounds, deviating or jumping blocks.
+    :param filename: Path of the PNG image.
+    """
+    # PIL is slow to import, so it is only imported when rendering
+    from PIL import Image
+
+    height, width = density.shape
+    shade = np.log1p(density) / max(np.log1p(density.max()), 1)
+    image = (np.array(BACKGROUND_COLOR) * (1 - shade[:, :, None]) + BACKPLOT_COLOR * shade[:, :, None]).astype(np.uint8)
+    for limit in (p.end_margin, p.L - p.end_margin):
+        image[int(np.clip((p.L - limit) / p.L * height, 0, height - 1)), ::4] = LIMIT_COLOR
+    image[flagged] = FLAGGED_COLOR
+
+    Image.fromarray(image).save(filename, format="PNG")
+    print(f"Back-plot exported to {filename}")